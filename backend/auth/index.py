@@ -1,13 +1,43 @@
 import json
 import os
-import hashlib
 import secrets
 import base64
 from datetime import datetime, timedelta
 from typing import Dict, Any, Optional
-import psycopg2
 from psycopg2.extras import RealDictCursor
+from db_pool import get_pool, report_query_count, execute_prepared
+from responses import JSON_HEADERS, dumps, preflight_headers
+from session_cache import get_session_token, resolve_user_id, invalidate_session, peek_user_id, remember_session, record_activity
+from session_touch import flush_session_touches
+from session_tokens import SIGNED_TOKEN_PREFIX, signed_tokens_enabled, issue_signed_token, revoke_signed_token
+from passwords import HasherBusy, hash_password, verify_password, needs_rehash
+from totp import verify_totp, provisioning_uri
 
+SESSION_TTL_SECONDS = 7 * 24 * 3600
+SESSION_MAX_PER_USER = int(os.environ.get('SESSION_MAX_PER_USER', '10'))
+
+LOGIN_QUERY = "SELECT id, email, language, theme, two_fa_enabled, two_fa_secret, password_hash FROM users WHERE email = %s"
+
+KNOWN_USER = "SELECT %s::integer AS user_id, NULL::float8 AS seconds_left"
+SESSION_USER = '''SELECT user_id, EXTRACT(EPOCH FROM (expires_at - NOW()))::float8 AS seconds_left
+                  FROM sessions WHERE session_token = %s AND expires_at > NOW()'''
+
+SESSION_CAP_SQL = '''
+    WITH created AS (
+        INSERT INTO sessions (user_id, session_token, expires_at) VALUES (%s, %s, %s)
+    )
+    DELETE FROM sessions WHERE user_id = %s AND (
+        expires_at <= NOW() OR id IN (
+            SELECT id FROM sessions WHERE user_id = %s AND expires_at > NOW()
+            ORDER BY expires_at DESC, id DESC OFFSET %s
+        )
+    )
+    RETURNING session_token
+'''
+
+PREFLIGHT_HEADERS = preflight_headers('GET, POST, PUT, OPTIONS', 'Content-Type, X-Session-Token')
+
+@report_query_count
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Authentication API with registration, login, 2FA setup
@@ -19,18 +49,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
-                'Access-Control-Max-Age': '86400'
-            },
+            'headers': dict(PREFLIGHT_HEADERS),
             'body': '',
             'isBase64Encoded': False
         }
     
-    db_url = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(db_url)
+    pool = get_pool()
+    conn = pool.getconn()
     
     try:
         if method == 'POST':
@@ -41,6 +66,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 return register_user(conn, body_data)
             elif action == 'login':
                 return login_user(conn, body_data)
+            elif action == 'logout':
+                return logout_user(conn, event.get('headers', {}))
             elif action == 'verify_session':
                 return verify_session(conn, event.get('headers', {}))
             elif action == 'enable_2fa':
@@ -57,20 +84,60 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         return {
             'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Method not allowed'}),
+            'isBase64Encoded': False
+        }
+    
+    except HasherBusy:
+        conn.rollback()
+        return {
+            'statusCode': 503,
+            'headers': {**JSON_HEADERS, 'Retry-After': '1'},
+            'body': dumps({'error': 'Too many login attempts in progress, retry shortly'}),
             'isBase64Encoded': False
         }
     
     finally:
-        conn.close()
-
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+        pool.putconn(conn)
+        flush_session_touches()
 
 def generate_session_token() -> str:
     return secrets.token_urlsafe(32)
 
+def create_session(cursor, user_id: int) -> str:
+    if signed_tokens_enabled():
+        session_token, _, _ = issue_signed_token(user_id, SESSION_TTL_SECONDS)
+        return session_token
+    
+    # Inserts the session and trims the user's others in one statement: the
+    # newest SESSION_MAX_PER_USER live sessions are kept and expired ones
+    # dropped. The DELETE cannot see the row inserted beside it, so it keeps
+    # one fewer of the existing sessions.
+    session_token = generate_session_token()
+    expires_at = datetime.now() + timedelta(seconds=SESSION_TTL_SECONDS)
+    execute_prepared(
+        cursor,
+        SESSION_CAP_SQL,
+        (user_id, session_token, expires_at, user_id, user_id, max(SESSION_MAX_PER_USER - 1, 0))
+    )
+    for row in cursor.fetchall():
+        invalidate_session(row['session_token'])
+    return session_token
+
+def session_user(conn, session_token: str) -> tuple:
+    # A cached or signed token is resolved in-process; otherwise the session
+    # lookup becomes a CTE of the statement that reads or writes the user.
+    user_id = peek_user_id(conn, session_token)
+    if user_id is not None:
+        return KNOWN_USER, (user_id,)
+    return SESSION_USER, (session_token,)
+
+def session_resolved(conn, session_token: str, user_id: int, seconds_left: Optional[float]) -> None:
+    if seconds_left is not None:
+        remember_session(session_token, user_id, seconds_left)
+    record_activity(session_token)
+
 def generate_2fa_secret() -> str:
     return base64.b32encode(secrets.token_bytes(20)).decode('utf-8')
 
@@ -82,43 +149,59 @@ def register_user(conn, body_data: Dict[str, Any]) -> Dict[str, Any]:
     if not email or not password:
         return {
             'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Email and password required'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Email and password required'}),
             'isBase64Encoded': False
         }
     
+    password_hash = hash_password(password)
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
-    cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
-    if cursor.fetchone():
+    # The unique email index decides whether the account is new; an opaque
+    # session is inserted by the same statement, so registration is one
+    # round trip plus the commit.
+    if signed_tokens_enabled():
+        cursor.execute(
+            """INSERT INTO users (email, password_hash, language) VALUES (%s, %s, %s)
+               ON CONFLICT (email) DO NOTHING
+               RETURNING id, email, language, theme, two_fa_enabled""",
+            (email, password_hash, language)
+        )
+        user = cursor.fetchone()
+        session_token = create_session(cursor, user['id']) if user else None
+    else:
+        session_token = generate_session_token()
+        cursor.execute(
+            """WITH u AS (
+                   INSERT INTO users (email, password_hash, language) VALUES (%s, %s, %s)
+                   ON CONFLICT (email) DO NOTHING
+                   RETURNING id, email, language, theme, two_fa_enabled
+               ), s AS (
+                   INSERT INTO sessions (user_id, session_token, expires_at)
+                   SELECT id, %s, %s FROM u
+               )
+               SELECT * FROM u""",
+            (email, password_hash, language, session_token, datetime.now() + timedelta(seconds=SESSION_TTL_SECONDS))
+        )
+        user = cursor.fetchone()
+    
+    if not user:
+        conn.rollback()
+        cursor.close()
         return {
             'statusCode': 409,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'User already exists'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'User already exists'}),
             'isBase64Encoded': False
         }
     
-    password_hash = hash_password(password)
-    cursor.execute(
-        "INSERT INTO users (email, password_hash, language) VALUES (%s, %s, %s) RETURNING id, email, language, theme, two_fa_enabled",
-        (email, password_hash, language)
-    )
-    user = cursor.fetchone()
-    
-    session_token = generate_session_token()
-    expires_at = datetime.now() + timedelta(days=7)
-    cursor.execute(
-        "INSERT INTO sessions (user_id, session_token, expires_at) VALUES (%s, %s, %s)",
-        (user['id'], session_token, expires_at)
-    )
-    
     conn.commit()
     cursor.close()
     
     return {
         'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({
             'user': dict(user),
             'session_token': session_token
         }),
@@ -132,42 +215,60 @@ def login_user(conn, body_data: Dict[str, Any]) -> Dict[str, Any]:
     if not email or not password:
         return {
             'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Email and password required'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Email and password required'}),
             'isBase64Encoded': False
         }
     
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    password_hash = hash_password(password)
-    
-    cursor.execute(
-        "SELECT id, email, language, theme, two_fa_enabled FROM users WHERE email = %s AND password_hash = %s",
-        (email, password_hash)
-    )
+    execute_prepared(cursor, LOGIN_QUERY, (email,))
     user = cursor.fetchone()
+    stored_hash = user.pop('password_hash') if user else None
+    two_fa_secret = user.pop('two_fa_secret') if user else None
     
-    if not user:
+    if not verify_password(password, stored_hash):
+        cursor.close()
         return {
             'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid credentials'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Invalid credentials'}),
             'isBase64Encoded': False
         }
     
-    session_token = generate_session_token()
-    expires_at = datetime.now() + timedelta(days=7)
-    cursor.execute(
-        "INSERT INTO sessions (user_id, session_token, expires_at) VALUES (%s, %s, %s)",
-        (user['id'], session_token, expires_at)
-    )
+    if user['two_fa_enabled'] and not verify_totp(user['id'], two_fa_secret, body_data.get('code')):
+        cursor.close()
+        return {
+            'statusCode': 401,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({
+                'error': 'Invalid two-factor code' if body_data.get('code') else 'Two-factor code required',
+                'two_fa_required': True
+            }),
+            'isBase64Encoded': False
+        }
+    
+    if needs_rehash(stored_hash):
+        # The upgrade is best-effort: with the hashing pool saturated the
+        # login still succeeds and the rehash waits for a later one.
+        try:
+            new_hash = hash_password(password)
+        except HasherBusy:
+            new_hash = None
+        if new_hash:
+            cursor.execute(
+                "UPDATE users SET password_hash = %s WHERE id = %s AND password_hash = %s",
+                (new_hash, user['id'], stored_hash)
+            )
+    
+    session_token = create_session(cursor, user['id'])
     
     conn.commit()
     cursor.close()
     
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({
             'user': dict(user),
             'session_token': session_token
         }),
@@ -175,23 +276,24 @@ def login_user(conn, body_data: Dict[str, Any]) -> Dict[str, Any]:
     }
 
 def verify_session(conn, headers: Dict[str, str]) -> Dict[str, Any]:
-    session_token = headers.get('x-session-token') or headers.get('X-Session-Token')
+    session_token = get_session_token(headers)
     
     if not session_token:
         return {
             'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Session token required'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Session token required'}),
             'isBase64Encoded': False
         }
     
+    me, params = session_user(conn, session_token)
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        '''SELECT u.id, u.email, u.language, u.theme, u.two_fa_enabled, u.analytics_enabled, u.action_logging_enabled
-           FROM users u
-           JOIN sessions s ON u.id = s.user_id
-           WHERE s.session_token = %s AND s.expires_at > NOW()''',
-        (session_token,)
+    execute_prepared(
+        cursor,
+        f"""WITH me AS ({me})
+            SELECT id, email, language, theme, two_fa_enabled, analytics_enabled, action_logging_enabled, me.seconds_left
+            FROM users JOIN me ON users.id = me.user_id""",
+        params
     )
     user = cursor.fetchone()
     cursor.close()
@@ -199,90 +301,148 @@ def verify_session(conn, headers: Dict[str, str]) -> Dict[str, Any]:
     if not user:
         return {
             'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid or expired session'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Invalid or expired session'}),
             'isBase64Encoded': False
         }
     
+    session_resolved(conn, session_token, user['id'], user.pop('seconds_left'))
+    
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'user': dict(user)}),
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'user': dict(user)}),
         'isBase64Encoded': False
     }
 
-def enable_2fa(conn, headers: Dict[str, str]) -> Dict[str, Any]:
-    session_token = headers.get('x-session-token') or headers.get('X-Session-Token')
+def logout_user(conn, headers: Dict[str, str]) -> Dict[str, Any]:
+    session_token = get_session_token(headers)
     
     if not session_token:
         return {
             'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Session token required'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Session token required'}),
             'isBase64Encoded': False
         }
     
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        "SELECT user_id FROM sessions WHERE session_token = %s AND expires_at > NOW()",
-        (session_token,)
-    )
-    session = cursor.fetchone()
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        revoke_signed_token(conn, session_token)
+    else:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM sessions WHERE session_token = %s", (session_token,))
+        conn.commit()
+        cursor.close()
+        invalidate_session(session_token)
+    
+    return {
+        'statusCode': 200,
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'message': 'Logged out'}),
+        'isBase64Encoded': False
+    }
+
+def enable_2fa(conn, headers: Dict[str, str]) -> Dict[str, Any]:
+    session_token = get_session_token(headers)
     
-    if not session:
+    if not session_token:
         return {
             'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid session'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Session token required'}),
             'isBase64Encoded': False
         }
     
     two_fa_secret = generate_2fa_secret()
+    me, params = session_user(conn, session_token)
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    # The secret only takes effect once verify_2fa confirms a code from it,
+    # so a user who never saved it cannot lock themselves out. An enabled
+    # user keeps their secret; the row still comes back to tell 409 from 401.
     cursor.execute(
-        "UPDATE users SET two_fa_secret = %s, two_fa_enabled = TRUE WHERE id = %s",
-        (two_fa_secret, session['user_id'])
+        f"""WITH me AS ({me})
+            UPDATE users SET two_fa_secret = CASE WHEN two_fa_enabled THEN two_fa_secret ELSE %s END
+            FROM me WHERE users.id = me.user_id
+            RETURNING users.id, users.email, users.two_fa_enabled, me.seconds_left""",
+        params + (two_fa_secret,)
     )
+    user = cursor.fetchone()
     conn.commit()
     cursor.close()
     
+    if not user:
+        return {
+            'statusCode': 401,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Invalid session'}),
+            'isBase64Encoded': False
+        }
+    
+    session_resolved(conn, session_token, user['id'], user['seconds_left'])
+    
+    if user['two_fa_enabled']:
+        return {
+            'statusCode': 409,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': '2FA already enabled'}),
+            'isBase64Encoded': False
+        }
+    
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'secret': two_fa_secret, 'message': '2FA enabled'}),
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({
+            'secret': two_fa_secret,
+            'otpauth_uri': provisioning_uri(two_fa_secret, user['email']),
+            'message': 'Confirm 2FA with verify_2fa'
+        }),
         'isBase64Encoded': False
     }
 
 def verify_2fa_code(conn, body_data: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
-    return {
-        'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'verified': True}),
-        'isBase64Encoded': False
-    }
-
-def update_user_settings(conn, body_data: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
-    session_token = headers.get('x-session-token') or headers.get('X-Session-Token')
+    user_id = resolve_user_id(conn, get_session_token(headers))
     
-    if not session_token:
+    if not user_id:
         return {
             'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Session token required'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Invalid session'}),
             'isBase64Encoded': False
         }
     
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        "SELECT user_id FROM sessions WHERE session_token = %s AND expires_at > NOW()",
-        (session_token,)
-    )
-    session = cursor.fetchone()
+    cursor.execute("SELECT two_fa_secret, two_fa_enabled FROM users WHERE id = %s", (user_id,))
+    user = cursor.fetchone()
+    
+    if not user or not verify_totp(user_id, user['two_fa_secret'], body_data.get('code')):
+        cursor.close()
+        return {
+            'statusCode': 401,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'verified': False, 'error': 'Invalid two-factor code'}),
+            'isBase64Encoded': False
+        }
+    
+    if not user['two_fa_enabled']:
+        cursor.execute("UPDATE users SET two_fa_enabled = TRUE, two_fa_confirmed_at = NOW() WHERE id = %s", (user_id,))
+        conn.commit()
+    cursor.close()
+    
+    return {
+        'statusCode': 200,
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'verified': True, 'two_fa_enabled': True}),
+        'isBase64Encoded': False
+    }
+
+def update_user_settings(conn, body_data: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+    session_token = get_session_token(headers)
     
-    if not session:
+    if not session_token:
         return {
             'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid session'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Session token required'}),
             'isBase64Encoded': False
         }
     
@@ -302,19 +462,34 @@ def update_user_settings(conn, body_data: Dict[str, Any], headers: Dict[str, str
         updates.append("action_logging_enabled = %s")
         params.append(body_data['action_logging_enabled'])
     
+    me, me_params = session_user(conn, session_token)
+    cursor = conn.cursor()
     if updates:
-        params.append(session['user_id'])
         cursor.execute(
-            f"UPDATE users SET {', '.join(updates)} WHERE id = %s",
-            params
+            f"""WITH me AS ({me})
+                UPDATE users SET {', '.join(updates)} FROM me WHERE users.id = me.user_id
+                RETURNING users.id, me.seconds_left""",
+            list(me_params) + params
         )
-        conn.commit()
-    
+    else:
+        cursor.execute(f"SELECT user_id, seconds_left FROM ({me}) me", me_params)
+    result = cursor.fetchone()
+    conn.commit()
     cursor.close()
     
+    if not result:
+        return {
+            'statusCode': 401,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Invalid session'}),
+            'isBase64Encoded': False
+        }
+    
+    session_resolved(conn, session_token, result[0], result[1])
+    
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'message': 'Settings updated'}),
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'message': 'Settings updated'}),
         'isBase64Encoded': False
     }
@@ -0,0 +1,178 @@
+'''
+Salted password hashing with per-hash KDF parameters.
+
+Hashes are stored as
+    scrypt$n=16384,r=8,p=1$<salt>$<key>
+    pbkdf2_sha256$i=600000$<salt>$<key>
+so the parameters can be raised without invalidating existing hashes; a
+hash made with other parameters, or a legacy unsalted SHA-256 hex digest,
+reports needs_rehash() and is replaced at the next successful login.
+
+KDF calls run on a bounded thread pool (hashlib releases the GIL while
+deriving). At most PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE calls are
+admitted at once; callers beyond that get HasherBusy after waiting
+PASSWORD_HASH_ADMIT_TIMEOUT seconds, so a login flood is shed instead of
+queueing up behind itself.
+
+    python passwords.py [threads] [seconds]   # hashing throughput at the current settings
+'''
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+PASSWORD_KDF = os.environ.get('PASSWORD_KDF', 'scrypt')
+PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', '16384'))
+PASSWORD_SCRYPT_R = int(os.environ.get('PASSWORD_SCRYPT_R', '8'))
+PASSWORD_SCRYPT_P = int(os.environ.get('PASSWORD_SCRYPT_P', '1'))
+PASSWORD_PBKDF2_ITERATIONS = int(os.environ.get('PASSWORD_PBKDF2_ITERATIONS', '600000'))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 1)))
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', str(4 * PASSWORD_HASH_WORKERS)))
+PASSWORD_HASH_ADMIT_TIMEOUT = float(os.environ.get('PASSWORD_HASH_ADMIT_TIMEOUT', '0.5'))
+
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def _derive(kdf: str, params: Dict[str, int], password: str, salt: bytes) -> bytes:
+    if kdf == 'scrypt':
+        n, r, p = params['n'], params['r'], params['p']
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                              maxmem=256 * n * r * p + 1024 * 1024, dklen=KEY_BYTES)
+    if kdf == 'pbkdf2_sha256':
+        return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, params['i'], dklen=KEY_BYTES)
+    raise ValueError(f'Unknown password KDF: {kdf}')
+
+
+def current_params() -> Dict[str, int]:
+    if PASSWORD_KDF == 'scrypt':
+        return {'n': PASSWORD_SCRYPT_N, 'r': PASSWORD_SCRYPT_R, 'p': PASSWORD_SCRYPT_P}
+    return {'i': PASSWORD_PBKDF2_ITERATIONS}
+
+
+def parse_hash(stored: str) -> Optional[tuple]:
+    try:
+        kdf, params, salt, key = stored.split('$')
+        parsed = {name: int(value) for name, value in (item.split('=') for item in params.split(','))}
+        return kdf, parsed, _b64decode(salt), _b64decode(key)
+    except (ValueError, AttributeError):
+        return None
+
+
+def is_legacy_hash(stored: str) -> bool:
+    return len(stored) == 64 and all(c in '0123456789abcdef' for c in stored)
+
+
+def needs_rehash(stored: str) -> bool:
+    parsed = parse_hash(stored)
+    return parsed is None or parsed[0] != PASSWORD_KDF or parsed[1] != current_params()
+
+
+def _hash_password(password: str) -> str:
+    params = current_params()
+    salt = secrets.token_bytes(SALT_BYTES)
+    key = _derive(PASSWORD_KDF, params, password, salt)
+    encoded = ','.join(f'{name}={value}' for name, value in params.items())
+    return f'{PASSWORD_KDF}${encoded}${_b64encode(salt)}${_b64encode(key)}'
+
+
+def _verify_password(password: str, stored: str) -> bool:
+    if is_legacy_hash(stored):
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+    parsed = parse_hash(stored)
+    if parsed is None:
+        return False
+    kdf, params, salt, key = parsed
+    return hmac.compare_digest(_derive(kdf, params, password, salt), key)
+
+
+class HashingPool:
+    def __init__(self, workers: int, queue: int, admit_timeout: float):
+        self.admit_timeout = admit_timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-kdf')
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        self._lock = threading.Lock()
+        self._stats = {'admitted': 0, 'rejected': 0}
+
+    def run(self, func: Callable, *args):
+        if not self._slots.acquire(timeout=self.admit_timeout):
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise HasherBusy()
+        with self._lock:
+            self._stats['admitted'] += 1
+        try:
+            return self._executor.submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+
+hashing_pool = HashingPool(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE, PASSWORD_HASH_ADMIT_TIMEOUT)
+
+_dummy_hash: Optional[str] = None
+
+
+def hash_password(password: str) -> str:
+    return hashing_pool.run(_hash_password, password)
+
+
+def verify_password(password: str, stored: Optional[str]) -> bool:
+    '''
+    Checks password against stored; with stored None (unknown user) a hash
+    of the same cost is still computed so the response time does not reveal
+    whether the account exists.
+    '''
+    global _dummy_hash
+    if stored is None:
+        if _dummy_hash is None:
+            _dummy_hash = _hash_password(secrets.token_urlsafe(16))
+        hashing_pool.run(_verify_password, password, _dummy_hash)
+        return False
+    return hashing_pool.run(_verify_password, password, stored)
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else PASSWORD_HASH_WORKERS
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    stored = _hash_password('benchmark-password')
+    done = [0]
+    deadline = time.monotonic() + seconds
+
+    def login_loop():
+        while time.monotonic() < deadline:
+            try:
+                verify_password('benchmark-password', stored)
+                with hashing_pool._lock:
+                    done[0] += 1
+            except HasherBusy:
+                pass
+
+    workers = [threading.Thread(target=login_loop) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    print(f'[passwords] {PASSWORD_KDF} {current_params()}: {done[0] / seconds:.1f} verifications/s '
+          f'with {threads} callers, {PASSWORD_HASH_WORKERS} workers; {hashing_pool.stats()}')
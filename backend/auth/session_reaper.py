@@ -0,0 +1,183 @@
+'''
+Session lifecycle maintenance.
+
+    python session_reaper.py               # reap expired sessions and revocations
+    python session_reaper.py --partition   # convert sessions to range partitions first
+
+Expired rows are deleted in batches of SESSION_REAP_BATCH_SIZE, each in its
+own short transaction, so the reaper never holds many row locks or produces
+one huge WAL burst. Once sessions is partitioned by expires_at, partitions
+whose whole range has expired are dropped instead, and partitions for the
+next SESSION_PARTITION_AHEAD_DAYS are created ahead of time; a default
+partition catches anything outside the prepared range.
+'''
+import os
+import re
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+SESSION_REAP_BATCH_SIZE = int(os.environ.get('SESSION_REAP_BATCH_SIZE', '1000'))
+SESSION_REAP_PAUSE = float(os.environ.get('SESSION_REAP_PAUSE', '0.05'))
+SESSION_PARTITION_DAYS = int(os.environ.get('SESSION_PARTITION_DAYS', '1'))
+SESSION_PARTITION_AHEAD_DAYS = int(os.environ.get('SESSION_PARTITION_AHEAD_DAYS', '30'))
+
+PARTITION_BOUND = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def reap_expired(conn, table: str, key: str, batch_size: int = SESSION_REAP_BATCH_SIZE) -> int:
+    reaped = 0
+    cursor = conn.cursor()
+    while True:
+        cursor.execute(
+            f'''DELETE FROM {table} WHERE {key} IN (
+                    SELECT {key} FROM {table} WHERE expires_at <= NOW()
+                    ORDER BY expires_at LIMIT %s FOR UPDATE SKIP LOCKED
+                )''',
+            (batch_size,)
+        )
+        deleted = cursor.rowcount
+        conn.commit()
+        reaped += deleted
+        if deleted < batch_size:
+            break
+        time.sleep(SESSION_REAP_PAUSE)
+    cursor.close()
+    return reaped
+
+
+def is_partitioned(conn) -> bool:
+    cursor = conn.cursor()
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = 'sessions'::regclass")
+    partitioned = cursor.fetchone()[0]
+    conn.commit()
+    cursor.close()
+    return partitioned
+
+
+def list_partitions(conn) -> List[Tuple[str, datetime, datetime]]:
+    cursor = conn.cursor()
+    cursor.execute(
+        '''SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+           FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+           WHERE i.inhparent = 'sessions'::regclass'''
+    )
+    partitions = []
+    for name, bound in cursor.fetchall():
+        match = PARTITION_BOUND.search(bound or '')
+        if match:
+            partitions.append((name, datetime.fromisoformat(match.group(1)), datetime.fromisoformat(match.group(2))))
+    conn.commit()
+    cursor.close()
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def ensure_partitions(conn, ahead_days: int = SESSION_PARTITION_AHEAD_DAYS) -> int:
+    existing = list_partitions(conn)
+    start = existing[-1][2] if existing else datetime.combine(datetime.now().date(), datetime.min.time())
+    horizon = datetime.now() + timedelta(days=ahead_days)
+    step = timedelta(days=SESSION_PARTITION_DAYS)
+    cursor = conn.cursor()
+    created = 0
+    while start < horizon:
+        end = start + step
+        cursor.execute(
+            f'''CREATE TABLE IF NOT EXISTS sessions_p{start:%Y%m%d} PARTITION OF sessions
+                FOR VALUES FROM ('{start.isoformat(sep=' ')}') TO ('{end.isoformat(sep=' ')}')'''
+        )
+        conn.commit()
+        created += 1
+        start = end
+    cursor.close()
+    return created
+
+
+def drop_expired_partitions(conn) -> int:
+    now = datetime.now()
+    cursor = conn.cursor()
+    dropped = 0
+    for name, _, upper in list_partitions(conn):
+        if upper <= now:
+            # The detach is committed on its own, so the ACCESS EXCLUSIVE lock
+            # on the parent is released before the drop; the drop then only
+            # locks the detached table. DETACH ... CONCURRENTLY is not an
+            # option while a default partition exists.
+            cursor.execute(f'ALTER TABLE sessions DETACH PARTITION {name}')
+            conn.commit()
+            cursor.execute(f'DROP TABLE {name}')
+            conn.commit()
+            dropped += 1
+    # Partitions detached by an earlier run whose drop failed.
+    cursor.execute(
+        '''SELECT relname FROM pg_class
+           WHERE relname ~ '^sessions_p[0-9]{8}$' AND relkind = 'r' AND NOT relispartition'''
+    )
+    for (name,) in cursor.fetchall():
+        cursor.execute(f'DROP TABLE {name}')
+        dropped += 1
+    conn.commit()
+    cursor.close()
+    return dropped
+
+
+def partition_sessions(conn) -> None:
+    '''
+    Rebuilds sessions as a table range-partitioned by expires_at, copying
+    the live rows. Runs in one transaction under an exclusive lock, so it is
+    meant for a maintenance window. session_token stays indexed but is only
+    unique together with expires_at, since a unique constraint on a
+    partitioned table must include the partition key.
+    '''
+    if is_partitioned(conn):
+        return
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    cursor = conn.cursor()
+    cursor.execute('LOCK TABLE sessions IN ACCESS EXCLUSIVE MODE')
+    cursor.execute('CREATE TABLE sessions_partitioned (LIKE sessions INCLUDING DEFAULTS) PARTITION BY RANGE (expires_at)')
+    cursor.execute('ALTER TABLE sessions_partitioned ADD PRIMARY KEY (id, expires_at)')
+    cursor.execute('ALTER TABLE sessions_partitioned ADD UNIQUE (session_token, expires_at)')
+    cursor.execute('ALTER TABLE sessions_partitioned ADD FOREIGN KEY (user_id) REFERENCES users(id)')
+    cursor.execute('CREATE TABLE sessions_default PARTITION OF sessions_partitioned DEFAULT')
+    cursor.execute('SELECT MAX(expires_at) FROM sessions')
+    latest = cursor.fetchone()[0] or today
+    start = today
+    while start <= max(latest, today + timedelta(days=SESSION_PARTITION_AHEAD_DAYS)):
+        end = start + timedelta(days=SESSION_PARTITION_DAYS)
+        cursor.execute(
+            f'''CREATE TABLE sessions_p{start:%Y%m%d} PARTITION OF sessions_partitioned
+                FOR VALUES FROM ('{start.isoformat(sep=' ')}') TO ('{end.isoformat(sep=' ')}')'''
+        )
+        start = end
+    cursor.execute('INSERT INTO sessions_partitioned SELECT * FROM sessions WHERE expires_at > NOW()')
+    cursor.execute('ALTER SEQUENCE sessions_id_seq OWNED BY sessions_partitioned.id')
+    cursor.execute('DROP TABLE sessions')
+    cursor.execute('ALTER TABLE sessions_partitioned RENAME TO sessions')
+    cursor.execute('CREATE INDEX idx_sessions_token_cover ON sessions(session_token) INCLUDE (user_id, expires_at)')
+    cursor.execute('CREATE INDEX idx_sessions_expires ON sessions(expires_at)')
+    cursor.execute('CREATE INDEX idx_sessions_user_recent ON sessions(user_id, expires_at DESC, id DESC)')
+    conn.commit()
+    cursor.close()
+
+
+def run(conn) -> Dict[str, int]:
+    stats = {}
+    if is_partitioned(conn):
+        stats['partitions_created'] = ensure_partitions(conn)
+        stats['partitions_dropped'] = drop_expired_partitions(conn)
+    stats['sessions_reaped'] = reap_expired(conn, 'sessions', 'id')
+    stats['revocations_reaped'] = reap_expired(conn, 'revoked_session_tokens', 'token_id')
+    return stats
+
+
+if __name__ == '__main__':
+    from db_pool import get_pool
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        if '--partition' in sys.argv[1:]:
+            partition_sessions(conn)
+            print('[session_reaper] sessions is now partitioned by expires_at')
+        print(f'[session_reaper] {run(conn)}')
+    finally:
+        pool.putconn(conn)
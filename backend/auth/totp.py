@@ -0,0 +1,108 @@
+'''
+RFC 6238 TOTP verification (HMAC-SHA1, TOTP_DIGITS digits, TOTP_STEP second
+steps, TOTP_WINDOW steps of clock drift either way).
+
+Decoded secrets and the codes of the current window are cached per user,
+so a verification is a few dictionary lookups and no database access. An
+accepted code's time step is remembered per user and any code from that
+step or an earlier one is refused afterwards (RFC 6238 section 5.2). The
+replay state lives in memory, so it covers the instance that accepted the
+code; with several instances a code stays replayable elsewhere for at most
+the remaining window.
+'''
+import base64
+import hashlib
+import hmac
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from urllib.parse import quote
+
+TOTP_STEP = int(os.environ.get('TOTP_STEP', '30'))
+TOTP_DIGITS = int(os.environ.get('TOTP_DIGITS', '6'))
+TOTP_WINDOW = int(os.environ.get('TOTP_WINDOW', '1'))
+TOTP_ISSUER = os.environ.get('TOTP_ISSUER', 'Library')
+
+
+def decode_secret(secret: str) -> bytes:
+    cleaned = secret.replace(' ', '').upper()
+    return base64.b32decode(cleaned + '=' * (-len(cleaned) % 8))
+
+
+def hotp(key: bytes, counter: int, digits: int = TOTP_DIGITS) -> str:
+    digest = hmac.new(key, struct.pack('>Q', counter), hashlib.sha1).digest()
+    offset = digest[-1] & 0x0F
+    value = struct.unpack('>I', digest[offset:offset + 4])[0] & 0x7FFFFFFF
+    return str(value % 10 ** digits).zfill(digits)
+
+
+def provisioning_uri(secret: str, account: str) -> str:
+    return (f'otpauth://totp/{quote(TOTP_ISSUER)}:{quote(account)}'
+            f'?secret={secret}&issuer={quote(TOTP_ISSUER)}&digits={TOTP_DIGITS}&period={TOTP_STEP}')
+
+
+class TotpVerifier:
+    def __init__(self, max_users: int = 10000):
+        self.max_users = max_users
+        # user_id -> (secret, key, {counter: code})
+        self._users: 'OrderedDict[int, Tuple[str, bytes, Dict[int, str]]]' = OrderedDict()
+        self._last_used: 'OrderedDict[int, int]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'accepted': 0, 'rejected': 0, 'replays': 0}
+
+    def _window_codes(self, user_id: int, secret: str, counter: int) -> Dict[int, str]:
+        entry = self._users.get(user_id)
+        if entry is None or entry[0] != secret:
+            entry = (secret, decode_secret(secret), {})
+        _, key, codes = entry
+        wanted = range(counter - TOTP_WINDOW, counter + TOTP_WINDOW + 1)
+        window = {step: codes.get(step) or hotp(key, step) for step in wanted}
+        self._users[user_id] = (secret, key, window)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        return window
+
+    def verify(self, user_id: int, secret: str, code: str, now: Optional[float] = None) -> bool:
+        code = str(code).strip()
+        counter = int((time.time() if now is None else now) // TOTP_STEP)
+        with self._lock:
+            matched = None
+            for step, expected in self._window_codes(user_id, secret, counter).items():
+                if hmac.compare_digest(expected, code):
+                    matched = step
+            if matched is None:
+                self._stats['rejected'] += 1
+                return False
+            if matched <= self._last_used.get(user_id, -1):
+                self._stats['replays'] += 1
+                return False
+            self._last_used[user_id] = matched
+            self._last_used.move_to_end(user_id)
+            while len(self._last_used) > self.max_users:
+                self._last_used.popitem(last=False)
+            self._stats['accepted'] += 1
+            return True
+
+    def forget(self, user_id: int) -> None:
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, 'users': len(self._users)}
+
+
+totp_verifier = TotpVerifier(max_users=int(os.environ.get('TOTP_CACHE_SIZE', '10000')))
+
+
+def verify_totp(user_id: int, secret: Optional[str], code: Optional[str]) -> bool:
+    if not secret or not code:
+        return False
+    try:
+        return totp_verifier.verify(user_id, secret, code)
+    except (ValueError, TypeError):
+        return False
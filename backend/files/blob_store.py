@@ -0,0 +1,263 @@
+'''
+Content-addressed blob storage for the files service. Bytes are stored once
+per SHA-256 digest and shared between users; the blobs table keeps the
+reference count. Byte writes and deletes happen while the blob row is locked
+by the surrounding transaction, so an upload and a collection of the same
+digest never interleave.
+
+Bytes are written before that transaction commits. If it rolls back, the
+file stays on disk with no blobs row; sweep_orphans, run by the purge job,
+removes such files.
+'''
+import hashlib
+import itertools
+import mmap
+import os
+import re
+import shutil
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from typing import Iterator, List, Optional, Tuple
+from psycopg2.extras import execute_values
+
+DIGEST_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+
+class BlobStore(ABC):
+    def key_for(self, digest: str) -> str:
+        return f'sha256/{digest[:2]}/{digest[2:4]}/{digest}'
+
+    @abstractmethod
+    def exists(self, digest: str) -> bool:
+        ...
+
+    @abstractmethod
+    def put(self, digest: str, data: bytes) -> None:
+        ...
+
+    @abstractmethod
+    def get(self, digest: str) -> bytes:
+        ...
+
+    def read_ranges(self, digest: str, ranges: List[Tuple[int, int]]) -> List[bytes]:
+        data = self.get(digest)
+        return [data[start:end + 1] for start, end in ranges]
+
+    @abstractmethod
+    def delete(self, digest: str) -> None:
+        ...
+
+    @abstractmethod
+    def iter_digests(self, written_before: float) -> Iterator[str]:
+        '''
+        Yields the digest of every stored blob last written before the given
+        epoch time; staged upload parts are not included.
+        '''
+
+    @abstractmethod
+    def put_part(self, upload_id: str, index: int, data: bytes) -> None:
+        ...
+
+    @abstractmethod
+    def assemble_parts(self, upload_id: str, count: int) -> Tuple[str, int]:
+        '''
+        Concatenates parts 0..count-1 into a staged object, returning its
+        digest and size; promote_staged() then files it under that digest.
+        '''
+
+    @abstractmethod
+    def promote_staged(self, upload_id: str, digest: str) -> None:
+        ...
+
+    @abstractmethod
+    def discard_upload(self, upload_id: str) -> None:
+        ...
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, root: str):
+        self.root = root
+
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self.path_for(digest))
+
+    def put(self, digest: str, data: bytes) -> None:
+        path = self.path_for(digest)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, digest: str) -> bytes:
+        with open(self.path_for(digest), 'rb') as blob:
+            return blob.read()
+
+    def read_ranges(self, digest: str, ranges: List[Tuple[int, int]]) -> List[bytes]:
+        # Only the requested slices are copied out of the page cache, so memory
+        # per request follows the range size rather than the file size.
+        with open(self.path_for(digest), 'rb') as blob:
+            if os.fstat(blob.fileno()).st_size == 0:
+                return [b'' for _ in ranges]
+            with mmap.mmap(blob.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return [mapped[start:end + 1] for start, end in ranges]
+
+    def delete(self, digest: str) -> None:
+        try:
+            os.remove(self.path_for(digest))
+        except FileNotFoundError:
+            pass
+
+    def iter_digests(self, written_before: float) -> Iterator[str]:
+        for prefix in os.listdir(self.root) if os.path.isdir(self.root) else []:
+            if len(prefix) != 2:
+                continue
+            for directory, _, names in os.walk(os.path.join(self.root, prefix)):
+                for name in names:
+                    if not DIGEST_PATTERN.fullmatch(name):
+                        continue
+                    try:
+                        if os.stat(os.path.join(directory, name)).st_mtime < written_before:
+                            yield name
+                    except FileNotFoundError:
+                        pass
+
+    def upload_dir(self, upload_id: str) -> str:
+        return os.path.join(self.root, 'uploads', upload_id)
+
+    def put_part(self, upload_id: str, index: int, data: bytes) -> None:
+        directory = self.upload_dir(upload_id)
+        os.makedirs(directory, exist_ok=True)
+        # A retry of the same chunk may run alongside the original request,
+        # so each writer gets its own temporary file.
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{index}-')
+        try:
+            with os.fdopen(fd, 'wb') as part:
+                part.write(data)
+            os.replace(tmp_path, os.path.join(directory, str(index)))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def assemble_parts(self, upload_id: str, count: int) -> Tuple[str, int]:
+        directory = self.upload_dir(upload_id)
+        digest = hashlib.sha256()
+        size = 0
+        with open(os.path.join(directory, 'staged'), 'wb') as staged:
+            for index in range(count):
+                with open(os.path.join(directory, str(index)), 'rb') as part:
+                    while True:
+                        block = part.read(1024 * 1024)
+                        if not block:
+                            break
+                        digest.update(block)
+                        staged.write(block)
+                        size += len(block)
+        return digest.hexdigest(), size
+
+    def promote_staged(self, upload_id: str, digest: str) -> None:
+        staged = os.path.join(self.upload_dir(upload_id), 'staged')
+        if self.exists(digest):
+            return
+        path = self.path_for(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(staged, path)
+
+    def discard_upload(self, upload_id: str) -> None:
+        shutil.rmtree(self.upload_dir(upload_id), ignore_errors=True)
+
+
+_store: Optional[BlobStore] = None
+
+
+def get_blob_store() -> BlobStore:
+    global _store
+    if _store is None:
+        backend = os.environ.get('BLOB_STORE_BACKEND', 'local')
+        if backend != 'local':
+            raise RuntimeError(f'Unknown BLOB_STORE_BACKEND: {backend}')
+        _store = LocalBlobStore(os.environ.get('BLOB_STORE_ROOT', '/tmp/blobs'))
+    return _store
+
+
+def content_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def reference_blob(cursor, digest: str, size: int) -> None:
+    cursor.execute(
+        '''INSERT INTO blobs (hash, size, ref_count) VALUES (%s, %s, 1)
+           ON CONFLICT (hash) DO UPDATE SET ref_count = blobs.ref_count + 1''',
+        (digest, size)
+    )
+
+
+def acquire_blob(cursor, store: BlobStore, digest: str, data: bytes) -> None:
+    reference_blob(cursor, digest, len(data))
+    if not store.exists(digest):
+        store.put(digest, data)
+
+
+def release_blob(cursor, digest: str) -> None:
+    cursor.execute("UPDATE blobs SET ref_count = ref_count - 1 WHERE hash = %s", (digest,))
+
+
+def collect_blob(conn, store: BlobStore, digest: str) -> bool:
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM blobs WHERE hash = %s AND ref_count <= 0 RETURNING hash", (digest,))
+    unreferenced = cursor.fetchone() is not None
+    derived: List[str] = []
+    if unreferenced:
+        store.delete(digest)
+        # Previews are blobs of their own, referenced once per source digest.
+        cursor.execute("DELETE FROM preview_jobs WHERE source_hash = %s", (digest,))
+        cursor.execute("DELETE FROM previews WHERE source_hash = %s RETURNING preview_hash", (digest,))
+        derived = [row[0] for row in cursor.fetchall()]
+        for preview_hash in derived:
+            release_blob(cursor, preview_hash)
+    conn.commit()
+    cursor.close()
+    for preview_hash in derived:
+        collect_blob(conn, store, preview_hash)
+    return unreferenced
+
+
+def sweep_orphans(conn, store: BlobStore, grace: float, batch_size: int) -> int:
+    '''
+    Deletes stored blobs older than grace seconds that have no blobs row,
+    left behind by rolled back uploads; returns how many were removed.
+    '''
+    removed = 0
+    digests = store.iter_digests(time.time() - grace)
+    while True:
+        batch = sorted(itertools.islice(digests, batch_size))
+        if not batch:
+            return removed
+        cursor = conn.cursor()
+        # A placeholder row claims each digest that has none. An upload of the
+        # same digest either committed its row first, so the insert skips it,
+        # or waits on the placeholder and writes the bytes again afterwards.
+        orphans = execute_values(
+            cursor,
+            '''INSERT INTO blobs (hash, size, ref_count) VALUES %s
+               ON CONFLICT (hash) DO NOTHING RETURNING hash''',
+            [(digest, 0, 0) for digest in batch],
+            fetch=True
+        )
+        orphans = [row[0] for row in orphans]
+        for digest in orphans:
+            store.delete(digest)
+        if orphans:
+            cursor.execute("DELETE FROM blobs WHERE hash = ANY(%s)", (orphans,))
+        conn.commit()
+        cursor.close()
+        removed += len(orphans)
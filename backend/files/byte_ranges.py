@@ -0,0 +1,89 @@
+'''
+HTTP Range (RFC 9110) parsing and multipart/byteranges assembly for blob
+downloads.
+'''
+import secrets
+from typing import List, Optional, Tuple
+
+ByteRange = Tuple[int, int]
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range_header(header: Optional[str], size: int) -> Optional[List[ByteRange]]:
+    '''
+    Returns inclusive (start, end) pairs, or None when the header is absent
+    or malformed and the full representation should be served instead.
+    '''
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+
+    ranges: List[ByteRange] = []
+    for part in spec.split(','):
+        first, dash, last = part.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if not first:
+                suffix = int(last)
+                if suffix <= 0:
+                    continue
+                start, end = max(size - suffix, 0), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else size - 1
+        except ValueError:
+            return None
+        if start > end and last:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+    return coalesce(ranges)
+
+
+def coalesce(ranges: List[ByteRange]) -> List[ByteRange]:
+    merged: List[ByteRange] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def clamp_to_budget(ranges: List[ByteRange], budget: int) -> List[ByteRange]:
+    '''
+    Serves at most budget bytes; later ranges are dropped and the last one
+    is shortened, which clients handle by requesting the remainder.
+    '''
+    clamped: List[ByteRange] = []
+    for start, end in ranges:
+        if budget <= 0:
+            break
+        end = min(end, start + budget - 1)
+        clamped.append((start, end))
+        budget -= end - start + 1
+    return clamped
+
+
+def multipart_byteranges(parts: List[Tuple[ByteRange, bytes]], size: int, content_type: str) -> Tuple[bytes, str]:
+    boundary = secrets.token_hex(16)
+    chunks = []
+    for (start, end), data in parts:
+        chunks.append(
+            f'--{boundary}\r\nContent-Type: {content_type}\r\n'
+            f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'.encode()
+        )
+        chunks.append(data)
+        chunks.append(b'\r\n')
+    chunks.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(chunks), f'multipart/byteranges; boundary={boundary}'
@@ -0,0 +1,298 @@
+'''
+Resumable chunked upload protocol: upload_init -> upload_chunk (any order,
+in parallel) -> upload_status -> upload_complete. Parts are staged in the
+blob store and concatenated once on completion while the digest is computed,
+so finishing an upload reads every byte exactly once.
+'''
+import base64
+import binascii
+import hashlib
+import math
+import os
+import re
+import secrets
+from typing import Dict, Any, Optional
+from psycopg2.extras import RealDictCursor
+from blob_store import get_blob_store, reference_blob
+from collection_versions import bump_version
+from previews import enqueue_preview
+from response_cache import response_cache
+from responses import JSON_HEADERS, dumps
+from storage_quota import reserve_storage, settle_reservation, get_usage
+
+DEFAULT_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', str(2 * 1024 * 1024)))
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+UPLOAD_TTL_HOURS = 24
+# files.type is VARCHAR(50), and 'deleted' marks a tombstone.
+FILE_TYPE_MAX_LENGTH = 50
+# A bare token such as 'unknown' or a type/subtype pair, without parameters;
+# the value ends up in a Content-Type header.
+FILE_TYPE_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9!#$&^_.+-]*(/[A-Za-z0-9][A-Za-z0-9!#$&^_.+-]*)?")
+
+
+def validate_file_type(file_type: Any) -> Optional[str]:
+    if not isinstance(file_type, str) or not file_type:
+        return 'File type must be a non-empty string'
+    if file_type == 'deleted':
+        return "File type 'deleted' is reserved"
+    if len(file_type) > FILE_TYPE_MAX_LENGTH:
+        return f'type must be at most {FILE_TYPE_MAX_LENGTH} characters'
+    if not FILE_TYPE_PATTERN.fullmatch(file_type):
+        return 'type must be a MIME type such as image/png'
+    return None
+
+
+def init_upload(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    name = body_data.get('name')
+    size = body_data.get('size')
+    file_type = body_data.get('type', 'unknown')
+    chunk_size = body_data.get('chunk_size', DEFAULT_CHUNK_SIZE)
+
+    if not name or not isinstance(size, int) or size <= 0:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'File name and positive size required'}),
+            'isBase64Encoded': False
+        }
+    if not isinstance(chunk_size, int) or not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': f'chunk_size must be between {MIN_CHUNK_SIZE} and {MAX_CHUNK_SIZE}'}),
+            'isBase64Encoded': False
+        }
+    error = validate_file_type(file_type)
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': error}),
+            'isBase64Encoded': False
+        }
+
+    upload_id = secrets.token_hex(16)
+    chunk_count = math.ceil(size / chunk_size)
+    cursor = conn.cursor()
+    if not reserve_storage(cursor, user_id, size):
+        conn.rollback()
+        cursor.close()
+        return {
+            'statusCode': 413,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Storage quota exceeded', 'usage': get_usage(conn, user_id)}),
+            'isBase64Encoded': False
+        }
+    cursor.execute(
+        '''INSERT INTO uploads (id, user_id, name, type, size, chunk_size, chunk_count, expires_at)
+           VALUES (%s, %s, %s, %s, %s, %s, %s, NOW() + make_interval(hours => %s))''',
+        (upload_id, user_id, name, file_type, size, chunk_size, chunk_count, UPLOAD_TTL_HOURS)
+    )
+    conn.commit()
+    cursor.close()
+
+    return {
+        'statusCode': 201,
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'upload_id': upload_id, 'chunk_size': chunk_size, 'chunk_count': chunk_count}),
+        'isBase64Encoded': False
+    }
+
+
+def put_chunk(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    upload_id = body_data.get('upload_id')
+    index = body_data.get('index')
+    checksum = str(body_data.get('checksum', '')).lower()
+
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    # FOR SHARE lets chunks arrive in parallel while upload_complete, which
+    # takes FOR UPDATE, waits for in-flight chunks to commit.
+    cursor.execute(
+        '''SELECT size, chunk_size, chunk_count FROM uploads
+           WHERE id = %s AND user_id = %s AND status = 'pending' AND expires_at > NOW()
+           FOR SHARE''',
+        (upload_id, user_id)
+    )
+    upload = cursor.fetchone()
+
+    if not upload:
+        cursor.close()
+        return {
+            'statusCode': 404,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Upload not found'}),
+            'isBase64Encoded': False
+        }
+
+    if not isinstance(index, int) or not 0 <= index < upload['chunk_count']:
+        cursor.close()
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Invalid chunk index'}),
+            'isBase64Encoded': False
+        }
+
+    try:
+        data = base64.b64decode(body_data.get('content', ''), validate=True)
+    except (binascii.Error, ValueError):
+        data = None
+
+    last_index = upload['chunk_count'] - 1
+    expected_size = upload['size'] - upload['chunk_size'] * last_index if index == last_index else upload['chunk_size']
+    if data is None or len(data) != expected_size:
+        cursor.close()
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': f'Chunk content must be {expected_size} base64-encoded bytes'}),
+            'isBase64Encoded': False
+        }
+
+    if hashlib.sha256(data).hexdigest() != checksum:
+        cursor.close()
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Chunk checksum mismatch'}),
+            'isBase64Encoded': False
+        }
+
+    get_blob_store().put_part(upload_id, index, data)
+    cursor.execute(
+        '''INSERT INTO upload_chunks (upload_id, chunk_index, size, checksum) VALUES (%s, %s, %s, %s)
+           ON CONFLICT (upload_id, chunk_index) DO UPDATE SET size = EXCLUDED.size, checksum = EXCLUDED.checksum, created_at = NOW()''',
+        (upload_id, index, len(data), checksum)
+    )
+    conn.commit()
+    cursor.close()
+
+    return {
+        'statusCode': 200,
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'upload_id': upload_id, 'index': index, 'received': True}),
+        'isBase64Encoded': False
+    }
+
+
+def upload_status(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(
+        '''SELECT u.id AS upload_id, u.name, u.size, u.chunk_size, u.chunk_count, u.status, u.file_id, u.expires_at,
+                  COALESCE(array_agg(c.chunk_index ORDER BY c.chunk_index) FILTER (WHERE c.chunk_index IS NOT NULL), '{}') AS received
+           FROM uploads u
+           LEFT JOIN upload_chunks c ON c.upload_id = u.id
+           WHERE u.id = %s AND u.user_id = %s
+           GROUP BY u.id''',
+        (body_data.get('upload_id'), user_id)
+    )
+    upload = cursor.fetchone()
+    cursor.close()
+
+    if not upload:
+        return {
+            'statusCode': 404,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Upload not found'}),
+            'isBase64Encoded': False
+        }
+
+    received = set(upload['received'])
+    upload_data = dict(upload)
+    upload_data['missing'] = [i for i in range(upload['chunk_count']) if i not in received]
+
+    return {
+        'statusCode': 200,
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'upload': upload_data}),
+        'isBase64Encoded': False
+    }
+
+
+def complete_upload(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    upload_id = body_data.get('upload_id')
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(
+        '''SELECT id, name, type, size, chunk_count, status, file_id, expires_at > NOW() AS live
+           FROM uploads WHERE id = %s AND user_id = %s FOR UPDATE''',
+        (upload_id, user_id)
+    )
+    upload = cursor.fetchone()
+
+    if not upload or (upload['status'] == 'pending' and not upload['live']):
+        cursor.close()
+        return {
+            'statusCode': 404,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Upload not found'}),
+            'isBase64Encoded': False
+        }
+
+    if upload['status'] == 'complete':
+        # file_id is set to NULL once the file is purged.
+        cursor.execute(
+            "SELECT id, name, size, type, created_at FROM files WHERE id = %s AND type <> 'deleted'",
+            (upload['file_id'],)
+        )
+        file_record = cursor.fetchone()
+        conn.commit()
+        cursor.close()
+        if not file_record:
+            return {
+                'statusCode': 410,
+                'headers': dict(JSON_HEADERS),
+                'body': dumps({'error': 'Uploaded file has been deleted'}),
+                'isBase64Encoded': False
+            }
+        return {
+            'statusCode': 200,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'file': dict(file_record)}),
+            'isBase64Encoded': False
+        }
+
+    cursor.execute(
+        "SELECT COUNT(*) AS chunks, COALESCE(SUM(size), 0) AS bytes FROM upload_chunks WHERE upload_id = %s",
+        (upload_id,)
+    )
+    received = cursor.fetchone()
+    if received['chunks'] != upload['chunk_count'] or received['bytes'] != upload['size']:
+        conn.commit()
+        cursor.close()
+        return {
+            'statusCode': 409,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Upload incomplete', 'received': received['chunks'], 'chunk_count': upload['chunk_count']}),
+            'isBase64Encoded': False
+        }
+
+    settle_reservation(cursor, user_id, upload['size'])
+    store = get_blob_store()
+    digest, size = store.assemble_parts(upload_id, upload['chunk_count'])
+    reference_blob(cursor, digest, size)
+    store.promote_staged(upload_id, digest)
+    enqueue_preview(cursor, digest, upload['type'])
+
+    cursor.execute(
+        "INSERT INTO files (user_id, name, size, type, storage_key, content_hash) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id, name, size, type, created_at",
+        (user_id, upload['name'], size, upload['type'], store.key_for(digest), digest)
+    )
+    file_record = cursor.fetchone()
+    cursor.execute(
+        "UPDATE uploads SET status = 'complete', file_id = %s WHERE id = %s",
+        (file_record['id'], upload_id)
+    )
+    cursor.execute("DELETE FROM upload_chunks WHERE upload_id = %s", (upload_id,))
+    bump_version(cursor, user_id, 'files')
+    conn.commit()
+    cursor.close()
+    response_cache.invalidate(user_id, 'files')
+    store.discard_upload(upload_id)
+
+    return {
+        'statusCode': 201,
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'file': dict(file_record)}),
+        'isBase64Encoded': False
+    }
@@ -0,0 +1,133 @@
+'''
+Purge job for deleted files.
+
+    python file_purge.py
+
+Tombstones older than FILES_PURGE_AFTER_DAYS are moved to files_archive in
+batches of FILES_PURGE_BATCH_SIZE rows, one short transaction per batch, and
+the blob references they held are released. Rows are claimed with SKIP
+LOCKED, so several purgers can run at once without waiting on each other.
+change_xid is archived with the row, which lets the library sync keep
+reporting the deletion to clients that have not synced since.
+
+Chunked uploads that expired while still pending are removed in the same
+run, together with the parts they staged in the blob store, and so are blob
+files older than BLOB_SWEEP_GRACE seconds that have no blobs row.
+'''
+import os
+import time
+from typing import Dict, List, Tuple
+from blob_store import get_blob_store, collect_blob, sweep_orphans
+
+FILES_PURGE_AFTER_DAYS = int(os.environ.get('FILES_PURGE_AFTER_DAYS', '7'))
+FILES_PURGE_BATCH_SIZE = int(os.environ.get('FILES_PURGE_BATCH_SIZE', '500'))
+FILES_PURGE_PAUSE = float(os.environ.get('FILES_PURGE_PAUSE', '0.1'))
+BLOB_SWEEP_GRACE = float(os.environ.get('BLOB_SWEEP_GRACE', '3600'))
+
+FILE_COLUMNS = 'id, user_id, name, size, type, storage_key, created_at, content_hash, deleted_at, updated_at, change_xid'
+
+
+def purge_batch(conn, batch_size: int, after_days: int) -> Tuple[int, List[str]]:
+    '''
+    Archives one batch; returns the number of rows moved and the digests
+    whose references were released.
+    '''
+    cursor = conn.cursor()
+    cursor.execute(
+        f'''WITH doomed AS (
+                SELECT id FROM files
+                WHERE type = 'deleted' AND deleted_at < NOW() - make_interval(days => %s)
+                ORDER BY deleted_at, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ), moved AS (
+                DELETE FROM files f USING doomed WHERE f.id = doomed.id
+                RETURNING f.*
+            ), archived AS (
+                INSERT INTO files_archive ({FILE_COLUMNS})
+                SELECT {FILE_COLUMNS} FROM moved
+            )
+            SELECT content_hash, COUNT(*) FROM moved GROUP BY content_hash ORDER BY content_hash''',
+        (after_days, batch_size)
+    )
+    groups = cursor.fetchall()
+    moved = sum(row[1] for row in groups)
+    released = [row for row in groups if row[0] is not None]
+    if released:
+        digests = [row[0] for row in released]
+        # Blob rows are locked in digest order so that concurrent purgers
+        # cannot deadlock on each other.
+        cursor.execute("SELECT hash FROM blobs WHERE hash = ANY(%s) ORDER BY hash FOR UPDATE", (digests,))
+        cursor.execute(
+            '''UPDATE blobs SET ref_count = ref_count - r.refs
+               FROM unnest(%s::char(64)[], %s::integer[]) AS r(hash, refs)
+               WHERE blobs.hash = r.hash''',
+            (digests, [row[1] for row in released])
+        )
+    conn.commit()
+    cursor.close()
+    return moved, [row[0] for row in released]
+
+
+def purge_expired_uploads(conn, store, batch_size: int) -> int:
+    '''
+    Deletes one batch of expired pending uploads and their staged parts;
+    returns the number of uploads removed. Reservations are left to
+    reconcile_storage, which already ignores expired uploads.
+    '''
+    cursor = conn.cursor()
+    cursor.execute(
+        '''WITH doomed AS (
+               SELECT id FROM uploads
+               WHERE status = 'pending' AND expires_at < NOW()
+               ORDER BY expires_at, id
+               LIMIT %s
+               FOR UPDATE SKIP LOCKED
+           ), chunks AS (
+               DELETE FROM upload_chunks c USING doomed WHERE c.upload_id = doomed.id
+           )
+           DELETE FROM uploads u USING doomed WHERE u.id = doomed.id RETURNING u.id''',
+        (batch_size,)
+    )
+    upload_ids = [row[0] for row in cursor.fetchall()]
+    # Parts go before the commit: if it fails, the rows come back and the
+    # next run deletes them again, so no directory outlives its row.
+    for upload_id in upload_ids:
+        store.discard_upload(upload_id)
+    conn.commit()
+    cursor.close()
+    return len(upload_ids)
+
+
+def purge_files(conn, batch_size: int = FILES_PURGE_BATCH_SIZE, after_days: int = FILES_PURGE_AFTER_DAYS) -> Dict[str, int]:
+    store = get_blob_store()
+    archived = collected = 0
+    while True:
+        moved, digests = purge_batch(conn, batch_size, after_days)
+        archived += moved
+        for digest in digests:
+            if collect_blob(conn, store, digest):
+                collected += 1
+        if moved < batch_size:
+            break
+        time.sleep(FILES_PURGE_PAUSE)
+    uploads_expired = 0
+    while True:
+        removed = purge_expired_uploads(conn, store, batch_size)
+        uploads_expired += removed
+        if removed < batch_size:
+            break
+        time.sleep(FILES_PURGE_PAUSE)
+    orphans = sweep_orphans(conn, store, BLOB_SWEEP_GRACE, batch_size)
+    return {'archived': archived, 'blobs_collected': collected, 'uploads_expired': uploads_expired,
+            'orphans_removed': orphans}
+
+
+if __name__ == '__main__':
+    from db_pool import get_pool
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        print(f'[file_purge] {purge_files(conn)}')
+    finally:
+        pool.putconn(conn)
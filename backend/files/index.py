@@ -1,13 +1,43 @@
 import json
 import os
 import base64
-from typing import Dict, Any
-import psycopg2
+import binascii
+from typing import Dict, Any, Optional
+from urllib.parse import quote
 from psycopg2.extras import RealDictCursor
+from db_pool import get_pool, report_query_count, execute_prepared
+from session_cache import get_session_token, resolve_user_id
+from session_touch import flush_session_touches
+from pagination import parse_page_params, fetch_page, stream_json_array
+from collection_versions import get_version, bump_version, make_etag, etag_matches
+from response_cache import response_cache, cache_key
+from responses import CORS_HEADERS, JSON_HEADERS, dumps, preflight_headers
+from blob_store import get_blob_store, content_digest, acquire_blob
+from byte_ranges import RangeNotSatisfiable, parse_range_header, clamp_to_budget, multipart_byteranges
+from previews import enqueue_preview
+from storage_quota import charge_storage, get_usage
+from chunked_uploads import init_upload, put_chunk, upload_status, complete_upload, validate_file_type, FILE_TYPE_PATTERN
 
+MAX_DOWNLOAD_BYTES = int(os.environ.get('MAX_DOWNLOAD_BYTES', str(4 * 1024 * 1024)))
+# Types a browser may render as they are; anything else, HTML and SVG
+# included, is sent as application/octet-stream.
+SAFE_CONTENT_TYPES = frozenset({
+    'image/png', 'image/jpeg', 'image/gif', 'image/webp', 'image/avif',
+    'audio/mpeg', 'audio/ogg', 'audio/wav', 'video/mp4', 'video/webm', 'text/plain'
+})
+
+FILES_LIST_QUERY = """SELECT id, name, size, type, created_at,
+                             (SELECT json_build_object('width', p.width, 'height', p.height, 'size', p.size,
+                                                       'url', '/api/files?id=' || files.id || '&preview=1')
+                              FROM previews p WHERE p.source_hash = files.content_hash) AS preview
+                      FROM files WHERE user_id = %s AND type <> 'deleted'"""
+
+PREFLIGHT_HEADERS = preflight_headers('GET, POST, DELETE, OPTIONS', 'Content-Type, X-Session-Token, If-None-Match, Range, If-Range')
+
+@report_query_count
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
-    Business: File manager API with upload, download, list, delete
+    Business: File manager API with upload, resumable chunked upload, download, list, delete
     Args: event with httpMethod, body, headers
     Returns: HTTP response with files data
     '''
@@ -16,38 +46,53 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
-                'Access-Control-Max-Age': '86400'
-            },
+            'headers': dict(PREFLIGHT_HEADERS),
             'body': '',
             'isBase64Encoded': False
         }
     
-    db_url = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(db_url)
+    pool = get_pool()
+    conn = pool.getconn()
     
     try:
         user_id = get_user_from_session(conn, event.get('headers', {}))
         if not user_id:
             return {
                 'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Unauthorized'}),
+                'headers': dict(JSON_HEADERS),
+                'body': dumps({'error': 'Unauthorized'}),
                 'isBase64Encoded': False
             }
         
         if method == 'GET':
             query_params = event.get('queryStringParameters', {}) or {}
             file_id = query_params.get('id')
+            if query_params.get('usage') in ('1', 'true'):
+                return {
+                    'statusCode': 200,
+                    'headers': dict(JSON_HEADERS),
+                    'body': dumps({'usage': get_usage(conn, user_id)}),
+                    'isBase64Encoded': False
+                }
             if file_id:
-                return download_file(conn, user_id, file_id)
-            return list_files(conn, user_id)
+                if query_params.get('preview') in ('1', 'true'):
+                    return download_preview(conn, user_id, file_id, event.get('headers', {}))
+                raw = query_params.get('raw') in ('1', 'true')
+                return download_file(conn, user_id, file_id, raw, event.get('headers', {}))
+            return list_files(conn, user_id, query_params, event.get('headers', {}))
         
         elif method == 'POST':
             body_data = json.loads(event.get('body', '{}'))
+            action = body_data.get('action', 'upload')
+            
+            if action == 'upload_init':
+                return init_upload(conn, user_id, body_data)
+            elif action == 'upload_chunk':
+                return put_chunk(conn, user_id, body_data)
+            elif action == 'upload_status':
+                return upload_status(conn, user_id, body_data)
+            elif action == 'upload_complete':
+                return complete_upload(conn, user_id, body_data)
             return upload_file(conn, user_id, body_data)
         
         elif method == 'DELETE':
@@ -56,44 +101,65 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         return {
             'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Method not allowed'}),
             'isBase64Encoded': False
         }
     
     finally:
-        conn.close()
+        pool.putconn(conn)
+        flush_session_touches()
 
 def get_user_from_session(conn, headers: Dict[str, str]) -> int:
-    session_token = headers.get('x-session-token') or headers.get('X-Session-Token')
-    if not session_token:
-        return None
-    
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        "SELECT user_id FROM sessions WHERE session_token = %s AND expires_at > NOW()",
-        (session_token,)
-    )
-    result = cursor.fetchone()
-    cursor.close()
-    return result['user_id'] if result else None
+    return resolve_user_id(conn, get_session_token(headers))
 
-def list_files(conn, user_id: int) -> Dict[str, Any]:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        "SELECT id, name, size, type, created_at FROM files WHERE user_id = %s ORDER BY created_at DESC",
-        (user_id,)
-    )
-    files = cursor.fetchall()
-    cursor.close()
+def list_files(conn, user_id: int, query_params: Dict[str, str], headers: Dict[str, str]) -> Dict[str, Any]:
+    # The version is read before the rows, so a concurrent write can only
+    # pair an older ETag with newer data, never the other way round.
+    version = get_version(conn, user_id, 'files')
+    etag = make_etag('files', user_id, version, query_params)
+    if etag_matches(headers, etag):
+        return {
+            'statusCode': 304,
+            'headers': {**CORS_HEADERS, 'ETag': etag, 'Access-Control-Expose-Headers': 'ETag'},
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    key = cache_key(user_id, 'files', query_params)
+    body = response_cache.get(key, version)
+    if body is None:
+        try:
+            body = render_files(conn, user_id, query_params)
+        except ValueError as e:
+            return {
+                'statusCode': 400,
+                'headers': dict(JSON_HEADERS),
+                'body': dumps({'error': str(e)}),
+                'isBase64Encoded': False
+            }
+        response_cache.put(key, version, body)
     
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'files': [dict(f) for f in files]}, default=str),
+        'headers': {**JSON_HEADERS, 'ETag': etag, 'Access-Control-Expose-Headers': 'ETag'},
+        'body': body,
         'isBase64Encoded': False
     }
 
+def render_files(conn, user_id: int, query_params: Dict[str, str]) -> str:
+    query = FILES_LIST_QUERY
+    
+    if query_params.get('stream') in ('1', 'true'):
+        return '{"files": ' + stream_json_array(conn, 'files', query, (user_id,), 'created_at') + '}'
+    
+    limit, after = parse_page_params(query_params)
+    files, next_cursor = fetch_page(conn, query, (user_id,), 'created_at', limit, after)
+    response_body = {'files': files}
+    if limit is not None:
+        response_body['next_cursor'] = next_cursor
+    return dumps(response_body)
+
 def upload_file(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
     name = body_data.get('name')
     size = body_data.get('size')
@@ -103,33 +169,86 @@ def upload_file(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]
     if not name or size is None:
         return {
             'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'File name and size required'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'File name and size required'}),
             'isBase64Encoded': False
         }
     
+    error = validate_file_type(file_type)
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': error}),
+            'isBase64Encoded': False
+        }
+    
+    data = None
+    digest = None
     storage_key = f"user_{user_id}/{name}"
     
+    if content:
+        try:
+            data = base64.b64decode(content, validate=True)
+        except (binascii.Error, ValueError):
+            return {
+                'statusCode': 400,
+                'headers': dict(JSON_HEADERS),
+                'body': dumps({'error': 'File content must be base64'}),
+                'isBase64Encoded': False
+            }
+        size = len(data)
+    elif not isinstance(size, int) or size < 0:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'File size must be a non-negative integer'}),
+            'isBase64Encoded': False
+        }
+    
     cursor = conn.cursor(cursor_factory=RealDictCursor)
+    if not charge_storage(cursor, user_id, size):
+        conn.rollback()
+        cursor.close()
+        return quota_exceeded(conn, user_id)
+    
+    if data is not None:
+        store = get_blob_store()
+        digest = content_digest(data)
+        storage_key = store.key_for(digest)
+        acquire_blob(cursor, store, digest, data)
+        enqueue_preview(cursor, digest, file_type)
+    
     cursor.execute(
-        "INSERT INTO files (user_id, name, size, type, storage_key) VALUES (%s, %s, %s, %s, %s) RETURNING id, name, size, type, created_at",
-        (user_id, name, size, file_type, storage_key)
+        "INSERT INTO files (user_id, name, size, type, storage_key, content_hash) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id, name, size, type, created_at",
+        (user_id, name, size, file_type, storage_key, digest)
     )
     file_record = cursor.fetchone()
+    bump_version(cursor, user_id, 'files')
     conn.commit()
     cursor.close()
+    response_cache.invalidate(user_id, 'files')
     
     return {
         'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'file': dict(file_record)}, default=str),
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'file': dict(file_record)}),
+        'isBase64Encoded': False
+    }
+
+def quota_exceeded(conn, user_id: int) -> Dict[str, Any]:
+    return {
+        'statusCode': 413,
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'error': 'Storage quota exceeded', 'usage': get_usage(conn, user_id)}),
         'isBase64Encoded': False
     }
 
-def download_file(conn, user_id: int, file_id: str) -> Dict[str, Any]:
+def download_file(conn, user_id: int, file_id: str, raw: bool, headers: Dict[str, str]) -> Dict[str, Any]:
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        "SELECT id, name, size, type, storage_key FROM files WHERE id = %s AND user_id = %s",
+    execute_prepared(
+        cursor,
+        "SELECT id, name, size, type, storage_key, content_hash FROM files WHERE id = %s AND user_id = %s AND type <> 'deleted'",
         (file_id, user_id)
     )
     file_record = cursor.fetchone()
@@ -138,57 +257,172 @@ def download_file(conn, user_id: int, file_id: str) -> Dict[str, Any]:
     if not file_record:
         return {
             'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'File not found'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'File not found'}),
             'isBase64Encoded': False
         }
     
+    if raw and file_record['content_hash']:
+        return serve_blob(file_record, headers)
+    
+    file_data = dict(file_record)
+    del file_data['content_hash']
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({
-            'file': dict(file_record),
-            'downloadUrl': f"/api/files?id={file_id}"
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({
+            'file': file_data,
+            'downloadUrl': f"/api/files?id={file_id}&raw=1"
         }),
         'isBase64Encoded': False
     }
 
+def download_preview(conn, user_id: int, file_id: str, headers: Dict[str, str]) -> Dict[str, Any]:
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(
+        """SELECT f.name, p.preview_hash AS content_hash, p.size, 'image/jpeg' AS type
+           FROM files f JOIN previews p ON p.source_hash = f.content_hash
+           WHERE f.id = %s AND f.user_id = %s AND f.type <> 'deleted'""",
+        (file_id, user_id)
+    )
+    preview_record = cursor.fetchone()
+    cursor.close()
+    
+    if not preview_record:
+        return {
+            'statusCode': 404,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Preview not found'}),
+            'isBase64Encoded': False
+        }
+    
+    preview_record['name'] = os.path.splitext(preview_record['name'])[0] + '-preview.jpg'
+    return serve_blob(preview_record, headers)
+
+def safe_content_type(file_type: Optional[str]) -> str:
+    # Rows written before type was validated are checked again here.
+    if not file_type or not FILE_TYPE_PATTERN.fullmatch(file_type):
+        return 'application/octet-stream'
+    file_type = file_type.lower()
+    return file_type if file_type in SAFE_CONTENT_TYPES else 'application/octet-stream'
+
+def serve_blob(file_record: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+    digest = file_record['content_hash']
+    size = file_record['size']
+    etag = f'"{digest}"'
+    content_type = safe_content_type(file_record['type'])
+    response_headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(file_record['name'])}",
+        'X-Content-Type-Options': 'nosniff',
+        **CORS_HEADERS,
+        'Access-Control-Expose-Headers': 'Accept-Ranges, Content-Range, ETag'
+    }
+    
+    range_header = headers.get('range') or headers.get('Range')
+    if_range = headers.get('if-range') or headers.get('If-Range')
+    if if_range and if_range.strip() != etag:
+        range_header = None
+    
+    try:
+        ranges = parse_range_header(range_header, size)
+    except RangeNotSatisfiable:
+        return {
+            'statusCode': 416,
+            'headers': {**response_headers, 'Content-Range': f'bytes */{size}'},
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    store = get_blob_store()
+    
+    if ranges is None:
+        if size > MAX_DOWNLOAD_BYTES:
+            return {
+                'statusCode': 413,
+                'headers': {**response_headers, 'Content-Type': 'application/json'},
+                'body': dumps({'error': 'File too large for a single response, use Range requests', 'size': size}),
+                'isBase64Encoded': False
+            }
+        data = store.read_ranges(digest, [(0, size - 1)])[0] if size else b''
+        return {
+            'statusCode': 200,
+            'headers': {**response_headers, 'Content-Type': content_type},
+            'body': base64.b64encode(data).decode('ascii'),
+            'isBase64Encoded': True
+        }
+    
+    ranges = clamp_to_budget(ranges, MAX_DOWNLOAD_BYTES)
+    slices = store.read_ranges(digest, ranges)
+    
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        body = slices[0]
+        response_headers['Content-Type'] = content_type
+        response_headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    else:
+        body, response_headers['Content-Type'] = multipart_byteranges(list(zip(ranges, slices)), size, content_type)
+    
+    return {
+        'statusCode': 206,
+        'headers': response_headers,
+        'body': base64.b64encode(body).decode('ascii'),
+        'isBase64Encoded': True
+    }
+
 def delete_file(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
     file_id = body_data.get('id')
     if not file_id:
         return {
             'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'File ID required'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'File ID required'}),
             'isBase64Encoded': False
         }
     
+    # Tombstoning, the quota credit and the version bump happen in one
+    # statement; the credit and bump only apply when this call is the one
+    # that moved the row from live to deleted.
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     cursor.execute(
-        "SELECT storage_key FROM files WHERE id = %s AND user_id = %s",
-        (file_id, user_id)
+        """WITH target AS (
+               UPDATE files SET type = 'deleted', deleted_at = NOW()
+               WHERE id = %s AND user_id = %s AND type <> 'deleted'
+               RETURNING size
+           ), credited AS (
+               UPDATE user_storage
+               SET used_bytes = GREATEST(used_bytes - target.size, 0), file_count = GREATEST(file_count - 1, 0),
+                   updated_at = NOW()
+               FROM target WHERE user_storage.user_id = %s
+           ), bumped AS (
+               INSERT INTO collection_versions (user_id, collection, version)
+               SELECT %s, 'files', 1 FROM target
+               ON CONFLICT (user_id, collection) DO UPDATE SET version = collection_versions.version + 1
+           )
+           SELECT (SELECT COUNT(*) FROM target) AS deleted,
+                  EXISTS (SELECT 1 FROM files WHERE id = %s AND user_id = %s) AS found""",
+        (file_id, user_id, user_id, user_id, file_id, user_id)
     )
-    file_record = cursor.fetchone()
+    result = cursor.fetchone()
     
-    if not file_record:
+    if not result['deleted'] and not result['found']:
+        conn.rollback()
         cursor.close()
         return {
             'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'File not found'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'File not found'}),
             'isBase64Encoded': False
         }
     
-    cursor.execute(
-        "UPDATE files SET type = 'deleted' WHERE id = %s AND user_id = %s",
-        (file_id, user_id)
-    )
     conn.commit()
     cursor.close()
+    response_cache.invalidate(user_id, 'files')
     
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'message': 'File deleted'}),
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'message': 'File deleted'}),
         'isBase64Encoded': False
     }
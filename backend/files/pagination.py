@@ -0,0 +1,109 @@
+'''
+Keyset pagination over (sort timestamp, id) with opaque continuation tokens,
+plus a streaming mode that reads through a named server-side cursor.
+
+The sort column must be NOT NULL (V0014 enforces it for games.updated_at
+and the created_at of platforms and files): a NULL would have no place in
+the (sort, id) order and could not be written into a cursor.
+'''
+import base64
+import io
+import json
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+from db_pool import execute_prepared
+from responses import column_names, dumps, fetch_records, records
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+
+
+def encode_cursor(sort_value: datetime, row_id: int) -> str:
+    raw = json.dumps([sort_value.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode_cursor(token: str) -> Tuple[str, int]:
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        sort_value, row_id = json.loads(raw)
+        datetime.fromisoformat(sort_value)
+        return sort_value, int(row_id)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid pagination cursor')
+
+
+def parse_page_params(query_params: Dict[str, str]) -> Tuple[Optional[int], Optional[Tuple[str, int]]]:
+    '''
+    Returns (limit, after); limit is None when the client asked for neither
+    a page size nor a continuation token, which keeps the full-list response.
+    '''
+    limit = query_params.get('limit')
+    after = query_params.get('after')
+    if limit is None and not after:
+        return None, None
+    try:
+        limit = int(limit) if limit is not None else DEFAULT_PAGE_SIZE
+    except ValueError:
+        raise ValueError('Invalid limit')
+    if limit < 1:
+        raise ValueError('Invalid limit')
+    return min(limit, MAX_PAGE_SIZE), decode_cursor(after) if after else None
+
+
+def page_query(query: str, params: Tuple, sort_column: str,
+               limit: Optional[int], after: Optional[Tuple[str, int]]) -> Tuple[str, List[Any]]:
+    '''
+    The statement and arguments fetch_page runs; one row past the limit is
+    read to tell whether another page follows.
+    '''
+    args = list(params)
+    if after:
+        query += f" AND ({sort_column}, id) < (%s::timestamp, %s)"
+        args.extend(after)
+    query += f" ORDER BY {sort_column} DESC, id DESC"
+    if limit is not None:
+        query += " LIMIT %s"
+        args.append(limit + 1)
+    return query, args
+
+
+def fetch_page(conn, query: str, params: Tuple, sort_column: str,
+               limit: Optional[int], after: Optional[Tuple[str, int]]) -> Tuple[List[Any], Optional[str]]:
+    query, args = page_query(query, params, sort_column, limit, after)
+    cursor = conn.cursor()
+    execute_prepared(cursor, query, args)
+    rows = fetch_records(cursor)
+    cursor.close()
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][sort_column], rows[-1]['id'])
+    return rows, next_cursor
+
+
+def stream_json_array(conn, name: str, query: str, params: Tuple, sort_column: str) -> str:
+    '''
+    Serializes every matching row into a JSON array while holding at most
+    STREAM_BATCH_SIZE rows in memory at a time.
+    '''
+    cursor = conn.cursor(name=f'stream_{name}')
+    cursor.execute(f"{query} ORDER BY {sort_column} DESC, id DESC", params)
+
+    out = io.StringIO()
+    out.write('[')
+    columns = None
+    while True:
+        rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+        if not rows:
+            break
+        if columns is None:
+            columns = column_names(cursor)
+        else:
+            out.write(',')
+        out.write(dumps(records(columns, rows))[1:-1])
+    out.write(']')
+    cursor.close()
+    return out.getvalue()
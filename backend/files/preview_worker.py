@@ -0,0 +1,241 @@
+'''
+Preview worker: drains preview_jobs into thumbnails stored in the blob store.
+
+    python preview_worker.py [processes]
+
+Each process claims batches with FOR UPDATE SKIP LOCKED, so any number of
+processes on any number of hosts can share the queue. A job that fails is
+retried with exponential backoff up to PREVIEW_MAX_ATTEMPTS times; a job
+whose worker died is reclaimed once it has been locked longer than
+PREVIEW_LOCK_TIMEOUT seconds. Rendering twice is harmless because previews
+are keyed by the source digest. Per-worker counters are kept in
+preview_workers.
+'''
+import multiprocessing
+import os
+import socket
+import sys
+import time
+from typing import Dict, List, Tuple
+from blob_store import get_blob_store, content_digest, acquire_blob, release_blob
+from collection_versions import bump_versions
+from db_pool import get_pool
+from previews import Image, render_thumbnail
+
+PREVIEW_WORKERS = int(os.environ.get('PREVIEW_WORKERS', str(os.cpu_count() or 1)))
+PREVIEW_BATCH_SIZE = int(os.environ.get('PREVIEW_BATCH_SIZE', '8'))
+PREVIEW_MAX_ATTEMPTS = int(os.environ.get('PREVIEW_MAX_ATTEMPTS', '5'))
+PREVIEW_RETRY_DELAY = float(os.environ.get('PREVIEW_RETRY_DELAY', '30'))
+PREVIEW_LOCK_TIMEOUT = float(os.environ.get('PREVIEW_LOCK_TIMEOUT', '300'))
+PREVIEW_POLL_INTERVAL = float(os.environ.get('PREVIEW_POLL_INTERVAL', '5'))
+PREVIEW_MAX_SOURCE_BYTES = int(os.environ.get('PREVIEW_MAX_SOURCE_BYTES', str(50 * 1024 * 1024)))
+
+Job = Tuple[int, str, int]
+
+
+class PermanentFailure(Exception):
+    pass
+
+
+class WorkerStats:
+    FIELDS = ('jobs_done', 'jobs_failed', 'jobs_retried', 'bytes_in', 'bytes_out', 'busy_seconds')
+
+    def __init__(self, worker_id: str):
+        self.worker_id = worker_id
+        self.totals: Dict[str, float] = {field: 0 for field in self.FIELDS}
+        self.unsaved: Dict[str, float] = {field: 0 for field in self.FIELDS}
+
+    def add(self, field: str, amount: float = 1) -> None:
+        self.totals[field] += amount
+        self.unsaved[field] += amount
+
+    def save(self, conn) -> None:
+        cursor = conn.cursor()
+        cursor.execute(
+            '''INSERT INTO preview_workers (worker_id, jobs_done, jobs_failed, jobs_retried, bytes_in, bytes_out, busy_seconds)
+               VALUES (%(worker_id)s, %(jobs_done)s, %(jobs_failed)s, %(jobs_retried)s, %(bytes_in)s, %(bytes_out)s, %(busy_seconds)s)
+               ON CONFLICT (worker_id) DO UPDATE SET
+                   jobs_done = preview_workers.jobs_done + EXCLUDED.jobs_done,
+                   jobs_failed = preview_workers.jobs_failed + EXCLUDED.jobs_failed,
+                   jobs_retried = preview_workers.jobs_retried + EXCLUDED.jobs_retried,
+                   bytes_in = preview_workers.bytes_in + EXCLUDED.bytes_in,
+                   bytes_out = preview_workers.bytes_out + EXCLUDED.bytes_out,
+                   busy_seconds = preview_workers.busy_seconds + EXCLUDED.busy_seconds,
+                   updated_at = NOW()''',
+            {'worker_id': self.worker_id, **self.unsaved}
+        )
+        conn.commit()
+        cursor.close()
+        self.unsaved = {field: 0 for field in self.FIELDS}
+
+    def summary(self) -> str:
+        busy = self.totals['busy_seconds']
+        rate = self.totals['jobs_done'] / busy if busy else 0.0
+        return (f"done={int(self.totals['jobs_done'])} failed={int(self.totals['jobs_failed'])} "
+                f"retried={int(self.totals['jobs_retried'])} in={int(self.totals['bytes_in'])}B "
+                f"out={int(self.totals['bytes_out'])}B rate={rate:.1f} jobs/s")
+
+
+def claim_jobs(conn, worker_id: str, batch_size: int) -> List[Job]:
+    cursor = conn.cursor()
+    cursor.execute(
+        '''UPDATE preview_jobs SET status = 'running', attempts = attempts + 1,
+                  locked_by = %s, locked_at = NOW(), updated_at = NOW()
+           WHERE id IN (
+               SELECT id FROM preview_jobs
+               WHERE (status = 'pending' AND run_after <= NOW())
+                  OR (status = 'running' AND locked_at < NOW() - make_interval(secs => %s))
+               ORDER BY id
+               FOR UPDATE SKIP LOCKED
+               LIMIT %s
+           )
+           RETURNING id, source_hash, attempts''',
+        (worker_id, PREVIEW_LOCK_TIMEOUT, batch_size)
+    )
+    jobs = cursor.fetchall()
+    conn.commit()
+    cursor.close()
+    return jobs
+
+
+def finish_job(cursor, job_id: int, worker_id: str, status: str) -> None:
+    cursor.execute(
+        '''UPDATE preview_jobs SET status = %s, last_error = NULL, locked_by = NULL, locked_at = NULL, updated_at = NOW()
+           WHERE id = %s AND locked_by = %s''',
+        (status, job_id, worker_id)
+    )
+
+
+def fail_job(conn, job: Job, worker_id: str, error: Exception, stats: WorkerStats) -> None:
+    job_id, _, attempts = job
+    permanent = isinstance(error, PermanentFailure) or attempts >= PREVIEW_MAX_ATTEMPTS
+    cursor = conn.cursor()
+    cursor.execute(
+        '''UPDATE preview_jobs SET status = %s, last_error = %s, locked_by = NULL, locked_at = NULL,
+                  run_after = NOW() + make_interval(secs => %s), updated_at = NOW()
+           WHERE id = %s AND locked_by = %s''',
+        ('failed' if permanent else 'pending', str(error)[:1000],
+         PREVIEW_RETRY_DELAY * 2 ** (attempts - 1), job_id, worker_id)
+    )
+    conn.commit()
+    cursor.close()
+    stats.add('jobs_failed' if permanent else 'jobs_retried')
+
+
+def process_job(conn, store, job: Job, worker_id: str, stats: WorkerStats) -> None:
+    job_id, source_hash, _ = job
+    cursor = conn.cursor()
+    cursor.execute(
+        '''SELECT b.size, p.source_hash IS NOT NULL FROM blobs b
+           LEFT JOIN previews p ON p.source_hash = b.hash
+           WHERE b.hash = %s AND b.ref_count > 0''',
+        (source_hash,)
+    )
+    source = cursor.fetchone()
+    conn.commit()
+    if not source or source[1]:
+        finish_job(cursor, job_id, worker_id, 'done' if source else 'skipped')
+        conn.commit()
+        cursor.close()
+        return
+    if source[0] > PREVIEW_MAX_SOURCE_BYTES:
+        cursor.close()
+        raise PermanentFailure(f'Source is larger than {PREVIEW_MAX_SOURCE_BYTES} bytes')
+
+    data = store.get(source_hash)
+    try:
+        thumbnail, width, height = render_thumbnail(data)
+    except (OSError, ValueError) as e:
+        cursor.close()
+        raise PermanentFailure(f'Cannot decode image: {e}')
+    preview_hash = content_digest(thumbnail)
+
+    # The share lock keeps collect_blob from removing the source while its
+    # preview is attached; if the source is already gone there is nothing to do.
+    cursor.execute("SELECT 1 FROM blobs WHERE hash = %s AND ref_count > 0 FOR SHARE", (source_hash,))
+    if cursor.fetchone() is None:
+        finish_job(cursor, job_id, worker_id, 'skipped')
+        conn.commit()
+        cursor.close()
+        return
+
+    acquire_blob(cursor, store, preview_hash, thumbnail)
+    cursor.execute(
+        '''INSERT INTO previews (source_hash, preview_hash, width, height, size) VALUES (%s, %s, %s, %s, %s)
+           ON CONFLICT (source_hash) DO NOTHING RETURNING source_hash''',
+        (source_hash, preview_hash, width, height, len(thumbnail))
+    )
+    if cursor.fetchone() is None:
+        release_blob(cursor, preview_hash)
+    else:
+        cursor.execute(
+            "SELECT DISTINCT user_id FROM files WHERE content_hash = %s AND type <> 'deleted'",
+            (source_hash,)
+        )
+        user_ids = [row[0] for row in cursor.fetchall()]
+        if user_ids:
+            bump_versions(cursor, user_ids, 'files')
+    finish_job(cursor, job_id, worker_id, 'done')
+    conn.commit()
+    cursor.close()
+    stats.add('bytes_in', len(data))
+    stats.add('bytes_out', len(thumbnail))
+
+
+def run_once(conn, worker_id: str, stats: WorkerStats) -> int:
+    store = get_blob_store()
+    jobs = claim_jobs(conn, worker_id, PREVIEW_BATCH_SIZE)
+    for job in jobs:
+        started = time.monotonic()
+        try:
+            process_job(conn, store, job, worker_id, stats)
+            stats.add('jobs_done')
+        except Exception as e:
+            conn.rollback()
+            print(f'[preview_worker {worker_id}] job {job[0]} failed: {e}')
+            fail_job(conn, job, worker_id, e, stats)
+        stats.add('busy_seconds', time.monotonic() - started)
+    if jobs:
+        stats.save(conn)
+    return len(jobs)
+
+
+def run_worker(worker_id: str) -> None:
+    pool = get_pool()
+    conn = pool.getconn()
+    stats = WorkerStats(worker_id)
+    print(f'[preview_worker {worker_id}] started')
+    try:
+        while True:
+            if run_once(conn, worker_id, stats):
+                print(f'[preview_worker {worker_id}] {stats.summary()}')
+            else:
+                time.sleep(PREVIEW_POLL_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.putconn(conn)
+        print(f'[preview_worker {worker_id}] stopped: {stats.summary()}')
+
+
+def main() -> None:
+    if Image is None:
+        sys.exit('preview_worker requires Pillow (pip install Pillow)')
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else PREVIEW_WORKERS
+    prefix = f'{socket.gethostname()}-{os.getpid()}'
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(f'{prefix}-{index}',))
+        for index in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == '__main__':
+    main()
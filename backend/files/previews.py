@@ -0,0 +1,47 @@
+'''
+Image previews. Uploads of image types enqueue a preview_jobs row keyed by
+the content digest, so identical uploads share one job and one thumbnail;
+preview_worker.py renders them into the blob store. Pillow is only needed by
+the worker, not by the API function.
+'''
+import io
+import os
+from typing import Optional, Tuple
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PREVIEW_SIZE = int(os.environ.get('PREVIEW_SIZE', '256'))
+PREVIEW_QUALITY = int(os.environ.get('PREVIEW_QUALITY', '80'))
+PREVIEW_TYPES = ('image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff')
+
+
+def is_previewable(file_type: Optional[str]) -> bool:
+    return (file_type or '').lower() in PREVIEW_TYPES
+
+
+def enqueue_preview(cursor, digest: Optional[str], file_type: Optional[str]) -> None:
+    if digest and is_previewable(file_type):
+        cursor.execute(
+            "INSERT INTO preview_jobs (source_hash) VALUES (%s) ON CONFLICT (source_hash) DO NOTHING",
+            (digest,)
+        )
+
+
+def render_thumbnail(data: bytes) -> Tuple[bytes, int, int]:
+    '''
+    Returns a JPEG no larger than PREVIEW_SIZE on either side, with its
+    width and height.
+    '''
+    if Image is None:
+        raise RuntimeError('Pillow is required to render previews')
+    with Image.open(io.BytesIO(data)) as image:
+        image.draft('RGB', (PREVIEW_SIZE, PREVIEW_SIZE))
+        image.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=PREVIEW_QUALITY, optimize=True)
+        return out.getvalue(), image.width, image.height
@@ -0,0 +1,132 @@
+'''
+Response building shared by the handlers: immutable header maps, a JSON
+encoder that uses orjson when it is installed and the stdlib otherwise,
+and rows read from plain tuple cursors turned into dicts through the
+cursor's column names rather than RealDictCursor.
+
+Both backends write the same compact JSON; datetimes keep the
+str(datetime) form ('2024-01-02 03:04:05.123456'), Decimals are sent
+as strings and non-ASCII characters as \\uXXXX escapes, as with the former
+json.dumps(..., default=str).
+
+    python responses.py [rows] [repeats]   # per-row cost of fetching and encoding a list
+'''
+import json
+import re
+from datetime import date, datetime, time
+from decimal import Decimal
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Mapping, Sequence
+from uuid import UUID
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CORS_HEADERS: Mapping[str, str] = MappingProxyType({'Access-Control-Allow-Origin': '*'})
+JSON_HEADERS: Mapping[str, str] = MappingProxyType({'Content-Type': 'application/json', **CORS_HEADERS})
+
+
+def preflight_headers(methods: str, allow_headers: str) -> Mapping[str, str]:
+    return MappingProxyType({
+        **CORS_HEADERS,
+        'Access-Control-Allow-Methods': methods,
+        'Access-Control-Allow-Headers': allow_headers,
+        'Access-Control-Max-Age': '86400'
+    })
+
+
+ENCODERS: Dict[type, Callable[[Any], Any]] = {
+    datetime: str,
+    date: str,
+    time: str,
+    Decimal: str,
+    UUID: str,
+    memoryview: lambda value: value.hex(),
+    bytes: lambda value: value.hex(),
+}
+
+
+def encode_value(value: Any) -> Any:
+    return ENCODERS.get(type(value), str)(value)
+
+
+NON_ASCII = re.compile(r'[^\x00-\x7f]')
+
+
+def _escape_char(match: 're.Match[str]') -> str:
+    code = ord(match.group(0))
+    if code < 0x10000:
+        return '\\u%04x' % code
+    code -= 0x10000
+    return '\\u%04x\\u%04x' % (0xd800 | (code >> 10), 0xdc00 | (code & 0x3ff))
+
+
+def ascii_json(text: str) -> str:
+    '''
+    Escapes non-ASCII characters the way json.dumps(ensure_ascii=True)
+    does. In JSON text they can only occur inside strings, so the result is
+    the same document.
+    '''
+    return text if text.isascii() else NON_ASCII.sub(_escape_char, text)
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(payload: Any) -> str:
+        # orjson always writes UTF-8.
+        return ascii_json(orjson.dumps(payload, default=encode_value, option=_ORJSON_OPTIONS).decode())
+else:
+    _encoder = json.JSONEncoder(default=encode_value, separators=(',', ':'))
+
+    def dumps(payload: Any) -> str:
+        return _encoder.encode(payload)
+
+
+def column_names(cursor) -> List[str]:
+    return [column[0] for column in cursor.description]
+
+
+def records(columns: Sequence[str], rows: Sequence[tuple]) -> List[Dict[str, Any]]:
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def fetch_records(cursor) -> List[Dict[str, Any]]:
+    return records(column_names(cursor), cursor.fetchall())
+
+
+if __name__ == '__main__':
+    import sys
+    import timeit
+    from psycopg2.extras import RealDictCursor
+    from db_pool import get_pool
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    query = f'''SELECT g AS id, 'game ' || g AS name, g % 100 AS hours, 'playing' AS status,
+                       NOW() - g * INTERVAL '1 minute' AS created_at, NOW() AS updated_at
+                FROM generate_series(1, {rows}) g'''
+    def realdict_path(conn):
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute(query)
+        return json.dumps({'games': [dict(row) for row in cursor.fetchall()]}, default=str)
+
+    def tuple_path(conn):
+        cursor = conn.cursor()
+        cursor.execute(query)
+        return dumps({'games': fetch_records(cursor)})
+
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        paths = {
+            'RealDictCursor + dict() + json.dumps(default=str)': realdict_path,
+            f"tuple cursor + fetch_records() + dumps() [{'orjson' if orjson else 'stdlib'}]": tuple_path,
+        }
+        for label, path in paths.items():
+            best = min(timeit.repeat(lambda: path(conn), number=1, repeat=repeats))
+            print(f'[responses] {label}: {best * 1e6 / rows:.2f} us/row ({best * 1e3:.1f} ms for {rows} rows)')
+        conn.rollback()
+    finally:
+        pool.putconn(conn)
@@ -0,0 +1,113 @@
+'''
+Stateless HMAC-signed session tokens: v1.<user_id>.<expires>.<token_id>.<signature>
+Verified without touching the sessions table; revocations are kept in
+revoked_session_tokens and mirrored into a periodically refreshed set.
+'''
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from typing import Optional, Tuple
+
+SIGNED_TOKEN_PREFIX = 'v1.'
+
+
+def signed_tokens_enabled() -> bool:
+    return os.environ.get('SESSION_TOKEN_MODE', 'opaque') == 'signed'
+
+
+def _signing_key() -> Optional[bytes]:
+    key = os.environ.get('SESSION_SIGNING_KEY')
+    return key.encode() if key else None
+
+
+def _sign(key: bytes, payload: str) -> str:
+    digest = hmac.new(key, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+
+def issue_signed_token(user_id: int, ttl_seconds: int) -> Tuple[str, str, int]:
+    key = _signing_key()
+    if not key:
+        raise RuntimeError('SESSION_SIGNING_KEY is required for signed session tokens')
+    expires = int(time.time()) + ttl_seconds
+    token_id = secrets.token_urlsafe(12)
+    payload = f'{SIGNED_TOKEN_PREFIX}{user_id}.{expires}.{token_id}'
+    return f'{payload}.{_sign(key, payload)}', token_id, expires
+
+
+def verify_signed_token(session_token: str) -> Optional[Tuple[int, str, int]]:
+    key = _signing_key()
+    if not key or not session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return None
+    payload, _, signature = session_token.rpartition('.')
+    # Compared as bytes: compare_digest rejects str holding non-ASCII
+    # characters, and a header with lone surrogates cannot be encoded at all.
+    try:
+        if not hmac.compare_digest(signature.encode(), _sign(key, payload).encode()):
+            return None
+    except UnicodeEncodeError:
+        return None
+    try:
+        user_id, expires, token_id = payload[len(SIGNED_TOKEN_PREFIX):].split('.')
+        user_id, expires = int(user_id), int(expires)
+    except ValueError:
+        return None
+    if expires <= time.time():
+        return None
+    return user_id, token_id, expires
+
+
+class RevocationSet:
+    def __init__(self, refresh_interval: float = 30.0):
+        self.refresh_interval = refresh_interval
+        self._revoked = frozenset()
+        self._loaded_at = float('-inf')
+        self._lock = threading.Lock()
+
+    def _refresh(self, conn) -> None:
+        cursor = conn.cursor()
+        cursor.execute("SELECT token_id FROM revoked_session_tokens WHERE expires_at > NOW()")
+        revoked = frozenset(row[0] for row in cursor.fetchall())
+        cursor.close()
+        with self._lock:
+            self._revoked = revoked
+            self._loaded_at = time.monotonic()
+
+    def is_revoked(self, conn, token_id: str) -> bool:
+        if time.monotonic() - self._loaded_at >= self.refresh_interval:
+            self._refresh(conn)
+        return token_id in self._revoked
+
+    def add(self, token_id: str) -> None:
+        with self._lock:
+            self._revoked = self._revoked | {token_id}
+
+
+revocations = RevocationSet(float(os.environ.get('SESSION_REVOCATION_REFRESH', '30')))
+
+
+def resolve_signed_token(conn, session_token: str) -> Optional[int]:
+    claims = verify_signed_token(session_token)
+    if claims is None or revocations.is_revoked(conn, claims[1]):
+        return None
+    return claims[0]
+
+
+def revoke_signed_token(conn, session_token: str) -> bool:
+    claims = verify_signed_token(session_token)
+    if claims is None:
+        return False
+    user_id, token_id, expires = claims
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO revoked_session_tokens (token_id, user_id, expires_at) VALUES (%s, %s, to_timestamp(%s)) ON CONFLICT (token_id) DO NOTHING",
+        (token_id, user_id, expires)
+    )
+    conn.commit()
+    cursor.close()
+    revocations.add(token_id)
+    return True
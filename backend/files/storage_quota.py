@@ -0,0 +1,141 @@
+'''
+Per-user storage accounting. user_storage holds the live bytes and file
+count of every user plus the bytes reserved by pending chunked uploads, and
+is updated in the same transaction as the files row it describes, so a
+quota check is a single-row read.
+
+Callers touch user_storage before the files/uploads rows it summarizes;
+together with the row lock taken by reconcile_storage() this keeps the
+reconciler from overwriting a concurrent change with a stale sum.
+
+    python storage_quota.py    # repair drift for every user, in batches
+'''
+import os
+from typing import Dict, Any, Optional
+from psycopg2.extras import RealDictCursor
+
+DEFAULT_QUOTA_BYTES = int(os.environ.get('STORAGE_QUOTA_BYTES', str(10 * 1024 ** 3)))
+RECONCILE_BATCH_SIZE = int(os.environ.get('STORAGE_RECONCILE_BATCH_SIZE', '1000'))
+
+
+def _charge(cursor, user_id: int, size: int, column: str, files: int) -> bool:
+    cursor.execute("INSERT INTO user_storage (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING", (user_id,))
+    # The check and the increment are one statement under the row lock, so
+    # concurrent uploads of the same user cannot overshoot the quota together.
+    cursor.execute(
+        f'''UPDATE user_storage SET {column} = {column} + %(size)s, file_count = file_count + %(files)s, updated_at = NOW()
+            WHERE user_id = %(user_id)s
+              AND used_bytes + reserved_bytes + %(size)s <= COALESCE(quota_bytes, %(default_quota)s)
+            RETURNING user_id''',
+        {'user_id': user_id, 'size': size, 'files': files, 'default_quota': DEFAULT_QUOTA_BYTES}
+    )
+    return cursor.fetchone() is not None
+
+
+def charge_storage(cursor, user_id: int, size: int) -> bool:
+    '''
+    Accounts a new file of size bytes; returns False, changing nothing, when
+    it would exceed the user's quota.
+    '''
+    return _charge(cursor, user_id, size, 'used_bytes', 1)
+
+
+def reserve_storage(cursor, user_id: int, size: int) -> bool:
+    return _charge(cursor, user_id, size, 'reserved_bytes', 0)
+
+
+def settle_reservation(cursor, user_id: int, size: int) -> None:
+    cursor.execute(
+        '''UPDATE user_storage SET reserved_bytes = GREATEST(reserved_bytes - %s, 0), used_bytes = used_bytes + %s,
+                  file_count = file_count + 1, updated_at = NOW()
+           WHERE user_id = %s''',
+        (size, size, user_id)
+    )
+
+
+def credit_storage(cursor, user_id: int, size: int) -> None:
+    cursor.execute(
+        '''UPDATE user_storage SET used_bytes = GREATEST(used_bytes - %s, 0), file_count = GREATEST(file_count - 1, 0),
+                  updated_at = NOW()
+           WHERE user_id = %s''',
+        (size, user_id)
+    )
+
+
+def get_usage(conn, user_id: int) -> Dict[str, Any]:
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute(
+        '''SELECT used_bytes, reserved_bytes, file_count, COALESCE(quota_bytes, %s) AS quota_bytes
+           FROM user_storage WHERE user_id = %s''',
+        (DEFAULT_QUOTA_BYTES, user_id)
+    )
+    usage: Optional[Dict[str, Any]] = cursor.fetchone()
+    cursor.close()
+    if usage is None:
+        return {'used_bytes': 0, 'reserved_bytes': 0, 'file_count': 0, 'quota_bytes': DEFAULT_QUOTA_BYTES}
+    return dict(usage)
+
+
+def reconcile_storage(conn, batch_size: int = RECONCILE_BATCH_SIZE) -> Dict[str, int]:
+    '''
+    Recomputes every user's counters from files and pending uploads, one
+    batch of users per transaction, and returns how many rows were repaired.
+    '''
+    checked = repaired = 0
+    last_id = 0
+    cursor = conn.cursor()
+    while True:
+        cursor.execute("SELECT id FROM users WHERE id > %s ORDER BY id LIMIT %s", (last_id, batch_size))
+        user_ids = [row[0] for row in cursor.fetchall()]
+        if not user_ids:
+            conn.commit()
+            break
+
+        cursor.execute(
+            "INSERT INTO user_storage (user_id) SELECT unnest(%s::integer[]) ON CONFLICT (user_id) DO NOTHING",
+            (user_ids,)
+        )
+        cursor.execute(
+            "SELECT user_id FROM user_storage WHERE user_id = ANY(%s) ORDER BY user_id FOR UPDATE",
+            (user_ids,)
+        )
+        # A new statement takes a new snapshot, so the sums below include
+        # every change whose transaction held these row locks before us.
+        cursor.execute(
+            '''UPDATE user_storage s SET used_bytes = a.used_bytes, reserved_bytes = a.reserved_bytes,
+                      file_count = a.file_count, updated_at = NOW()
+               FROM (
+                   SELECT u.id AS user_id,
+                          COALESCE(f.used_bytes, 0) AS used_bytes,
+                          COALESCE(f.file_count, 0) AS file_count,
+                          COALESCE(p.reserved_bytes, 0) AS reserved_bytes
+                   FROM unnest(%s::integer[]) AS u(id)
+                   LEFT JOIN (
+                       SELECT user_id, SUM(size) AS used_bytes, COUNT(*) AS file_count FROM files
+                       WHERE user_id = ANY(%s) AND type <> 'deleted' GROUP BY user_id
+                   ) f ON f.user_id = u.id
+                   LEFT JOIN (
+                       SELECT user_id, SUM(size) AS reserved_bytes FROM uploads
+                       WHERE user_id = ANY(%s) AND status = 'pending' AND expires_at > NOW() GROUP BY user_id
+                   ) p ON p.user_id = u.id
+               ) a
+               WHERE s.user_id = a.user_id
+                 AND (s.used_bytes, s.reserved_bytes, s.file_count) IS DISTINCT FROM (a.used_bytes, a.reserved_bytes, a.file_count)''',
+            (user_ids, user_ids, user_ids)
+        )
+        repaired += cursor.rowcount
+        checked += len(user_ids)
+        conn.commit()
+        last_id = user_ids[-1]
+    cursor.close()
+    return {'checked': checked, 'repaired': repaired}
+
+
+if __name__ == '__main__':
+    from db_pool import get_pool
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        print(f'[storage_quota] reconciled {reconcile_storage(conn)}')
+    finally:
+        pool.putconn(conn)
@@ -0,0 +1,290 @@
+'''
+Warm PostgreSQL connection pool kept at module scope so it survives
+between invocations of the same function instance.
+
+Fixed hot statements go through execute_prepared(): each physical
+connection PREPAREs a statement the first time it runs it (in the same
+round trip as its first EXECUTE) and only EXECUTEs it afterwards, so the
+server skips parsing and, once it settles on a generic plan, planning.
+Set DB_PREPARED_STATEMENTS=0 behind a proxy that does not keep sessions
+(transaction-mode pgbouncer).
+'''
+import functools
+import hashlib
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, Any, List, Optional, Sequence, Tuple, Union
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+
+DB_PREPARED_STATEMENTS = os.environ.get('DB_PREPARED_STATEMENTS', '1') in ('1', 'true')
+
+PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+_counting_classes: Dict[Any, Any] = {}
+
+
+def _counting(cursor_class):
+    counting = _counting_classes.get(cursor_class)
+    if counting is None:
+        def execute(self, query, vars=None):
+            self.connection.query_count += 1
+            return cursor_class.execute(self, query, vars)
+
+        def executemany(self, query, vars_list):
+            self.connection.query_count += 1
+            return cursor_class.executemany(self, query, vars_list)
+
+        counting = type(f'Counting{cursor_class.__name__}', (cursor_class,),
+                        {'execute': execute, 'executemany': executemany})
+        _counting_classes[cursor_class] = counting
+    return counting
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    '''
+    Tracks the statements prepared on this session and counts the round
+    trips made since the pool handed the connection out: every execute
+    (execute_values pages included) and every COMMIT that ends a
+    transaction. Server-side cursor fetches are not counted.
+    '''
+    query_count = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = set()
+
+    def cursor(self, *args, **kwargs):
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _counting(factory)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        if self.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            self.query_count += 1
+        return super().commit()
+
+
+class ConnectionPool:
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 5,
+                 check_after: float = 30.0, acquire_timeout: float = 5.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('Invalid pool size: min=%s max=%s' % (min_size, max_size))
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.check_after = check_after
+        self.acquire_timeout = acquire_timeout
+        self._idle: List[Any] = []
+        self._last_used: Dict[int, float] = {}
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._stats = {'hits': 0, 'misses': 0, 'replaced': 0, 'discarded': 0, 'timeouts': 0}
+        self.last_query_count = 0
+        for _ in range(min_size):
+            self._idle.append(self._connect())
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, connection_factory=PooledConnection)
+        self._last_used[id(conn)] = time.monotonic()
+        return conn
+
+    def _forget(self, conn) -> None:
+        self._last_used.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0.0) < self.check_after:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def getconn(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            while not self._idle and self._in_use >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolExhausted('No free database connections (max=%d)' % self.max_size)
+                self._cond.wait(remaining)
+            conn = self._idle.pop() if self._idle else None
+            self._in_use += 1
+
+        try:
+            if conn is not None and self._is_healthy(conn):
+                self._count('hits')
+            else:
+                if conn is not None:
+                    self._count('replaced')
+                    self._forget(conn)
+                else:
+                    self._count('misses')
+                conn = self._connect()
+            conn.query_count = 0
+            return conn
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def _count(self, key: str) -> None:
+        with self._cond:
+            self._stats[key] += 1
+
+    def putconn(self, conn) -> None:
+        self.last_query_count = getattr(conn, 'query_count', 0)
+        keep = not conn.closed
+        if keep and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                keep = False
+
+        with self._cond:
+            self._in_use -= 1
+            if keep:
+                self._last_used[id(conn)] = time.monotonic()
+                self._idle.append(conn)
+            else:
+                self._stats['discarded'] += 1
+                self._forget(conn)
+            self._cond.notify()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            lookups = self._stats['hits'] + self._stats['misses'] + self._stats['replaced']
+            return {
+                **self._stats,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'hit_ratio': self._stats['hits'] / lookups if lookups else 0.0
+            }
+
+    def close(self) -> None:
+        with self._cond:
+            while self._idle:
+                self._forget(self._idle.pop())
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    os.environ.get('DATABASE_URL'),
+                    min_size=int(os.environ.get('DB_POOL_MIN', '1')),
+                    max_size=int(os.environ.get('DB_POOL_MAX', '5')),
+                    check_after=float(os.environ.get('DB_POOL_CHECK_AFTER', '30')),
+                    acquire_timeout=float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '5'))
+                )
+    return _pool
+
+
+_statements: Dict[str, Tuple[str, str, List[str]]] = {}
+
+
+def _statement(sql: str) -> Tuple[str, str, List[str]]:
+    '''
+    Returns (name, body, param_names) for sql: the name is derived from the
+    text, so every connection agrees on it, and the body has $n parameters.
+    param_names is empty for positional %s queries.
+    '''
+    statement = _statements.get(sql)
+    if statement is None:
+        names: List[str] = []
+        positions = [0]
+
+        def number(match) -> str:
+            if match.group(0) == '%%':
+                return '%%'
+            if match.group(1):
+                if match.group(1) not in names:
+                    names.append(match.group(1))
+                return f'${names.index(match.group(1)) + 1}'
+            positions[0] += 1
+            return f'${positions[0]}'
+
+        body = PLACEHOLDER.sub(number, sql)
+        statement = (f'stmt_{hashlib.sha1(sql.encode()).hexdigest()[:16]}', body, names)
+        _statements[sql] = statement
+    return statement
+
+
+def execute_prepared(cursor, sql: str, params: Union[Sequence[Any], Dict[str, Any]] = ()) -> None:
+    '''
+    cursor.execute(sql, params), run as a named prepared statement. The
+    connection's prepared set is marked before sending because PREPARE
+    outlives a failed or rolled back transaction. If the session lost its
+    statements (a proxy ran DISCARD ALL), the error surfaces on the first
+    statement of a transaction, which is then rolled back and retried with
+    a fresh PREPARE; nothing earlier in the transaction is lost.
+    '''
+    conn = cursor.connection
+    if not DB_PREPARED_STATEMENTS or not isinstance(conn, PooledConnection):
+        cursor.execute(sql, params)
+        return
+
+    name, body, names = _statement(sql)
+    args = [params[key] for key in names] if names else list(params)
+    execute = f"EXECUTE {name} ({', '.join(['%s'] * len(args))})" if args else f'EXECUTE {name}'
+    starts_transaction = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    for attempt in range(2):
+        if name in conn.prepared_statements:
+            command = execute
+        else:
+            command = f'PREPARE {name} AS {body}; {execute}'
+            conn.prepared_statements.add(name)
+        try:
+            cursor.execute(command, args)
+            return
+        except psycopg2.errors.InvalidSqlStatementName:
+            conn.prepared_statements.clear()
+            if attempt or not starts_transaction:
+                raise
+            conn.rollback()
+
+
+def report_query_count(handler: Callable) -> Callable:
+    '''
+    With DB_QUERY_COUNT_HEADER=1, adds X-Query-Count (round trips made by
+    the invocation) to the handler's responses.
+    '''
+    if os.environ.get('DB_QUERY_COUNT_HEADER') not in ('1', 'true'):
+        return handler
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        pool = get_pool()
+        pool.last_query_count = 0
+        response = handler(event, context)
+        response.setdefault('headers', {})['X-Query-Count'] = str(pool.last_query_count)
+        return response
+    return wrapper
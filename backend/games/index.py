@@ -1,9 +1,31 @@
 import json
-import os
-from typing import Dict, Any
+import logging
+from typing import Dict, Any, List, Optional
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+from db_pool import get_pool, report_query_count, execute_prepared
+from session_cache import get_session_token, resolve_user_id
+from session_touch import flush_session_touches
+from pagination import parse_page_params, fetch_page, stream_json_array
+from collection_versions import get_version, bump_version, make_etag, etag_matches
+from response_cache import response_cache, cache_key
+from responses import CORS_HEADERS, JSON_HEADERS, dumps, preflight_headers
+from playtime import playtime, INT4_MAX
 
+BULK_MAX_ITEMS = 5000
+BULK_PAGE_SIZE = 500
+# VARCHAR limits from the schema; longer values would fail the whole statement.
+GAME_FIELD_LIMITS = {'name': 255, 'status': 20}
+
+GAMES_LIST_QUERY = "SELECT id, name, hours, status, created_at, updated_at FROM games WHERE user_id = %s"
+GAME_INSERT_QUERY = "INSERT INTO games (user_id, name, hours, status) VALUES (%s, %s, %s, %s) RETURNING id, name, hours, status, created_at"
+GAMES_BULK_INSERT_QUERY = "INSERT INTO games (user_id, name, hours, status) VALUES %s RETURNING id, name, hours, status, created_at"
+
+logger = logging.getLogger(__name__)
+
+PREFLIGHT_HEADERS = preflight_headers('GET, POST, PUT, DELETE, OPTIONS', 'Content-Type, X-Session-Token, If-None-Match')
+
+@report_query_count
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Games library CRUD API
@@ -15,78 +37,113 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
-                'Access-Control-Max-Age': '86400'
-            },
+            'headers': dict(PREFLIGHT_HEADERS),
             'body': '',
             'isBase64Encoded': False
         }
     
-    db_url = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(db_url)
+    pool = get_pool()
+    conn = pool.getconn()
     
     try:
+        flush_playtime(conn)
+        
         user_id = get_user_from_session(conn, event.get('headers', {}))
         if not user_id:
             return {
                 'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Unauthorized'}),
+                'headers': dict(JSON_HEADERS),
+                'body': dumps({'error': 'Unauthorized'}),
                 'isBase64Encoded': False
             }
         
         if method == 'GET':
-            return get_games(conn, user_id)
+            return get_games(conn, user_id, event.get('queryStringParameters') or {}, event.get('headers', {}))
         elif method == 'POST':
             body_data = json.loads(event.get('body', '{}'))
+            if 'items' in body_data:
+                return bulk_create_games(conn, user_id, body_data)
             return create_game(conn, user_id, body_data)
         elif method == 'PUT':
             body_data = json.loads(event.get('body', '{}'))
+            if 'items' in body_data:
+                return bulk_update_games(conn, user_id, body_data)
+            if 'add_hours' in body_data:
+                return add_game_hours(conn, user_id, body_data)
             return update_game(conn, user_id, body_data)
         
         return {
             'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Method not allowed'}),
             'isBase64Encoded': False
         }
     
     finally:
-        conn.close()
+        pool.putconn(conn)
+        flush_session_touches()
 
 def get_user_from_session(conn, headers: Dict[str, str]) -> int:
-    session_token = headers.get('x-session-token') or headers.get('X-Session-Token')
-    if not session_token:
-        return None
-    
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        "SELECT user_id FROM sessions WHERE session_token = %s AND expires_at > NOW()",
-        (session_token,)
-    )
-    result = cursor.fetchone()
-    cursor.close()
-    return result['user_id'] if result else None
+    return resolve_user_id(conn, get_session_token(headers))
 
-def get_games(conn, user_id: int) -> Dict[str, Any]:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        "SELECT id, name, hours, status, created_at FROM games WHERE user_id = %s ORDER BY updated_at DESC",
-        (user_id,)
-    )
-    games = cursor.fetchall()
-    cursor.close()
+def flush_playtime(conn) -> None:
+    if not playtime.due():
+        return
+    try:
+        user_ids = playtime.flush(conn)
+    except psycopg2.Error:
+        logger.warning('Playtime flush failed, deltas kept for the next flush', exc_info=True)
+        return
+    for flushed_user_id in user_ids:
+        response_cache.invalidate(flushed_user_id, 'games')
+
+def get_games(conn, user_id: int, query_params: Dict[str, str], headers: Dict[str, str]) -> Dict[str, Any]:
+    # The version is read before the rows, so a concurrent write can only
+    # pair an older ETag with newer data, never the other way round.
+    version = get_version(conn, user_id, 'games')
+    etag = make_etag('games', user_id, version, query_params)
+    if etag_matches(headers, etag):
+        return {
+            'statusCode': 304,
+            'headers': {**CORS_HEADERS, 'ETag': etag, 'Access-Control-Expose-Headers': 'ETag'},
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    key = cache_key(user_id, 'games', query_params)
+    body = response_cache.get(key, version)
+    if body is None:
+        try:
+            body = render_games(conn, user_id, query_params)
+        except ValueError as e:
+            return {
+                'statusCode': 400,
+                'headers': dict(JSON_HEADERS),
+                'body': dumps({'error': str(e)}),
+                'isBase64Encoded': False
+            }
+        response_cache.put(key, version, body)
     
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'games': [dict(g) for g in games]}, default=str),
+        'headers': {**JSON_HEADERS, 'ETag': etag, 'Access-Control-Expose-Headers': 'ETag'},
+        'body': body,
         'isBase64Encoded': False
     }
 
+def render_games(conn, user_id: int, query_params: Dict[str, str]) -> str:
+    query = GAMES_LIST_QUERY
+    
+    if query_params.get('stream') in ('1', 'true'):
+        return '{"games": ' + stream_json_array(conn, 'games', query, (user_id,), 'updated_at') + '}'
+    
+    limit, after = parse_page_params(query_params)
+    games, next_cursor = fetch_page(conn, query, (user_id,), 'updated_at', limit, after)
+    response_body = {'games': games}
+    if limit is not None:
+        response_body['next_cursor'] = next_cursor
+    return dumps(response_body)
+
 def create_game(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
     name = body_data.get('name')
     hours = body_data.get('hours', 0)
@@ -95,24 +152,36 @@ def create_game(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]
     if not name:
         return {
             'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Game name required'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Game name required'}),
+            'isBase64Encoded': False
+        }
+    
+    error = validate_game_fields(body_data)
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': error}),
             'isBase64Encoded': False
         }
     
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        "INSERT INTO games (user_id, name, hours, status) VALUES (%s, %s, %s, %s) RETURNING id, name, hours, status, created_at",
+    execute_prepared(
+        cursor,
+        GAME_INSERT_QUERY,
         (user_id, name, hours, status)
     )
     game = cursor.fetchone()
+    bump_version(cursor, user_id, 'games')
     conn.commit()
     cursor.close()
+    response_cache.invalidate(user_id, 'games')
     
     return {
         'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'game': dict(game)}, default=str),
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'game': dict(game)}),
         'isBase64Encoded': False
     }
 
@@ -121,8 +190,17 @@ def update_game(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]
     if not game_id:
         return {
             'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Game ID required'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Game ID required'}),
+            'isBase64Encoded': False
+        }
+    
+    error = validate_game_fields(body_data)
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': error}),
             'isBase64Encoded': False
         }
     
@@ -144,8 +222,8 @@ def update_game(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]
     if len(updates) <= 1:
         return {
             'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'No fields to update'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'No fields to update'}),
             'isBase64Encoded': False
         }
     
@@ -156,20 +234,250 @@ def update_game(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]
         params
     )
     game = cursor.fetchone()
+    if game:
+        bump_version(cursor, user_id, 'games')
     conn.commit()
     cursor.close()
     
     if not game:
         return {
             'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Game not found'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Game not found'}),
+            'isBase64Encoded': False
+        }
+    
+    response_cache.invalidate(user_id, 'games')
+    
+    return {
+        'statusCode': 200,
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'game': dict(game)}),
+        'isBase64Encoded': False
+    }
+
+def add_game_hours(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    game_id = body_data.get('id')
+    hours = body_data.get('add_hours')
+    if isinstance(game_id, str) and game_id.isascii() and game_id.isdigit():
+        game_id = int(game_id)
+    if not isinstance(game_id, int) or isinstance(game_id, bool) or not 0 < game_id <= INT4_MAX:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Game ID required'}),
+            'isBase64Encoded': False
+        }
+    if not isinstance(hours, int) or isinstance(hours, bool) or not 0 < hours <= INT4_MAX:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': f'add_hours must be an integer between 1 and {INT4_MAX}'}),
             'isBase64Encoded': False
         }
     
+    if body_data.get('defer'):
+        # Ownership is checked before queuing; a game deleted before the
+        # flush still loses its queued hours.
+        cursor = conn.cursor()
+        execute_prepared(cursor, "SELECT 1 FROM games WHERE id = %s AND user_id = %s", (game_id, user_id))
+        owned = cursor.fetchone() is not None
+        cursor.close()
+        if not owned:
+            return {
+                'statusCode': 404,
+                'headers': dict(JSON_HEADERS),
+                'body': dumps({'error': 'Game not found'}),
+                'isBase64Encoded': False
+            }
+        try:
+            pending = playtime.add(user_id, game_id, hours)
+        except ValueError as e:
+            return {
+                'statusCode': 400,
+                'headers': dict(JSON_HEADERS),
+                'body': dumps({'error': str(e)}),
+                'isBase64Encoded': False
+            }
+        # Flush now if this increment made one due, rather than waiting for
+        # an invocation that may never come.
+        flush_playtime(conn)
+        return {
+            'statusCode': 202,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'queued': True, 'pending_hours': pending}),
+            'isBase64Encoded': False
+        }
+    
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    execute_prepared(
+        cursor,
+        "UPDATE games SET hours = hours + %s, updated_at = NOW() WHERE id = %s AND user_id = %s RETURNING id, name, hours, status",
+        (hours, game_id, user_id)
+    )
+    game = cursor.fetchone()
+    if game:
+        bump_version(cursor, user_id, 'games')
+    conn.commit()
+    cursor.close()
+    
+    if not game:
+        return {
+            'statusCode': 404,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Game not found'}),
+            'isBase64Encoded': False
+        }
+    
+    response_cache.invalidate(user_id, 'games')
+    
+    return {
+        'statusCode': 200,
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'game': dict(game)}),
+        'isBase64Encoded': False
+    }
+
+def validate_bulk_items(body_data: Dict[str, Any]) -> Optional[str]:
+    items = body_data.get('items')
+    if not isinstance(items, list) or not items:
+        return 'Items required'
+    if len(items) > BULK_MAX_ITEMS:
+        return f'At most {BULK_MAX_ITEMS} items per request'
+    return None
+
+def validate_game_fields(item: Dict[str, Any]) -> Optional[str]:
+    if 'name' in item and (not isinstance(item['name'], str) or not item['name']):
+        return 'Invalid game name'
+    if 'hours' in item and (not isinstance(item['hours'], int) or isinstance(item['hours'], bool)):
+        return 'Invalid hours'
+    if 'hours' in item and not 0 <= item['hours'] <= INT4_MAX:
+        return f'hours must be between 0 and {INT4_MAX}'
+    if 'status' in item and not isinstance(item['status'], str):
+        return 'Invalid status'
+    for field, limit in GAME_FIELD_LIMITS.items():
+        if isinstance(item.get(field), str) and len(item[field]) > limit:
+            return f'{field} must be at most {limit} characters'
+    return None
+
+def bulk_create_games(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    error = validate_bulk_items(body_data)
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': error}),
+            'isBase64Encoded': False
+        }
+    
+    items = body_data['items']
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    indexes = []
+    values = []
+    
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get('name'):
+            results[index] = {'index': index, 'status': 'error', 'error': 'Game name required'}
+            continue
+        error = validate_game_fields(item)
+        if error:
+            results[index] = {'index': index, 'status': 'error', 'error': error}
+            continue
+        indexes.append(index)
+        values.append((user_id, item['name'], item.get('hours', 0), item.get('status', 'playing')))
+    
+    if values:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        # RETURNING yields rows in VALUES order, which maps them back to items.
+        games = execute_values(
+            cursor,
+            GAMES_BULK_INSERT_QUERY,
+            values,
+            page_size=BULK_PAGE_SIZE,
+            fetch=True
+        )
+        bump_version(cursor, user_id, 'games')
+        conn.commit()
+        cursor.close()
+        response_cache.invalidate(user_id, 'games')
+        
+        for index, game in zip(indexes, games):
+            results[index] = {'index': index, 'status': 'created', 'game': dict(game)}
+    
+    return {
+        'statusCode': 200,
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'results': results, 'created': len(values), 'failed': len(items) - len(values)}),
+        'isBase64Encoded': False
+    }
+
+def bulk_update_games(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    error = validate_bulk_items(body_data)
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': error}),
+            'isBase64Encoded': False
+        }
+    
+    items = body_data['items']
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    index_by_id: Dict[int, int] = {}
+    values = []
+    
+    for index, item in enumerate(items):
+        game_id = item.get('id') if isinstance(item, dict) else None
+        if not isinstance(game_id, int) or isinstance(game_id, bool):
+            results[index] = {'index': index, 'status': 'error', 'error': 'Game ID required'}
+            continue
+        if game_id in index_by_id:
+            results[index] = {'index': index, 'status': 'error', 'error': 'Duplicate game ID'}
+            continue
+        error = validate_game_fields(item)
+        if not error and not any(field in item for field in ('name', 'hours', 'status')):
+            error = 'No fields to update'
+        if error:
+            results[index] = {'index': index, 'status': 'error', 'error': error}
+            continue
+        index_by_id[game_id] = index
+        values.append((game_id, user_id, item.get('name'), item.get('hours'), item.get('status')))
+    
+    updated = 0
+    if values:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        games = execute_values(
+            cursor,
+            '''UPDATE games AS g SET
+                   name = COALESCE(v.name, g.name),
+                   hours = COALESCE(v.hours, g.hours),
+                   status = COALESCE(v.status, g.status),
+                   updated_at = NOW()
+               FROM (VALUES %s) AS v(id, user_id, name, hours, status)
+               WHERE g.id = v.id AND g.user_id = v.user_id
+               RETURNING g.id, g.name, g.hours, g.status''',
+            values,
+            template='(%s::integer, %s::integer, %s::varchar, %s::integer, %s::varchar)',
+            page_size=BULK_PAGE_SIZE,
+            fetch=True
+        )
+        if games:
+            bump_version(cursor, user_id, 'games')
+        conn.commit()
+        cursor.close()
+        
+        for game in games:
+            index = index_by_id.pop(game['id'])
+            results[index] = {'index': index, 'status': 'updated', 'game': dict(game)}
+        for index in index_by_id.values():
+            results[index] = {'index': index, 'status': 'not_found', 'error': 'Game not found'}
+        updated = len(games)
+        if updated:
+            response_cache.invalidate(user_id, 'games')
+    
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'game': dict(game)}),
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'results': results, 'updated': updated, 'failed': len(items) - updated}),
         'isBase64Encoded': False
     }
@@ -0,0 +1,116 @@
+'''
+Write-behind aggregation of playtime increments. Deltas for the same game
+are summed in memory and applied in one batched UPDATE once the oldest
+pending delta is PLAYTIME_FLUSH_INTERVAL seconds old or PLAYTIME_MAX_PENDING
+games are waiting. Flushes happen at the start of invocations and right after
+a deferred increment that makes a flush due, so pending deltas of an instance
+that is shut down while idle are lost.
+
+Each pending sum stays within INT4 range. A row that still overflows when
+added to the stored hours is dropped and logged on its own, so one bad game
+cannot hold back the acknowledged increments of everyone else.
+'''
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+import psycopg2
+from psycopg2.extras import execute_values
+from collection_versions import bump_versions
+
+logger = logging.getLogger(__name__)
+
+# Largest value of an INTEGER column such as games.id or games.hours.
+INT4_MAX = 2147483647
+
+UPDATE_SQL = '''UPDATE games AS g SET hours = g.hours + v.delta, updated_at = NOW()
+                FROM (VALUES %s) AS v(id, user_id, delta)
+                WHERE g.id = v.id AND g.user_id = v.user_id
+                RETURNING g.user_id'''
+ROW_TEMPLATE = '(%s::integer, %s::integer, %s::integer)'
+
+
+class PlaytimeAggregator:
+    def __init__(self, flush_interval: float = 30.0, max_pending: int = 1000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: Dict[Tuple[int, int], int] = {}
+        self._oldest: Optional[float] = None
+        self._lock = threading.Lock()
+        self._stats = {'increments': 0, 'flushes': 0, 'rows_flushed': 0, 'rows_dropped': 0}
+
+    def add(self, user_id: int, game_id: int, hours: int) -> int:
+        with self._lock:
+            key = (user_id, game_id)
+            total = self._pending.get(key, 0) + hours
+            if total > INT4_MAX:
+                raise ValueError(f'At most {INT4_MAX} pending hours per game')
+            self._pending[key] = total
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._stats['increments'] += 1
+            return self._pending[key]
+
+    def due(self) -> bool:
+        with self._lock:
+            if not self._pending:
+                return False
+            return (len(self._pending) >= self.max_pending
+                    or time.monotonic() - self._oldest >= self.flush_interval)
+
+    def flush(self, conn) -> List[int]:
+        with self._lock:
+            pending, self._pending, self._oldest = self._pending, {}, None
+        if not pending:
+            return []
+
+        rows = [(game_id, user_id, delta) for (user_id, game_id), delta in pending.items()]
+        dropped = 0
+        try:
+            cursor = conn.cursor()
+            try:
+                updated = execute_values(cursor, UPDATE_SQL, rows, template=ROW_TEMPLATE, fetch=True)
+            except psycopg2.DataError:
+                # Some sum overflowed games.hours: apply the rows one by one
+                # and drop only those that fail.
+                conn.rollback()
+                updated = []
+                for row in rows:
+                    cursor.execute('SAVEPOINT playtime_row')
+                    try:
+                        updated += execute_values(cursor, UPDATE_SQL, [row], template=ROW_TEMPLATE, fetch=True)
+                    except psycopg2.DataError:
+                        cursor.execute('ROLLBACK TO SAVEPOINT playtime_row')
+                        dropped += 1
+                        logger.error('Dropped +%sh for game %s of user %s', row[2], row[0], row[1], exc_info=True)
+                    cursor.execute('RELEASE SAVEPOINT playtime_row')
+            user_ids = sorted({row[0] for row in updated})
+            if user_ids:
+                bump_versions(cursor, user_ids, 'games')
+            conn.commit()
+            cursor.close()
+        except Exception:
+            conn.rollback()
+            with self._lock:
+                for key, delta in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + delta
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+            raise
+
+        with self._lock:
+            self._stats['flushes'] += 1
+            self._stats['rows_flushed'] += len(updated)
+            self._stats['rows_dropped'] += dropped
+        return user_ids
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, 'pending': len(self._pending)}
+
+
+playtime = PlaytimeAggregator(
+    flush_interval=float(os.environ.get('PLAYTIME_FLUSH_INTERVAL', '30')),
+    max_pending=int(os.environ.get('PLAYTIME_MAX_PENDING', '1000'))
+)
@@ -0,0 +1,134 @@
+'''
+Session token resolution with a bounded in-process TTL/LRU cache.
+Entries never outlive the session's expires_at; SESSION_CACHE_TTL bounds how
+long a revocation made by another function instance can go unnoticed.
+'''
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+from db_pool import execute_prepared
+from session_tokens import SIGNED_TOKEN_PREFIX, resolve_signed_token
+from session_touch import session_toucher
+
+
+class SessionCache:
+    def __init__(self, max_entries: int = 10000, ttl: float = 60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: 'OrderedDict[str, Tuple[int, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, session_token: str) -> Optional[int]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(session_token)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[session_token]
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(session_token)
+            self._stats['hits'] += 1
+            return entry[0]
+
+    def put(self, session_token: str, user_id: int, seconds_left: float) -> None:
+        lifetime = min(self.ttl, seconds_left)
+        if lifetime <= 0:
+            return
+        with self._lock:
+            self._entries[session_token] = (user_id, time.monotonic() + lifetime)
+            self._entries.move_to_end(session_token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, session_token: str) -> None:
+        with self._lock:
+            if self._entries.pop(session_token, None) is not None:
+                self._stats['invalidations'] += 1
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self._lock:
+            stale = [token for token, entry in self._entries.items() if entry[0] == user_id]
+            for token in stale:
+                del self._entries[token]
+            self._stats['invalidations'] += len(stale)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                'size': len(self._entries),
+                'hit_ratio': self._stats['hits'] / lookups if lookups else 0.0
+            }
+
+
+session_cache = SessionCache(
+    max_entries=int(os.environ.get('SESSION_CACHE_SIZE', '10000')),
+    ttl=float(os.environ.get('SESSION_CACHE_TTL', '60'))
+)
+
+
+def get_session_token(headers: Dict[str, str]) -> Optional[str]:
+    return headers.get('x-session-token') or headers.get('X-Session-Token')
+
+
+def peek_user_id(conn, session_token: str) -> Optional[int]:
+    '''
+    Resolves signed or cached tokens without reading the sessions table;
+    None means the caller still has to look the token up.
+    '''
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return resolve_signed_token(conn, session_token)
+    return session_cache.get(session_token)
+
+
+def remember_session(session_token: str, user_id: int, seconds_left: float) -> None:
+    session_cache.put(session_token, user_id, seconds_left)
+
+
+def resolve_user_id(conn, session_token: Optional[str]) -> Optional[int]:
+    if not session_token:
+        return None
+
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return resolve_signed_token(conn, session_token)
+
+    user_id = session_cache.get(session_token)
+    if user_id is not None:
+        record_activity(session_token)
+        return user_id
+
+    cursor = conn.cursor()
+    execute_prepared(
+        cursor,
+        "SELECT user_id, EXTRACT(EPOCH FROM (expires_at - NOW())) FROM sessions WHERE session_token = %s AND expires_at > NOW()",
+        (session_token,)
+    )
+    result = cursor.fetchone()
+    cursor.close()
+    if not result:
+        return None
+
+    session_cache.put(session_token, result[0], float(result[1]))
+    record_activity(session_token)
+    return result[0]
+
+
+def record_activity(session_token: str) -> None:
+    if session_token.startswith(SIGNED_TOKEN_PREFIX):
+        return
+    session_toucher.touch(session_token)
+
+
+def invalidate_session(session_token: str) -> None:
+    session_cache.invalidate(session_token)
+    session_toucher.forget(session_token)
+
+
+def invalidate_user_sessions(user_id: int) -> None:
+    session_cache.invalidate_user(user_id)
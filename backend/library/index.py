@@ -0,0 +1,233 @@
+import base64
+import zlib
+from typing import Dict, Any, Optional
+from db_pool import get_pool, report_query_count, execute_prepared
+from responses import CORS_HEADERS, JSON_HEADERS, ascii_json, dumps, preflight_headers
+from session_cache import get_session_token, peek_user_id, remember_session, record_activity, resolve_user_id
+from session_touch import flush_session_touches
+from library_io import export_library, import_library, read_lines
+from library_sync import parse_sync_limit, sync_library
+
+def text_timestamp(column: str) -> str:
+    '''
+    SQL for a TIMESTAMP written the way str(datetime) writes it, which is
+    how the list endpoints send timestamps; json_agg would use ISO 8601.
+    '''
+    return (f"to_char({column}, 'YYYY-MM-DD HH24:MI:SS') || CASE WHEN date_trunc('second', {column}) = {column} "
+            f"THEN '' ELSE to_char({column}, '.US') END")
+
+DASHBOARD_QUERY = f'''
+    WITH me AS ({{me}})
+    SELECT me.user_id, me.seconds_left, json_build_object(
+        'user', (
+            SELECT row_to_json(u) FROM (
+                SELECT id, email, language, theme, two_fa_enabled, analytics_enabled, action_logging_enabled
+                FROM users WHERE id = me.user_id
+            ) u
+        ),
+        'games', COALESCE((
+            SELECT json_agg(g.game ORDER BY g.updated_at DESC, g.id DESC) FROM (
+                SELECT id, updated_at, json_build_object(
+                    'id', id, 'name', name, 'hours', hours, 'status', status,
+                    'created_at', {text_timestamp('created_at')}, 'updated_at', {text_timestamp('updated_at')}
+                ) AS game
+                FROM games WHERE user_id = me.user_id
+            ) g
+        ), '[]'::json),
+        'platforms', COALESCE((
+            SELECT json_agg(p.platform ORDER BY p.created_at DESC, p.id DESC) FROM (
+                SELECT id, created_at, json_build_object(
+                    'id', id, 'name', name, 'icon', icon, 'color', color, 'status', status,
+                    'created_at', {text_timestamp('created_at')}
+                ) AS platform
+                FROM streaming_platforms WHERE user_id = me.user_id AND status <> 'deleted'
+            ) p
+        ), '[]'::json),
+        'files', COALESCE((
+            SELECT json_agg(f.file ORDER BY f.created_at DESC, f.id DESC) FROM (
+                SELECT id, created_at, json_build_object(
+                    'id', id, 'name', name, 'size', size, 'type', type,
+                    'created_at', {text_timestamp('created_at')},
+                    'preview', (SELECT json_build_object('width', p.width, 'height', p.height, 'size', p.size,
+                                                         'url', '/api/files?id=' || files.id || '&preview=1')
+                                FROM previews p WHERE p.source_hash = files.content_hash)
+                ) AS file
+                FROM files WHERE user_id = me.user_id AND type <> 'deleted'
+            ) f
+        ), '[]'::json)
+    )::text
+    FROM me
+'''
+
+KNOWN_USER = "SELECT %s::integer AS user_id, NULL::float8 AS seconds_left"
+SESSION_USER = '''SELECT user_id, EXTRACT(EPOCH FROM (expires_at - NOW()))::float8 AS seconds_left
+                  FROM sessions WHERE session_token = %s AND expires_at > NOW()'''
+
+PREFLIGHT_HEADERS = preflight_headers('GET, POST, OPTIONS', 'Content-Type, Content-Encoding, X-Session-Token')
+
+@report_query_count
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Aggregated user library API: dashboard snapshot in one round trip, delta sync (GET ?sync=1&cursor=), NDJSON export (GET ?export=1) and import (POST)
+    Args: event with httpMethod, headers, queryStringParameters, body
+    Returns: HTTP response with user settings, games, platforms and files, changes since a sync cursor, an NDJSON export or import totals
+    '''
+    method: str = event.get('httpMethod', 'GET')
+    
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': dict(PREFLIGHT_HEADERS),
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    session_token = get_session_token(event.get('headers', {}))
+    if not session_token:
+        return {
+            'statusCode': 401,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Unauthorized'}),
+            'isBase64Encoded': False
+        }
+    
+    pool = get_pool()
+    conn = pool.getconn()
+    
+    try:
+        if method == 'GET':
+            query_params = event.get('queryStringParameters') or {}
+            if query_params.get('sync') in ('1', 'true'):
+                return sync_user_library(conn, session_token, query_params)
+            if query_params.get('export') in ('1', 'true'):
+                return export_user_library(conn, session_token, event.get('headers', {}))
+            return get_dashboard(conn, session_token)
+        
+        elif method == 'POST':
+            return import_user_library(conn, session_token, event)
+        
+        return {
+            'statusCode': 405,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Method not allowed'}),
+            'isBase64Encoded': False
+        }
+    
+    finally:
+        pool.putconn(conn)
+        flush_session_touches()
+
+def get_dashboard(conn, session_token: str) -> Dict[str, Any]:
+    # A cached or signed token is resolved in-process; otherwise the session
+    # lookup is folded into the same statement, so either way this is one
+    # round trip.
+    user_id: Optional[int] = peek_user_id(conn, session_token)
+    cursor = conn.cursor()
+    if user_id is not None:
+        execute_prepared(cursor, DASHBOARD_QUERY.format(me=KNOWN_USER), (user_id,))
+    else:
+        execute_prepared(cursor, DASHBOARD_QUERY.format(me=SESSION_USER), (session_token,))
+    result = cursor.fetchone()
+    cursor.close()
+    
+    if not result:
+        return {
+            'statusCode': 401,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Unauthorized'}),
+            'isBase64Encoded': False
+        }
+    
+    if user_id is None:
+        remember_session(session_token, result[0], result[1])
+    record_activity(session_token)
+    
+    return {
+        'statusCode': 200,
+        'headers': dict(JSON_HEADERS),
+        'body': ascii_json(result[2]),
+        'isBase64Encoded': False
+    }
+
+def unauthorized() -> Dict[str, Any]:
+    return {
+        'statusCode': 401,
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'error': 'Unauthorized'}),
+        'isBase64Encoded': False
+    }
+
+def sync_user_library(conn, session_token: str, query_params: Dict[str, str]) -> Dict[str, Any]:
+    user_id = resolve_user_id(conn, session_token)
+    if not user_id:
+        return unauthorized()
+    
+    try:
+        changes = sync_library(conn, user_id, query_params.get('cursor'), parse_sync_limit(query_params.get('limit')))
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': str(e)}),
+            'isBase64Encoded': False
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': dict(JSON_HEADERS),
+        'body': dumps(changes),
+        'isBase64Encoded': False
+    }
+
+def export_user_library(conn, session_token: str, headers: Dict[str, str]) -> Dict[str, Any]:
+    user_id = resolve_user_id(conn, session_token)
+    if not user_id:
+        return unauthorized()
+    
+    accept_encoding = headers.get('accept-encoding') or headers.get('Accept-Encoding') or ''
+    compress = 'gzip' in accept_encoding
+    document, records = export_library(conn, user_id, compress)
+    response_headers = {
+        **CORS_HEADERS,
+        'Content-Type': 'application/x-ndjson',
+        'Content-Disposition': 'attachment; filename="library.ndjson"',
+        'X-Record-Count': str(records),
+        'Access-Control-Expose-Headers': 'X-Record-Count'
+    }
+    if compress:
+        response_headers['Content-Encoding'] = 'gzip'
+        return {
+            'statusCode': 200,
+            'headers': response_headers,
+            'body': base64.b64encode(document).decode('ascii'),
+            'isBase64Encoded': True
+        }
+    return {
+        'statusCode': 200,
+        'headers': response_headers,
+        'body': document.decode('utf-8'),
+        'isBase64Encoded': False
+    }
+
+def import_user_library(conn, session_token: str, event: Dict[str, Any]) -> Dict[str, Any]:
+    user_id = resolve_user_id(conn, session_token)
+    if not user_id:
+        return unauthorized()
+    
+    try:
+        totals = import_library(conn, user_id, read_lines(event.get('body'), event.get('isBase64Encoded', False)))
+    except (ValueError, OSError, EOFError, zlib.error) as e:
+        # A truncated or corrupt gzip body surfaces as EOFError or zlib.error.
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': f'Invalid import: {e}'}),
+            'isBase64Encoded': False
+        }
+    
+    return {
+        'statusCode': 200,
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'imported': totals}),
+        'isBase64Encoded': False
+    }
@@ -0,0 +1,308 @@
+'''
+NDJSON export and import of a user's library: games, live platforms and
+live file metadata, one JSON object per line with a "kind" field, after a
+{"kind": "library", "format": 1} header line.
+
+Export reads all three collections through one named server-side cursor,
+LIBRARY_EXPORT_BATCH_SIZE rows at a time, with each line rendered by
+PostgreSQL; with gzip in Accept-Encoding the lines are compressed as they
+are written, so the instance holds one batch plus the compressed output.
+
+Import parses the body line by line and COPYs each kind into a temporary
+table in chunks of LIBRARY_IMPORT_CHUNK_ROWS, merging every chunk into the
+user's rows before the next one is read:
+    game      updated when its exported id is one of the user's games, or
+              else when exactly one of them has its name (hours, status,
+              updated_at replaced); inserted when no game has the name,
+              and reported as a conflict when several do
+    platform  upserted by name among live platforms; absent fields keep
+              their current value
+    file      metadata (name, type) of a live file the user already owns
+              with that content_hash; file content only arrives through
+              the upload endpoints, since claiming a digest would
+              otherwise grant access to whichever blob has it
+The import runs in one transaction under a per-user advisory lock, so it
+applies completely or not at all, and reports rows per second.
+'''
+import base64
+import csv
+import gzip
+import io
+import json
+import os
+import re
+import time
+from typing import Any, Dict, IO, Iterable, Iterator, List, Optional, Tuple
+import psycopg2
+from collection_versions import bump_version
+
+LIBRARY_EXPORT_BATCH_SIZE = int(os.environ.get('LIBRARY_EXPORT_BATCH_SIZE', '2000'))
+LIBRARY_IMPORT_CHUNK_ROWS = int(os.environ.get('LIBRARY_IMPORT_CHUNK_ROWS', '5000'))
+LIBRARY_FORMAT = 1
+INT4_MAX = 2147483647
+# Same rule as the files upload endpoints: the type is sent back as a header.
+FILE_TYPE_PATTERN = re.compile(r"[A-Za-z0-9][A-Za-z0-9!#$&^_.+-]*(/[A-Za-z0-9][A-Za-z0-9!#$&^_.+-]*)?")
+
+EXPORT_QUERY = '''
+    SELECT json_build_object('kind', 'game', 'id', id, 'name', name, 'hours', hours, 'status', status,
+                             'created_at', created_at, 'updated_at', updated_at)::text
+    FROM games WHERE user_id = %(user_id)s
+    UNION ALL
+    SELECT json_build_object('kind', 'platform', 'name', name, 'icon', icon, 'color', color, 'status', status,
+                             'created_at', created_at)::text
+    FROM streaming_platforms WHERE user_id = %(user_id)s AND status <> 'deleted'
+    UNION ALL
+    SELECT json_build_object('kind', 'file', 'name', name, 'size', size, 'type', type,
+                             'content_hash', content_hash, 'created_at', created_at)::text
+    FROM files WHERE user_id = %(user_id)s AND type <> 'deleted'
+'''
+
+
+class LibraryImportError(ValueError):
+    pass
+
+
+# kind -> (staging table, COPY columns)
+IMPORT_KINDS = {
+    'game': ('import_games', ('line', 'id', 'name', 'hours', 'status', 'created_at', 'updated_at')),
+    'platform': ('import_platforms', ('line', 'name', 'icon', 'color', 'status', 'created_at')),
+    'file': ('import_files', ('line', 'name', 'type', 'content_hash')),
+}
+
+STAGING_TABLES = '''
+    CREATE TEMP TABLE IF NOT EXISTS import_games (
+        line INTEGER, id INTEGER, name VARCHAR(255), hours INTEGER, status VARCHAR(20), created_at TIMESTAMP,
+        updated_at TIMESTAMP
+    ) ON COMMIT DROP;
+    CREATE TEMP TABLE IF NOT EXISTS import_platforms (
+        line INTEGER, name VARCHAR(100), icon VARCHAR(50), color VARCHAR(50), status VARCHAR(20), created_at TIMESTAMP
+    ) ON COMMIT DROP;
+    CREATE TEMP TABLE IF NOT EXISTS import_files (
+        line INTEGER, name VARCHAR(255), type VARCHAR(50), content_hash CHAR(64)
+    ) ON COMMIT DROP;
+'''
+
+# Each merge takes the last line per key within the chunk, updates the
+# matching rows and inserts the rest; it returns (inserted, updated,
+# conflicts), counting rows.
+MERGE_SQL = {
+    'game': '''
+        WITH resolved AS (
+            SELECT i.*,
+                   COALESCE(
+                       (SELECT g.id FROM games g WHERE g.id = i.id AND g.user_id = %(user_id)s),
+                       (SELECT MIN(g.id) FROM games g WHERE g.user_id = %(user_id)s AND g.name = i.name
+                        HAVING COUNT(*) = 1)
+                   ) AS target,
+                   (SELECT COUNT(*) FROM games g WHERE g.user_id = %(user_id)s AND g.name = i.name) AS same_name
+            FROM import_games i
+        ), matched AS (
+            SELECT DISTINCT ON (target) * FROM resolved WHERE target IS NOT NULL ORDER BY target, line DESC
+        ), updated AS (
+            UPDATE games g SET hours = COALESCE(m.hours, g.hours), status = COALESCE(m.status, g.status),
+                               updated_at = COALESCE(m.updated_at, NOW())
+            FROM matched m WHERE g.id = m.target AND g.user_id = %(user_id)s
+            RETURNING 1
+        ), fresh AS (
+            SELECT DISTINCT ON (COALESCE('id:' || id, 'name:' || name)) * FROM resolved
+            WHERE target IS NULL AND same_name = 0
+            ORDER BY COALESCE('id:' || id, 'name:' || name), line DESC
+        ), inserted AS (
+            INSERT INTO games (user_id, name, hours, status, created_at, updated_at)
+            SELECT %(user_id)s, name, COALESCE(hours, 0), COALESCE(status, 'playing'),
+                   COALESCE(created_at, NOW()), COALESCE(updated_at, NOW())
+            FROM fresh
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM inserted), (SELECT COUNT(*) FROM updated),
+               (SELECT COUNT(*) FROM resolved WHERE target IS NULL AND same_name > 0)
+    ''',
+    'platform': '''
+        WITH incoming AS (
+            SELECT DISTINCT ON (name) * FROM import_platforms ORDER BY name, line DESC
+        ), updated AS (
+            UPDATE streaming_platforms p SET icon = COALESCE(i.icon, p.icon), color = COALESCE(i.color, p.color),
+                                           status = COALESCE(i.status, p.status)
+            FROM incoming i WHERE p.user_id = %(user_id)s AND p.name = i.name AND p.status <> 'deleted'
+            RETURNING p.name
+        ), inserted AS (
+            INSERT INTO streaming_platforms (user_id, name, icon, color, status, created_at)
+            SELECT %(user_id)s, name, icon, color, COALESCE(status, 'active'), COALESCE(created_at, NOW())
+            FROM incoming WHERE name NOT IN (SELECT name FROM updated)
+            RETURNING 1
+        )
+        SELECT (SELECT COUNT(*) FROM inserted), (SELECT COUNT(DISTINCT name) FROM updated), 0
+    ''',
+    'file': '''
+        WITH incoming AS (
+            SELECT DISTINCT ON (content_hash) * FROM import_files ORDER BY content_hash, line DESC
+        ), updated AS (
+            UPDATE files f SET name = i.name, type = COALESCE(i.type, f.type)
+            FROM incoming i WHERE f.user_id = %(user_id)s AND f.content_hash = i.content_hash AND f.type <> 'deleted'
+            RETURNING f.content_hash
+        )
+        SELECT 0, (SELECT COUNT(DISTINCT content_hash) FROM updated), 0
+    ''',
+}
+
+COLLECTIONS = {'game': 'games', 'platform': 'platforms', 'file': 'files'}
+
+
+def export_library(conn, user_id: int, compress: bool) -> Tuple[bytes, int]:
+    '''
+    Returns the NDJSON document (gzip-compressed when compress is set) and
+    the number of records in it.
+    '''
+    raw = io.BytesIO()
+    out: IO[bytes] = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) if compress else raw
+    out.write(json.dumps({'kind': 'library', 'format': LIBRARY_FORMAT}).encode() + b'\n')
+    exported = 0
+    cursor = conn.cursor(name='library_export')
+    cursor.execute(EXPORT_QUERY, {'user_id': user_id})
+    while True:
+        rows = cursor.fetchmany(LIBRARY_EXPORT_BATCH_SIZE)
+        if not rows:
+            break
+        out.write(''.join(row[0] + '\n' for row in rows).encode())
+        exported += len(rows)
+    cursor.close()
+    conn.commit()
+    if compress:
+        out.close()
+    return raw.getvalue(), exported
+
+
+def _text(record: Dict[str, Any], field: str, limit: int, required: bool = False) -> Optional[str]:
+    value = record.get(field)
+    if value is None or value == '':
+        if required:
+            raise LibraryImportError(f'{field} is required')
+        return None
+    if not isinstance(value, str) or len(value) > limit:
+        raise LibraryImportError(f'{field} must be a string of at most {limit} characters')
+    return value
+
+
+def parse_record(line_number: int, record: Any) -> Tuple[str, tuple]:
+    if not isinstance(record, dict):
+        raise LibraryImportError('expected a JSON object')
+    kind = record.get('kind')
+    if kind == 'game':
+        hours = record.get('hours')
+        if hours is not None and (not isinstance(hours, int) or isinstance(hours, bool) or hours < 0):
+            raise LibraryImportError('hours must be a non-negative integer')
+        game_id = record.get('id')
+        if game_id is not None and (not isinstance(game_id, int) or isinstance(game_id, bool)
+                                    or not 0 < game_id <= INT4_MAX):
+            raise LibraryImportError('id must be a positive integer')
+        return kind, (line_number, game_id, _text(record, 'name', 255, required=True), hours, _text(record, 'status', 20),
+                      _text(record, 'created_at', 40), _text(record, 'updated_at', 40))
+    if kind == 'platform':
+        status = _text(record, 'status', 20)
+        if status == 'deleted':
+            raise LibraryImportError('deleted platforms cannot be imported')
+        return kind, (line_number, _text(record, 'name', 100, required=True), _text(record, 'icon', 50),
+                      _text(record, 'color', 50), status, _text(record, 'created_at', 40))
+    if kind == 'file':
+        content_hash = _text(record, 'content_hash', 64, required=True)
+        if len(content_hash) != 64:
+            raise LibraryImportError('content_hash must be a SHA-256 hex digest')
+        file_type = _text(record, 'type', 50)
+        if file_type == 'deleted':
+            raise LibraryImportError('deleted files cannot be imported')
+        if file_type is not None and not FILE_TYPE_PATTERN.fullmatch(file_type):
+            raise LibraryImportError('type must be a MIME type such as image/png')
+        return kind, (line_number, _text(record, 'name', 255, required=True), file_type, content_hash)
+    raise LibraryImportError(f'unknown kind {kind!r}')
+
+
+def split_lines(text: str) -> Iterator[str]:
+    # Slices the body line by line; io.StringIO(text) would first copy the
+    # whole body into its own buffer.
+    start = 0
+    while start < len(text):
+        end = text.find('\n', start)
+        if end == -1:
+            end = len(text)
+        yield text[start:end]
+        start = end + 1
+
+
+def read_lines(body: Any, base64_encoded: bool) -> Iterable[str]:
+    if not base64_encoded:
+        return split_lines(body or '')
+    raw = io.BytesIO(base64.b64decode(body or ''))
+    if raw.getbuffer()[:2] == b'\x1f\x8b':
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=raw), encoding='utf-8')
+    return io.TextIOWrapper(raw, encoding='utf-8')
+
+
+def _flush(cursor, kind: str, rows: List[tuple], user_id: int, totals: Dict[str, Dict[str, int]]) -> None:
+    table, columns = IMPORT_KINDS[kind]
+    buffer = io.StringIO()
+    # None is written as an empty field, which COPY reads as NULL; parsing
+    # already turned empty strings into None, so nothing else is empty.
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    cursor.execute(MERGE_SQL[kind], {'user_id': user_id})
+    inserted, updated, conflicts = cursor.fetchone()
+    cursor.execute(f'TRUNCATE {table}')
+    counts = totals[COLLECTIONS[kind]]
+    counts['inserted'] += inserted
+    counts['updated'] += updated
+    counts['conflicts'] += conflicts
+    counts['skipped'] += len(rows) - inserted - updated - conflicts
+    rows.clear()
+
+
+def import_library(conn, user_id: int, lines: Iterable[str]) -> Dict[str, Any]:
+    '''
+    Imports NDJSON lines for user_id; raises LibraryImportError (with the line
+    number) on a malformed record, after rolling the transaction back.
+    '''
+    started = time.monotonic()
+    totals = {collection: {'inserted': 0, 'updated': 0, 'conflicts': 0, 'skipped': 0} for collection in COLLECTIONS.values()}
+    pending: Dict[str, List[tuple]] = {kind: [] for kind in IMPORT_KINDS}
+    records = 0
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('library_import'), %s)", (user_id,))
+        cursor.execute(STAGING_TABLES)
+        line_number = 0
+        for line_number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if line_number == 1 and isinstance(record, dict) and record.get('kind') == 'library':
+                    if record.get('format') != LIBRARY_FORMAT:
+                        raise LibraryImportError(f"unsupported format {record.get('format')!r}")
+                    continue
+                kind, row = parse_record(line_number, record)
+            except (ValueError, TypeError) as e:
+                raise LibraryImportError(f'line {line_number}: {e}')
+            pending[kind].append(row)
+            records += 1
+            if len(pending[kind]) >= LIBRARY_IMPORT_CHUNK_ROWS:
+                _flush(cursor, kind, pending[kind], user_id, totals)
+        for kind, rows in pending.items():
+            if rows:
+                _flush(cursor, kind, rows, user_id, totals)
+        for collection, counts in totals.items():
+            if counts['inserted'] or counts['updated']:
+                bump_version(cursor, user_id, collection)
+        conn.commit()
+    except psycopg2.DataError as e:
+        conn.rollback()
+        raise LibraryImportError(f'invalid value: {e.pgerror or e}'.strip())
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    seconds = time.monotonic() - started
+    rows_per_second = records / seconds if seconds > 0 else float(records)
+    print(f'[library_io] user {user_id} imported {records} records in {seconds:.2f}s ({rows_per_second:.0f} rows/s)')
+    return {'records': records, 'seconds': round(seconds, 3), 'rows_per_second': round(rows_per_second), **totals}
@@ -0,0 +1,198 @@
+'''
+Delta sync of a user's games, platforms and files.
+
+    GET /library?sync=1[&cursor=<token>][&limit=N]
+
+Every row carries change_xid, the id of the transaction that last wrote it:
+the column default sets it on insert and the track_change trigger on every
+update. A sync returns the rows whose change_xid is at or above the
+client's cursor, and the next cursor is the xmin of the snapshot those rows
+were read under. Every transaction below that xmin had finished and was
+visible to the read, and anything that commits later has an id at or above
+it, so no change falls between two syncs. Rows written by transactions at
+or above the xmin can come back on the following sync; clients apply
+changes as upserts by id, so a repeat is harmless.
+
+Soft-deleted platforms and files are reported as tombstones (ids under
+'deleted'), also after the purge jobs have moved them to the archive
+tables, which keep change_xid. A sync without a cursor returns the live
+library and no tombstones. A page holds at most `limit` changes; while
+has_more is set the client passes next_cursor back to read the rest of the
+same round, and the last page's next_cursor is the one to keep.
+'''
+import base64
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+from db_pool import execute_prepared
+
+LIBRARY_SYNC_PAGE_SIZE = int(os.environ.get('LIBRARY_SYNC_PAGE_SIZE', '500'))
+LIBRARY_SYNC_MAX_PAGE_SIZE = int(os.environ.get('LIBRARY_SYNC_MAX_PAGE_SIZE', '5000'))
+
+SYNC_KINDS = ('games', 'platforms', 'files')
+
+SYNC_FIELDS = {
+    'games': ('id', 'name', 'hours', 'status', 'created_at', 'updated_at'),
+    'platforms': ('id', 'name', 'icon', 'color', 'status', 'created_at', 'updated_at'),
+    'files': ('id', 'name', 'size', 'type', 'created_at', 'updated_at'),
+}
+
+# Each source is read in (change_xid, id) order from its user_id, change_xid,
+# id index; a kind's position applies to its live table and its archive
+# alike, as purged rows keep their ids.
+SYNC_SOURCES = {
+    'games': [
+        '''SELECT 0, change_xid, id, FALSE, name, hours, status, NULL::varchar, NULL::varchar, NULL::bigint, NULL::varchar,
+                  created_at, updated_at
+           FROM games WHERE user_id = %(user_id)s
+           AND (change_xid, id) > (%(games_xid)s::xid8, %(games_id)s)''',
+    ],
+    'platforms': [
+        '''SELECT 1, change_xid, id, status = 'deleted', name, NULL::integer, status, icon, color, NULL::bigint, NULL::varchar,
+                  created_at, updated_at
+           FROM streaming_platforms WHERE user_id = %(user_id)s
+           AND (change_xid, id) > (%(platforms_xid)s::xid8, %(platforms_id)s)
+           AND (status <> 'deleted' OR NOT %(full)s)''',
+        '''SELECT 1, change_xid, id, TRUE, name, NULL::integer, status, icon, color, NULL::bigint, NULL::varchar,
+                  created_at, updated_at
+           FROM streaming_platforms_archive WHERE user_id = %(user_id)s
+           AND (change_xid, id) > (%(platforms_xid)s::xid8, %(platforms_id)s)
+           AND NOT %(full)s''',
+    ],
+    'files': [
+        '''SELECT 2, change_xid, id, type = 'deleted', name, NULL::integer, NULL::varchar, NULL::varchar, NULL::varchar, size, type,
+                  created_at, updated_at
+           FROM files WHERE user_id = %(user_id)s
+           AND (change_xid, id) > (%(files_xid)s::xid8, %(files_id)s)
+           AND (type <> 'deleted' OR NOT %(full)s)''',
+        '''SELECT 2, change_xid, id, TRUE, name, NULL::integer, NULL::varchar, NULL::varchar, NULL::varchar, size, type,
+                  created_at, updated_at
+           FROM files_archive WHERE user_id = %(user_id)s
+           AND (change_xid, id) > (%(files_xid)s::xid8, %(files_id)s)
+           AND NOT %(full)s''',
+    ],
+}
+
+SYNC_COLUMNS = ('id', 'deleted', 'name', 'hours', 'status', 'icon', 'color', 'size', 'type', 'created_at', 'updated_at')
+
+
+def sync_query(first_kind: int) -> str:
+    '''
+    The statement for a page starting at SYNC_KINDS[first_kind]: every source
+    from that kind on, each limited on its own, beside the snapshot xmin.
+    The LEFT JOIN keeps the xmin row when nothing changed.
+    '''
+    sources = [
+        f'({source} ORDER BY change_xid, id LIMIT %(limit)s)'
+        for kind in SYNC_KINDS[first_kind:]
+        for source in SYNC_SOURCES[kind]
+    ]
+    return f'''
+        WITH bound AS (
+            SELECT COALESCE(%(bound)s::xid8, pg_snapshot_xmin(pg_current_snapshot())) AS xmin
+        )
+        SELECT bound.xmin::text, changes.kind, changes.change_xid::text, {', '.join(f'changes.{c}' for c in SYNC_COLUMNS)}
+        FROM bound LEFT JOIN ({' UNION ALL '.join(sources)}) changes (kind, change_xid, {', '.join(SYNC_COLUMNS)}) ON TRUE
+    '''
+
+
+SYNC_QUERIES = [sync_query(first_kind) for first_kind in range(len(SYNC_KINDS))]
+
+
+def encode_sync_cursor(position: List[int]) -> str:
+    raw = json.dumps(position).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode_sync_cursor(token: Optional[str]) -> Tuple[int, Optional[int], int, int, int]:
+    '''
+    Returns (since, bound, kind, after_xid, after_id). A finished round's
+    cursor holds only the next since; a cursor in the middle of a round
+    also holds the round's bound and the last change sent.
+    '''
+    if not token:
+        return 0, None, 0, 0, 0
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = [int(value) for value in json.loads(raw)]
+    except (ValueError, TypeError):
+        raise ValueError('Invalid sync cursor')
+    if any(value < 0 for value in values):
+        raise ValueError('Invalid sync cursor')
+    if len(values) == 1:
+        return values[0], None, 0, values[0], 0
+    if len(values) == 5 and values[2] < len(SYNC_KINDS):
+        since, bound, kind, after_xid, after_id = values
+        return since, bound, kind, after_xid, after_id
+    raise ValueError('Invalid sync cursor')
+
+
+def parse_sync_limit(value: Optional[str]) -> int:
+    if value is None:
+        return LIBRARY_SYNC_PAGE_SIZE
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError('Invalid limit')
+    if limit < 1:
+        raise ValueError('Invalid limit')
+    return min(limit, LIBRARY_SYNC_MAX_PAGE_SIZE)
+
+
+def sync_params(user_id: int, since: int, bound: Optional[int], first_kind: int,
+                after_xid: int, after_id: int, limit: int) -> Dict[str, Any]:
+    params: Dict[str, Any] = {
+        'user_id': user_id,
+        'bound': None if bound is None else str(bound),
+        'full': since == 0,
+        'limit': limit + 1,
+    }
+    for kind, name in enumerate(SYNC_KINDS):
+        # ids start at 1, so (since, 0) admits every change at or above since
+        position = (after_xid, after_id) if kind == first_kind else (since, 0)
+        params[f'{name}_xid'], params[f'{name}_id'] = str(position[0]), position[1]
+    return params
+
+
+def sync_library(conn, user_id: int, token: Optional[str], limit: int) -> Dict[str, Any]:
+    '''
+    One page of changes for user_id after the cursor token, in a single
+    statement; raises ValueError on a malformed token.
+    '''
+    since, bound, first_kind, after_xid, after_id = decode_sync_cursor(token)
+    cursor = conn.cursor()
+    execute_prepared(
+        cursor,
+        SYNC_QUERIES[first_kind],
+        sync_params(user_id, since, bound, first_kind, after_xid, after_id, limit)
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+
+    bound = int(rows[0][0])
+    # Each source returned at most limit + 1 rows past its position, so the
+    # first `limit` changes in (kind, change_xid, id) order are all here.
+    changes = sorted(
+        ((row[1], int(row[2]), row[3:]) for row in rows if row[1] is not None),
+        key=lambda change: (change[0], change[1], change[2][0])
+    )
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    body: Dict[str, Any] = {kind: [] for kind in SYNC_KINDS}
+    body['deleted'] = {'platforms': [], 'files': []}
+    for kind, _, values in changes:
+        name = SYNC_KINDS[kind]
+        record = dict(zip(SYNC_COLUMNS, values))
+        if record['deleted']:
+            body['deleted'][name].append(record['id'])
+        else:
+            body[name].append({field: record[field] for field in SYNC_FIELDS[name]})
+
+    if has_more:
+        last_kind, last_xid, last_values = changes[-1]
+        body['next_cursor'] = encode_sync_cursor([since, bound, last_kind, last_xid, last_values[0]])
+    else:
+        body['next_cursor'] = encode_sync_cursor([bound])
+    body['has_more'] = has_more
+    return body
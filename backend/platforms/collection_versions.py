@@ -0,0 +1,55 @@
+'''
+Per-user, per-collection version counters used as ETags for list endpoints.
+Writers bump the counter inside their own transaction, so a 304 can be
+answered from a single primary-key lookup.
+'''
+import hashlib
+from typing import Dict, Iterable
+from psycopg2.extras import execute_values
+from db_pool import execute_prepared
+
+
+def get_version(conn, user_id: int, collection: str) -> int:
+    cursor = conn.cursor()
+    execute_prepared(
+        cursor,
+        "SELECT version FROM collection_versions WHERE user_id = %s AND collection = %s",
+        (user_id, collection)
+    )
+    result = cursor.fetchone()
+    cursor.close()
+    return result[0] if result else 0
+
+
+def bump_version(cursor, user_id: int, collection: str) -> None:
+    execute_prepared(
+        cursor,
+        '''INSERT INTO collection_versions (user_id, collection, version) VALUES (%s, %s, 1)
+           ON CONFLICT (user_id, collection) DO UPDATE SET version = collection_versions.version + 1''',
+        (user_id, collection)
+    )
+
+
+def make_etag(collection: str, user_id: int, version: int, query_params: Dict[str, str]) -> str:
+    variant = '&'.join(f'{k}={v}' for k, v in sorted(query_params.items()))
+    digest = hashlib.sha1(variant.encode()).hexdigest()[:12]
+    return f'W/"{collection}-{user_id}-{version}-{digest}"'
+
+
+def etag_matches(headers: Dict[str, str], etag: str) -> bool:
+    if_none_match = headers.get('if-none-match') or headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    weak = etag[2:]
+    return any(tag.strip().removeprefix('W/') == weak for tag in if_none_match.split(','))
+
+
+def bump_versions(cursor, user_ids: Iterable[int], collection: str) -> None:
+    execute_values(
+        cursor,
+        '''INSERT INTO collection_versions (user_id, collection, version) VALUES %s
+           ON CONFLICT (user_id, collection) DO UPDATE SET version = collection_versions.version + 1''',
+        [(user_id, collection, 1) for user_id in sorted(set(user_ids))]
+    )
@@ -1,9 +1,24 @@
 import json
-import os
-from typing import Dict, Any
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from typing import Dict, Any, List, Optional
+from psycopg2.extras import RealDictCursor, execute_values
+from db_pool import get_pool, report_query_count, execute_prepared
+from session_cache import get_session_token, resolve_user_id
+from session_touch import flush_session_touches
+from pagination import parse_page_params, fetch_page, stream_json_array
+from collection_versions import get_version, bump_version, make_etag, etag_matches
+from response_cache import response_cache, cache_key
+from responses import CORS_HEADERS, JSON_HEADERS, dumps, preflight_headers
 
+BULK_MAX_ITEMS = 5000
+BULK_PAGE_SIZE = 500
+# VARCHAR limits from the schema; longer values would fail the whole statement.
+PLATFORM_FIELD_LIMITS = {'name': 100, 'icon': 50, 'color': 50, 'status': 20}
+
+PLATFORMS_LIST_QUERY = "SELECT id, name, icon, color, status, created_at FROM streaming_platforms WHERE user_id = %s AND status <> 'deleted'"
+
+PREFLIGHT_HEADERS = preflight_headers('GET, POST, PUT, DELETE, OPTIONS', 'Content-Type, X-Session-Token, If-None-Match')
+
+@report_query_count
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Streaming platforms CRUD API
@@ -15,36 +30,35 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     if method == 'OPTIONS':
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Session-Token',
-                'Access-Control-Max-Age': '86400'
-            },
+            'headers': dict(PREFLIGHT_HEADERS),
             'body': '',
             'isBase64Encoded': False
         }
     
-    db_url = os.environ.get('DATABASE_URL')
-    conn = psycopg2.connect(db_url)
+    pool = get_pool()
+    conn = pool.getconn()
     
     try:
         user_id = get_user_from_session(conn, event.get('headers', {}))
         if not user_id:
             return {
                 'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Unauthorized'}),
+                'headers': dict(JSON_HEADERS),
+                'body': dumps({'error': 'Unauthorized'}),
                 'isBase64Encoded': False
             }
         
         if method == 'GET':
-            return get_platforms(conn, user_id)
+            return get_platforms(conn, user_id, event.get('queryStringParameters') or {}, event.get('headers', {}))
         elif method == 'POST':
             body_data = json.loads(event.get('body', '{}'))
+            if 'items' in body_data:
+                return bulk_create_platforms(conn, user_id, body_data)
             return create_platform(conn, user_id, body_data)
         elif method == 'PUT':
             body_data = json.loads(event.get('body', '{}'))
+            if 'items' in body_data:
+                return bulk_update_platforms(conn, user_id, body_data)
             return update_platform(conn, user_id, body_data)
         elif method == 'DELETE':
             body_data = json.loads(event.get('body', '{}'))
@@ -52,44 +66,65 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         return {
             'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Method not allowed'}),
             'isBase64Encoded': False
         }
     
     finally:
-        conn.close()
+        pool.putconn(conn)
+        flush_session_touches()
 
 def get_user_from_session(conn, headers: Dict[str, str]) -> int:
-    session_token = headers.get('x-session-token') or headers.get('X-Session-Token')
-    if not session_token:
-        return None
-    
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        "SELECT user_id FROM sessions WHERE session_token = %s AND expires_at > NOW()",
-        (session_token,)
-    )
-    result = cursor.fetchone()
-    cursor.close()
-    return result['user_id'] if result else None
+    return resolve_user_id(conn, get_session_token(headers))
 
-def get_platforms(conn, user_id: int) -> Dict[str, Any]:
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
-        "SELECT id, name, icon, color, status, created_at FROM streaming_platforms WHERE user_id = %s ORDER BY created_at DESC",
-        (user_id,)
-    )
-    platforms = cursor.fetchall()
-    cursor.close()
+def get_platforms(conn, user_id: int, query_params: Dict[str, str], headers: Dict[str, str]) -> Dict[str, Any]:
+    # The version is read before the rows, so a concurrent write can only
+    # pair an older ETag with newer data, never the other way round.
+    version = get_version(conn, user_id, 'platforms')
+    etag = make_etag('platforms', user_id, version, query_params)
+    if etag_matches(headers, etag):
+        return {
+            'statusCode': 304,
+            'headers': {**CORS_HEADERS, 'ETag': etag, 'Access-Control-Expose-Headers': 'ETag'},
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    key = cache_key(user_id, 'platforms', query_params)
+    body = response_cache.get(key, version)
+    if body is None:
+        try:
+            body = render_platforms(conn, user_id, query_params)
+        except ValueError as e:
+            return {
+                'statusCode': 400,
+                'headers': dict(JSON_HEADERS),
+                'body': dumps({'error': str(e)}),
+                'isBase64Encoded': False
+            }
+        response_cache.put(key, version, body)
     
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'platforms': [dict(p) for p in platforms]}, default=str),
+        'headers': {**JSON_HEADERS, 'ETag': etag, 'Access-Control-Expose-Headers': 'ETag'},
+        'body': body,
         'isBase64Encoded': False
     }
 
+def render_platforms(conn, user_id: int, query_params: Dict[str, str]) -> str:
+    query = PLATFORMS_LIST_QUERY
+    
+    if query_params.get('stream') in ('1', 'true'):
+        return '{"platforms": ' + stream_json_array(conn, 'platforms', query, (user_id,), 'created_at') + '}'
+    
+    limit, after = parse_page_params(query_params)
+    platforms, next_cursor = fetch_page(conn, query, (user_id,), 'created_at', limit, after)
+    response_body = {'platforms': platforms}
+    if limit is not None:
+        response_body['next_cursor'] = next_cursor
+    return dumps(response_body)
+
 def create_platform(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
     name = body_data.get('name')
     icon = body_data.get('icon', 'Tv')
@@ -98,24 +133,36 @@ def create_platform(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str,
     if not name:
         return {
             'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Platform name required'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Platform name required'}),
+            'isBase64Encoded': False
+        }
+    
+    error = validate_platform_fields(body_data)
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': error}),
             'isBase64Encoded': False
         }
     
     cursor = conn.cursor(cursor_factory=RealDictCursor)
-    cursor.execute(
+    execute_prepared(
+        cursor,
         "INSERT INTO streaming_platforms (user_id, name, icon, color) VALUES (%s, %s, %s, %s) RETURNING id, name, icon, color, status, created_at",
         (user_id, name, icon, color)
     )
     platform = cursor.fetchone()
+    bump_version(cursor, user_id, 'platforms')
     conn.commit()
     cursor.close()
+    response_cache.invalidate(user_id, 'platforms')
     
     return {
         'statusCode': 201,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'platform': dict(platform)}, default=str),
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'platform': dict(platform)}),
         'isBase64Encoded': False
     }
 
@@ -124,8 +171,17 @@ def update_platform(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str,
     if not platform_id:
         return {
             'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Platform ID required'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Platform ID required'}),
+            'isBase64Encoded': False
+        }
+    
+    error = validate_platform_fields(body_data)
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': error}),
             'isBase64Encoded': False
         }
     
@@ -148,33 +204,37 @@ def update_platform(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str,
     if not updates:
         return {
             'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'No fields to update'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'No fields to update'}),
             'isBase64Encoded': False
         }
     
     params.extend([platform_id, user_id])
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     cursor.execute(
-        f"UPDATE streaming_platforms SET {', '.join(updates)} WHERE id = %s AND user_id = %s RETURNING id, name, icon, color, status",
+        f"UPDATE streaming_platforms SET {', '.join(updates)} WHERE id = %s AND user_id = %s AND status <> 'deleted' RETURNING id, name, icon, color, status",
         params
     )
     platform = cursor.fetchone()
+    if platform:
+        bump_version(cursor, user_id, 'platforms')
     conn.commit()
     cursor.close()
     
     if not platform:
         return {
             'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Platform not found'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Platform not found'}),
             'isBase64Encoded': False
         }
     
+    response_cache.invalidate(user_id, 'platforms')
+    
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'platform': dict(platform)}),
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'platform': dict(platform)}),
         'isBase64Encoded': False
     }
 
@@ -183,31 +243,178 @@ def delete_platform(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str,
     if not platform_id:
         return {
             'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Platform ID required'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Platform ID required'}),
             'isBase64Encoded': False
         }
     
     cursor = conn.cursor()
     cursor.execute(
-        "UPDATE streaming_platforms SET status = 'deleted' WHERE id = %s AND user_id = %s",
+        "UPDATE streaming_platforms SET status = 'deleted', deleted_at = NOW() WHERE id = %s AND user_id = %s AND status <> 'deleted'",
         (platform_id, user_id)
     )
-    conn.commit()
     affected = cursor.rowcount
+    if affected:
+        bump_version(cursor, user_id, 'platforms')
+    conn.commit()
     cursor.close()
     
     if affected == 0:
         return {
             'statusCode': 404,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Platform not found'}),
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': 'Platform not found'}),
+            'isBase64Encoded': False
+        }
+    
+    response_cache.invalidate(user_id, 'platforms')
+    
+    return {
+        'statusCode': 200,
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'message': 'Platform deleted'}),
+        'isBase64Encoded': False
+    }
+
+def validate_bulk_items(body_data: Dict[str, Any]) -> Optional[str]:
+    items = body_data.get('items')
+    if not isinstance(items, list) or not items:
+        return 'Items required'
+    if len(items) > BULK_MAX_ITEMS:
+        return f'At most {BULK_MAX_ITEMS} items per request'
+    return None
+
+def validate_platform_fields(item: Dict[str, Any]) -> Optional[str]:
+    if 'name' in item and (not isinstance(item['name'], str) or not item['name']):
+        return 'Invalid platform name'
+    for field in ('icon', 'color', 'status'):
+        if field in item and not isinstance(item[field], str):
+            return f'Invalid {field}'
+    if item.get('status') == 'deleted':
+        return 'Use DELETE to remove a platform'
+    for field, limit in PLATFORM_FIELD_LIMITS.items():
+        if isinstance(item.get(field), str) and len(item[field]) > limit:
+            return f'{field} must be at most {limit} characters'
+    return None
+
+def bulk_create_platforms(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    error = validate_bulk_items(body_data)
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': error}),
+            'isBase64Encoded': False
+        }
+    
+    items = body_data['items']
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    indexes = []
+    values = []
+    
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get('name'):
+            results[index] = {'index': index, 'status': 'error', 'error': 'Platform name required'}
+            continue
+        error = validate_platform_fields(item)
+        if error:
+            results[index] = {'index': index, 'status': 'error', 'error': error}
+            continue
+        indexes.append(index)
+        values.append((user_id, item['name'], item.get('icon', 'Tv'), item.get('color', 'bg-primary')))
+    
+    if values:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        # RETURNING yields rows in VALUES order, which maps them back to items.
+        platforms = execute_values(
+            cursor,
+            "INSERT INTO streaming_platforms (user_id, name, icon, color) VALUES %s RETURNING id, name, icon, color, status, created_at",
+            values,
+            page_size=BULK_PAGE_SIZE,
+            fetch=True
+        )
+        bump_version(cursor, user_id, 'platforms')
+        conn.commit()
+        cursor.close()
+        response_cache.invalidate(user_id, 'platforms')
+        
+        for index, platform in zip(indexes, platforms):
+            results[index] = {'index': index, 'status': 'created', 'platform': dict(platform)}
+    
+    return {
+        'statusCode': 200,
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'results': results, 'created': len(values), 'failed': len(items) - len(values)}),
+        'isBase64Encoded': False
+    }
+
+def bulk_update_platforms(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    error = validate_bulk_items(body_data)
+    if error:
+        return {
+            'statusCode': 400,
+            'headers': dict(JSON_HEADERS),
+            'body': dumps({'error': error}),
             'isBase64Encoded': False
         }
     
+    items = body_data['items']
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+    index_by_id: Dict[int, int] = {}
+    values = []
+    
+    for index, item in enumerate(items):
+        platform_id = item.get('id') if isinstance(item, dict) else None
+        if not isinstance(platform_id, int) or isinstance(platform_id, bool):
+            results[index] = {'index': index, 'status': 'error', 'error': 'Platform ID required'}
+            continue
+        if platform_id in index_by_id:
+            results[index] = {'index': index, 'status': 'error', 'error': 'Duplicate platform ID'}
+            continue
+        error = validate_platform_fields(item)
+        if not error and not any(field in item for field in ('name', 'icon', 'color', 'status')):
+            error = 'No fields to update'
+        if error:
+            results[index] = {'index': index, 'status': 'error', 'error': error}
+            continue
+        index_by_id[platform_id] = index
+        values.append((platform_id, user_id, item.get('name'), item.get('icon'), item.get('color'), item.get('status')))
+    
+    updated = 0
+    if values:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        platforms = execute_values(
+            cursor,
+            '''UPDATE streaming_platforms AS p SET
+                   name = COALESCE(v.name, p.name),
+                   icon = COALESCE(v.icon, p.icon),
+                   color = COALESCE(v.color, p.color),
+                   status = COALESCE(v.status, p.status)
+               FROM (VALUES %s) AS v(id, user_id, name, icon, color, status)
+               WHERE p.id = v.id AND p.user_id = v.user_id AND p.status <> 'deleted'
+               RETURNING p.id, p.name, p.icon, p.color, p.status''',
+            values,
+            template='(%s::integer, %s::integer, %s::varchar, %s::varchar, %s::varchar, %s::varchar)',
+            page_size=BULK_PAGE_SIZE,
+            fetch=True
+        )
+        if platforms:
+            bump_version(cursor, user_id, 'platforms')
+        conn.commit()
+        cursor.close()
+        
+        for platform in platforms:
+            index = index_by_id.pop(platform['id'])
+            results[index] = {'index': index, 'status': 'updated', 'platform': dict(platform)}
+        for index in index_by_id.values():
+            results[index] = {'index': index, 'status': 'not_found', 'error': 'Platform not found'}
+        updated = len(platforms)
+        if updated:
+            response_cache.invalidate(user_id, 'platforms')
+    
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'message': 'Platform deleted'}),
+        'headers': dict(JSON_HEADERS),
+        'body': dumps({'results': results, 'updated': updated, 'failed': len(items) - updated}),
         'isBase64Encoded': False
     }
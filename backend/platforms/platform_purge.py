@@ -0,0 +1,65 @@
+'''
+Purge job for deleted streaming platforms.
+
+    python platform_purge.py
+
+Tombstones older than PLATFORMS_PURGE_AFTER_DAYS are moved to
+streaming_platforms_archive in batches of PLATFORMS_PURGE_BATCH_SIZE rows,
+one short transaction per batch. Rows are claimed with SKIP LOCKED, so
+several purgers can run at once without waiting on each other. Archived rows
+keep change_xid, so the library sync still reports them as deleted.
+'''
+import os
+import time
+from typing import Dict
+
+PLATFORMS_PURGE_AFTER_DAYS = int(os.environ.get('PLATFORMS_PURGE_AFTER_DAYS', '7'))
+PLATFORMS_PURGE_BATCH_SIZE = int(os.environ.get('PLATFORMS_PURGE_BATCH_SIZE', '500'))
+PLATFORMS_PURGE_PAUSE = float(os.environ.get('PLATFORMS_PURGE_PAUSE', '0.1'))
+
+PLATFORM_COLUMNS = 'id, user_id, name, icon, color, status, created_at, deleted_at, updated_at, change_xid'
+
+
+def purge_batch(conn, batch_size: int, after_days: int) -> int:
+    cursor = conn.cursor()
+    cursor.execute(
+        f'''WITH doomed AS (
+                SELECT id FROM streaming_platforms
+                WHERE status = 'deleted' AND deleted_at < NOW() - make_interval(days => %s)
+                ORDER BY deleted_at, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ), moved AS (
+                DELETE FROM streaming_platforms p USING doomed WHERE p.id = doomed.id
+                RETURNING p.*
+            )
+            INSERT INTO streaming_platforms_archive ({PLATFORM_COLUMNS})
+            SELECT {PLATFORM_COLUMNS} FROM moved''',
+        (after_days, batch_size)
+    )
+    moved = cursor.rowcount
+    conn.commit()
+    cursor.close()
+    return moved
+
+
+def purge_platforms(conn, batch_size: int = PLATFORMS_PURGE_BATCH_SIZE,
+                    after_days: int = PLATFORMS_PURGE_AFTER_DAYS) -> Dict[str, int]:
+    archived = 0
+    while True:
+        moved = purge_batch(conn, batch_size, after_days)
+        archived += moved
+        if moved < batch_size:
+            break
+        time.sleep(PLATFORMS_PURGE_PAUSE)
+    return {'archived': archived}
+
+
+if __name__ == '__main__':
+    from db_pool import get_pool
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        print(f'[platform_purge] {purge_platforms(conn)}')
+    finally:
+        pool.putconn(conn)
@@ -0,0 +1,86 @@
+'''
+Bounded in-process LRU of serialized list responses, keyed by user,
+collection and query variant. Entries carry the collection version they
+were built from, so a write committed by another instance is never served.
+'''
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Set, Tuple
+
+CacheKey = Tuple[int, str, str]
+
+
+def cache_key(user_id: int, collection: str, query_params: Dict[str, str]) -> CacheKey:
+    return user_id, collection, '&'.join(f'{k}={v}' for k, v in sorted(query_params.items()))
+
+
+class ResponseCache:
+    def __init__(self, max_bytes: int, max_entry_bytes: int):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries: 'OrderedDict[CacheKey, Tuple[int, str, int]]' = OrderedDict()
+        self._by_collection: Dict[Tuple[int, str], Set[CacheKey]] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'rejected': 0}
+
+    def _drop(self, key: CacheKey) -> None:
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+        siblings = self._by_collection.get(key[:2])
+        if siblings is not None:
+            siblings.discard(key)
+            if not siblings:
+                del self._by_collection[key[:2]]
+
+    def get(self, key: CacheKey, version: int) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                if entry is not None:
+                    self._drop(key)
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[1]
+
+    def put(self, key: CacheKey, version: int, body: str) -> None:
+        size = sys.getsizeof(body)
+        with self._lock:
+            if size > self.max_entry_bytes:
+                self._stats['rejected'] += 1
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (version, body, size)
+            self._by_collection.setdefault(key[:2], set()).add(key)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def invalidate(self, user_id: int, collection: str) -> None:
+        with self._lock:
+            for key in list(self._by_collection.get((user_id, collection), ())):
+                self._drop(key)
+                self._stats['invalidations'] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hit_ratio': self._stats['hits'] / lookups if lookups else 0.0
+            }
+
+
+response_cache = ResponseCache(
+    max_bytes=int(os.environ.get('RESPONSE_CACHE_BYTES', str(32 * 1024 * 1024))),
+    max_entry_bytes=int(os.environ.get('RESPONSE_CACHE_MAX_ENTRY_BYTES', str(4 * 1024 * 1024)))
+)
@@ -0,0 +1,147 @@
+'''
+Sliding session expiry. Resolving a session records activity in memory; the
+recorded tokens are written back in one batched UPDATE once the oldest one
+has waited SESSION_TOUCH_FLUSH_INTERVAL seconds or SESSION_TOUCH_MAX_PENDING
+tokens are waiting. A token is recorded at most once per
+SESSION_TOUCH_INTERVAL per instance, and the UPDATE skips rows another
+instance has already extended within that interval, so a busy session costs
+one write per interval rather than one per request.
+
+Each touch moves expires_at to last activity + SESSION_SLIDING_TTL, but never
+past created_at + SESSION_MAX_DAYS. Signed tokens carry their expiry and do
+not slide.
+
+Handlers call flush_session_touches() after returning their connection to
+the pool; it writes on a pooled connection of its own, so a touch never
+commits or rolls back a transaction of the request.
+'''
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Optional
+import psycopg2
+from psycopg2.extras import execute_values
+from db_pool import get_pool, PoolExhausted
+
+logger = logging.getLogger(__name__)
+
+
+class SessionToucher:
+    def __init__(self, interval: float = 300.0, sliding_ttl: float = 7 * 24 * 3600, max_days: int = 30,
+                 flush_interval: float = 30.0, max_pending: int = 1000, max_tracked: int = 10000):
+        self.interval = interval
+        self.sliding_ttl = sliding_ttl
+        self.max_days = max_days
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_tracked = max_tracked
+        self._pending: Dict[str, datetime] = {}
+        self._oldest: Optional[float] = None
+        self._recorded: 'OrderedDict[str, float]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'touches': 0, 'recorded': 0, 'flushes': 0, 'rows_extended': 0, 'flush_failures': 0}
+
+    def touch(self, session_token: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._stats['touches'] += 1
+            last = self._recorded.get(session_token)
+            if last is not None and now - last < self.interval:
+                return
+            self._recorded[session_token] = now
+            self._recorded.move_to_end(session_token)
+            while len(self._recorded) > self.max_tracked:
+                self._recorded.popitem(last=False)
+            self._pending[session_token] = datetime.now()
+            if self._oldest is None:
+                self._oldest = now
+            self._stats['recorded'] += 1
+
+    def due(self) -> bool:
+        with self._lock:
+            if not self._pending:
+                return False
+            return (len(self._pending) >= self.max_pending
+                    or time.monotonic() - self._oldest >= self.flush_interval)
+
+    def flush(self, conn) -> int:
+        with self._lock:
+            pending, self._pending, self._oldest = self._pending, {}, None
+        if not pending:
+            return 0
+
+        try:
+            cursor = conn.cursor()
+            # The settings are numbers from the environment, so they are
+            # inlined; execute_values only takes the VALUES placeholder.
+            new_expiry = (f'LEAST(v.seen + make_interval(secs => {float(self.sliding_ttl)}), '
+                          f's.created_at + make_interval(days => {int(self.max_days)}))')
+            execute_values(
+                cursor,
+                f'''UPDATE sessions AS s SET expires_at = {new_expiry}, last_seen_at = v.seen
+                    FROM (VALUES %s) AS v(session_token, seen)
+                    WHERE s.session_token = v.session_token
+                      AND s.expires_at > NOW()
+                      AND s.expires_at < {new_expiry} - make_interval(secs => {float(self.interval)})''',
+                list(pending.items()),
+                template='(%s, %s::timestamp)'
+            )
+            extended = cursor.rowcount
+            conn.commit()
+            cursor.close()
+        except Exception:
+            conn.rollback()
+            with self._lock:
+                for session_token, seen in pending.items():
+                    self._pending.setdefault(session_token, seen)
+                if self._oldest is None:
+                    self._oldest = time.monotonic()
+            with self._lock:
+                self._stats['flush_failures'] += 1
+            raise
+
+        with self._lock:
+            self._stats['flushes'] += 1
+            self._stats['rows_extended'] += extended
+        return extended
+
+    def forget(self, session_token: str) -> None:
+        with self._lock:
+            self._pending.pop(session_token, None)
+            self._recorded.pop(session_token, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, 'pending': len(self._pending)}
+
+
+session_toucher = SessionToucher(
+    interval=float(os.environ.get('SESSION_TOUCH_INTERVAL', '300')),
+    sliding_ttl=float(os.environ.get('SESSION_SLIDING_TTL', str(7 * 24 * 3600))),
+    max_days=int(os.environ.get('SESSION_MAX_DAYS', '30')),
+    flush_interval=float(os.environ.get('SESSION_TOUCH_FLUSH_INTERVAL', '30')),
+    max_pending=int(os.environ.get('SESSION_TOUCH_MAX_PENDING', '1000'))
+)
+
+
+def flush_session_touches() -> None:
+    if not session_toucher.due():
+        return
+    pool = get_pool()
+    handler_query_count = pool.last_query_count
+    try:
+        conn = pool.getconn()
+    except (PoolExhausted, psycopg2.Error):
+        logger.warning('Session touch flush skipped, no database connection', exc_info=True)
+        return
+    try:
+        session_toucher.flush(conn)
+    except psycopg2.Error:
+        logger.warning('Session touch flush failed, touches kept for the next flush', exc_info=True)
+    finally:
+        pool.putconn(conn)
+        # putconn records this connection's count; the handler's comes first.
+        pool.last_query_count += handler_query_count
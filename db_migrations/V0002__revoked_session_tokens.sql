@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS revoked_session_tokens (
+    token_id VARCHAR(64) PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id),
+    expires_at TIMESTAMP NOT NULL,
+    revoked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_revoked_session_tokens_expires ON revoked_session_tokens(expires_at);
\ No newline at end of file
@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS collection_versions (
+    user_id INTEGER REFERENCES users(id),
+    collection VARCHAR(20) NOT NULL,
+    version BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, collection)
+);
\ No newline at end of file
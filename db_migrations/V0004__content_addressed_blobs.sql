@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS blobs (
+    hash CHAR(64) PRIMARY KEY,
+    size BIGINT NOT NULL,
+    ref_count INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE files ADD COLUMN IF NOT EXISTS content_hash CHAR(64);
+
+CREATE INDEX IF NOT EXISTS idx_files_content_hash ON files(content_hash);
\ No newline at end of file
@@ -0,0 +1,24 @@
+CREATE TABLE IF NOT EXISTS uploads (
+    id VARCHAR(32) PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id),
+    name VARCHAR(255) NOT NULL,
+    type VARCHAR(50),
+    size BIGINT NOT NULL,
+    chunk_size INTEGER NOT NULL,
+    chunk_count INTEGER NOT NULL,
+    status VARCHAR(20) DEFAULT 'pending',
+    file_id INTEGER REFERENCES files(id),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS upload_chunks (
+    upload_id VARCHAR(32) REFERENCES uploads(id),
+    chunk_index INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    checksum CHAR(64) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (upload_id, chunk_index)
+);
+
+CREATE INDEX IF NOT EXISTS idx_uploads_user ON uploads(user_id);
\ No newline at end of file
@@ -0,0 +1,35 @@
+CREATE TABLE IF NOT EXISTS previews (
+    source_hash CHAR(64) PRIMARY KEY,
+    preview_hash CHAR(64) NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS preview_jobs (
+    id SERIAL PRIMARY KEY,
+    source_hash CHAR(64) UNIQUE NOT NULL,
+    status VARCHAR(20) DEFAULT 'pending',
+    attempts INTEGER DEFAULT 0,
+    last_error TEXT,
+    locked_by VARCHAR(64),
+    locked_at TIMESTAMP,
+    run_after TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_preview_jobs_runnable ON preview_jobs(run_after, id) WHERE status IN ('pending', 'running');
+
+CREATE TABLE IF NOT EXISTS preview_workers (
+    worker_id VARCHAR(64) PRIMARY KEY,
+    jobs_done INTEGER DEFAULT 0,
+    jobs_failed INTEGER DEFAULT 0,
+    jobs_retried INTEGER DEFAULT 0,
+    bytes_in BIGINT DEFAULT 0,
+    bytes_out BIGINT DEFAULT 0,
+    busy_seconds DOUBLE PRECISION DEFAULT 0,
+    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
\ No newline at end of file
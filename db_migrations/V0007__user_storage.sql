@@ -0,0 +1,14 @@
+CREATE TABLE IF NOT EXISTS user_storage (
+    user_id INTEGER PRIMARY KEY REFERENCES users(id),
+    used_bytes BIGINT NOT NULL DEFAULT 0,
+    reserved_bytes BIGINT NOT NULL DEFAULT 0,
+    file_count INTEGER NOT NULL DEFAULT 0,
+    quota_bytes BIGINT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO user_storage (user_id, used_bytes, file_count)
+SELECT user_id, SUM(size), COUNT(*) FROM files
+WHERE type <> 'deleted' AND user_id IS NOT NULL
+GROUP BY user_id
+ON CONFLICT (user_id) DO NOTHING;
\ No newline at end of file
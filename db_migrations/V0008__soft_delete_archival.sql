@@ -0,0 +1,24 @@
+ALTER TABLE files ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+ALTER TABLE streaming_platforms ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+
+UPDATE files SET deleted_at = CURRENT_TIMESTAMP WHERE type = 'deleted' AND deleted_at IS NULL;
+UPDATE streaming_platforms SET deleted_at = CURRENT_TIMESTAMP WHERE status = 'deleted' AND deleted_at IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_files_user_live ON files(user_id, created_at DESC, id DESC) WHERE type <> 'deleted';
+CREATE INDEX IF NOT EXISTS idx_streaming_platforms_user_live ON streaming_platforms(user_id, created_at DESC, id DESC) WHERE status <> 'deleted';
+CREATE INDEX IF NOT EXISTS idx_files_tombstones ON files(deleted_at, id) WHERE type = 'deleted';
+CREATE INDEX IF NOT EXISTS idx_streaming_platforms_tombstones ON streaming_platforms(deleted_at, id) WHERE status = 'deleted';
+
+DROP INDEX IF EXISTS idx_files_user;
+DROP INDEX IF EXISTS idx_streaming_platforms_user;
+
+CREATE TABLE IF NOT EXISTS files_archive (LIKE files INCLUDING DEFAULTS);
+ALTER TABLE files_archive ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE files_archive ADD PRIMARY KEY (id);
+
+CREATE TABLE IF NOT EXISTS streaming_platforms_archive (LIKE streaming_platforms INCLUDING DEFAULTS);
+ALTER TABLE streaming_platforms_archive ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE streaming_platforms_archive ADD PRIMARY KEY (id);
+
+ALTER TABLE uploads DROP CONSTRAINT IF EXISTS uploads_file_id_fkey;
+ALTER TABLE uploads ADD CONSTRAINT uploads_file_id_fkey FOREIGN KEY (file_id) REFERENCES files(id) ON DELETE SET NULL;
\ No newline at end of file
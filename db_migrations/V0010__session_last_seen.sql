@@ -0,0 +1 @@
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS last_seen_at TIMESTAMP;
\ No newline at end of file
@@ -0,0 +1,16 @@
+CREATE INDEX IF NOT EXISTS idx_games_user_recent ON games(user_id, updated_at DESC, id DESC) INCLUDE (name, hours, status, created_at);
+DROP INDEX IF EXISTS idx_games_user;
+
+CREATE INDEX IF NOT EXISTS idx_files_user_live_cover ON files(user_id, created_at DESC, id DESC) INCLUDE (name, size, type, content_hash) WHERE type <> 'deleted';
+DROP INDEX IF EXISTS idx_files_user_live;
+
+CREATE INDEX IF NOT EXISTS idx_streaming_platforms_user_live_cover ON streaming_platforms(user_id, created_at DESC, id DESC) INCLUDE (name, icon, color, status) WHERE status <> 'deleted';
+DROP INDEX IF EXISTS idx_streaming_platforms_user_live;
+
+CREATE INDEX IF NOT EXISTS idx_sessions_token_cover ON sessions(session_token) INCLUDE (user_id, expires_at);
+DROP INDEX IF EXISTS idx_sessions_token;
+
+CREATE INDEX IF NOT EXISTS idx_sessions_user_recent ON sessions(user_id, expires_at DESC, id DESC);
+DROP INDEX IF EXISTS idx_sessions_user_expires;
+
+DROP INDEX IF EXISTS idx_users_email;
\ No newline at end of file
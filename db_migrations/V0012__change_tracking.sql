@@ -0,0 +1,39 @@
+ALTER TABLE games ADD COLUMN IF NOT EXISTS change_xid xid8 NOT NULL DEFAULT pg_current_xact_id();
+
+ALTER TABLE streaming_platforms ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+UPDATE streaming_platforms SET updated_at = COALESCE(deleted_at, created_at) WHERE updated_at IS NULL;
+ALTER TABLE streaming_platforms ALTER COLUMN updated_at SET DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE streaming_platforms ADD COLUMN IF NOT EXISTS change_xid xid8 NOT NULL DEFAULT pg_current_xact_id();
+
+ALTER TABLE files ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+UPDATE files SET updated_at = COALESCE(deleted_at, created_at) WHERE updated_at IS NULL;
+ALTER TABLE files ALTER COLUMN updated_at SET DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE files ADD COLUMN IF NOT EXISTS change_xid xid8 NOT NULL DEFAULT pg_current_xact_id();
+
+ALTER TABLE streaming_platforms_archive ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+ALTER TABLE streaming_platforms_archive ADD COLUMN IF NOT EXISTS change_xid xid8;
+ALTER TABLE files_archive ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP;
+ALTER TABLE files_archive ADD COLUMN IF NOT EXISTS change_xid xid8;
+
+CREATE OR REPLACE FUNCTION track_change() RETURNS trigger AS $$
+BEGIN
+    NEW.change_xid := pg_current_xact_id();
+    IF NEW.updated_at IS NOT DISTINCT FROM OLD.updated_at THEN
+        NEW.updated_at := CURRENT_TIMESTAMP;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS games_track_change ON games;
+CREATE TRIGGER games_track_change BEFORE UPDATE ON games FOR EACH ROW EXECUTE FUNCTION track_change();
+DROP TRIGGER IF EXISTS streaming_platforms_track_change ON streaming_platforms;
+CREATE TRIGGER streaming_platforms_track_change BEFORE UPDATE ON streaming_platforms FOR EACH ROW EXECUTE FUNCTION track_change();
+DROP TRIGGER IF EXISTS files_track_change ON files;
+CREATE TRIGGER files_track_change BEFORE UPDATE ON files FOR EACH ROW EXECUTE FUNCTION track_change();
+
+CREATE INDEX IF NOT EXISTS idx_games_user_changes ON games(user_id, change_xid, id);
+CREATE INDEX IF NOT EXISTS idx_streaming_platforms_user_changes ON streaming_platforms(user_id, change_xid, id);
+CREATE INDEX IF NOT EXISTS idx_files_user_changes ON files(user_id, change_xid, id);
+CREATE INDEX IF NOT EXISTS idx_streaming_platforms_archive_user_changes ON streaming_platforms_archive(user_id, change_xid, id);
+CREATE INDEX IF NOT EXISTS idx_files_archive_user_changes ON files_archive(user_id, change_xid, id);
\ No newline at end of file
@@ -0,0 +1,3 @@
+ALTER TABLE users ADD COLUMN IF NOT EXISTS two_fa_confirmed_at TIMESTAMP;
+
+UPDATE users SET two_fa_enabled = FALSE WHERE two_fa_enabled AND two_fa_confirmed_at IS NULL;
\ No newline at end of file
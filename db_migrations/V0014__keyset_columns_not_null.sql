@@ -0,0 +1,8 @@
+UPDATE games SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL;
+ALTER TABLE games ALTER COLUMN updated_at SET NOT NULL;
+
+UPDATE streaming_platforms SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+ALTER TABLE streaming_platforms ALTER COLUMN created_at SET NOT NULL;
+
+UPDATE files SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL;
+ALTER TABLE files ALTER COLUMN created_at SET NOT NULL;
\ No newline at end of file
@@ -0,0 +1 @@
+CREATE INDEX IF NOT EXISTS idx_uploads_pending_expiry ON uploads(expires_at, id) WHERE status = 'pending';
\ No newline at end of file
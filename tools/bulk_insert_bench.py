@@ -0,0 +1,56 @@
+'''
+Throughput of the games bulk create path against one INSERT per item.
+
+    python tools/bulk_insert_bench.py [--items 1000] [--repeats 5]
+
+Both paths run the handler's own statements (GAME_INSERT_QUERY through
+db_pool.execute_prepared, GAMES_BULK_INSERT_QUERY through execute_values
+with BULK_PAGE_SIZE) for a throwaway user, in one transaction that is
+rolled back at the end. This is a development tool and is not deployed.
+'''
+import argparse
+import os
+import sys
+import timeit
+
+BACKEND = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend')
+sys.path[:0] = [os.path.join(BACKEND, 'games')]
+from psycopg2.extras import execute_values
+from db_pool import get_pool, execute_prepared
+import index as games
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=1000, help='rows inserted per run')
+    parser.add_argument('--repeats', type=int, default=5, help='runs per path; the best one is reported')
+    args = parser.parse_args()
+
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO users (email, password_hash) VALUES ('bulk-benchmark@example.invalid', 'x') RETURNING id"
+        )
+        user_id = cursor.fetchone()[0]
+        values = [(user_id, f'game {i}', i % 100, 'playing') for i in range(args.items)]
+
+        def per_item():
+            for value in values:
+                execute_prepared(cursor, games.GAME_INSERT_QUERY, value)
+                cursor.fetchone()
+
+        def bulk():
+            execute_values(cursor, games.GAMES_BULK_INSERT_QUERY, values, page_size=games.BULK_PAGE_SIZE, fetch=True)
+
+        for label, path in (('per-item INSERT', per_item), (f'execute_values (page {games.BULK_PAGE_SIZE})', bulk)):
+            best = min(timeit.repeat(path, number=1, repeat=args.repeats))
+            print(f'{label}: {args.items / best:.0f} rows/s ({best * 1e3:.1f} ms for {args.items} rows)')
+        conn.rollback()
+    finally:
+        pool.putconn(conn)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+'''
+Query plan regression check for the hot list, session and sync queries.
+
+    python tools/query_plans.py             # check against the data already in DATABASE_URL
+    python tools/query_plans.py --seed 5000 # seed that many synthetic users first
+    python tools/query_plans.py --bench 2000 [--seed 5000]  # text vs prepared, per query
+
+Each query runs under EXPLAIN (ANALYZE, BUFFERS) for the user with the most
+games and fails the check on a sequential scan, an explicit sort, or more
+shared buffers than the query's budget. Seeded rows are written in the
+check's own transaction and rolled back at the end, so --seed leaves the
+database as it was (sequences aside); use a scratch database and VACUUM
+ANALYZE between seeded runs, as the rolled back rows linger as dead tuples
+and skew the next run's plans. Exits non-zero when any query fails.
+
+--bench runs each query that many times as plain text and as a prepared
+statement (db_pool.execute_prepared) and prints the mean time per call,
+which shows what skipping parse and plan saves per endpoint.
+
+The statements are loaded from the function modules under backend/ (the
+list queries go through pagination.page_query as fetch_page builds them),
+so the check always sees what the handlers run. auth.session_cap is the
+insert-and-trim statement itself; under the rolled back transaction its
+writes are discarded. library.sync reads from the current snapshot xmin,
+so with --seed every seeded row counts as a change and the page limit
+bounds the work. This is a development tool and is not deployed.
+'''
+import importlib.util
+import json
+import os
+import secrets
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Tuple
+
+BACKEND = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend')
+FUNCTIONS = ('library', 'auth', 'games', 'platforms', 'files')
+PAGE_LIMIT = 50
+
+# The shared modules (db_pool, pagination, ...) are identical copies in each
+# function, so whichever directory resolves them first will do.
+sys.path[:0] = [os.path.join(BACKEND, function) for function in FUNCTIONS]
+from db_pool import execute_prepared
+
+
+def load_module(function: str, module: str):
+    path = os.path.join(BACKEND, function, f'{module}.py')
+    spec = importlib.util.spec_from_file_location(f'{function}_{module}', path)
+    loaded = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(loaded)
+    return loaded
+
+
+Statement = Callable[[Dict[str, Any]], Tuple[str, Any]]
+
+
+def hot_queries() -> Dict[str, Tuple[int, Statement]]:
+    '''
+    name -> (shared buffer budget, sample params -> (statement, args));
+    files.list pays a previews primary-key probe per row on top of its own
+    index range, and auth.session_cap the insert plus trimming the seeded
+    60 sessions down to the cap.
+    '''
+    pagination = load_module('games', 'pagination')
+    games = load_module('games', 'index')
+    platforms = load_module('platforms', 'index')
+    files = load_module('files', 'index')
+    auth = load_module('auth', 'index')
+    sync = load_module('library', 'library_sync')
+
+    def page(query: str, sort_column: str, after: bool = False) -> Statement:
+        return lambda sample: pagination.page_query(
+            query, (sample['user_id'],), sort_column, PAGE_LIMIT, (sample['now'], 2147483647) if after else None
+        )
+
+    return {
+        'games.list': (100, page(games.GAMES_LIST_QUERY, 'updated_at')),
+        'games.list_after': (100, page(games.GAMES_LIST_QUERY, 'updated_at', after=True)),
+        'platforms.list': (100, page(platforms.PLATFORMS_LIST_QUERY, 'created_at')),
+        'files.list': (250, page(files.FILES_LIST_QUERY, 'created_at')),
+        'auth.login': (10, lambda sample: (auth.LOGIN_QUERY, (sample['email'],))),
+        'auth.session': (10, lambda sample: (auth.SESSION_USER, (sample['session_token'],))),
+        'auth.session_cap': (150, lambda sample: (auth.SESSION_CAP_SQL, (
+            sample['user_id'], f'plan-check-{secrets.token_hex(8)}', datetime.now() + timedelta(days=7),
+            sample['user_id'], sample['user_id'], max(auth.SESSION_MAX_PER_USER - 1, 0)
+        ))),
+        'library.sync': (60, lambda sample: (sync.SYNC_QUERIES[0], sync.sync_params(
+            sample['user_id'], sample['since'], None, 0, sample['since'], 0, PAGE_LIMIT
+        ))),
+    }
+
+
+SEED_STATEMENTS = [
+    "INSERT INTO users (email, password_hash) SELECT 'plan-check-' || g || '@example.invalid', 'x' FROM generate_series(1, %(users)s) g",
+    '''INSERT INTO games (user_id, name, hours, status, created_at, updated_at)
+       SELECT u.id, 'game ' || g, g %% 100, 'playing', NOW() - g * INTERVAL '1 minute', NOW() - g * INTERVAL '1 minute'
+       FROM users u CROSS JOIN generate_series(1, 200) g WHERE u.email LIKE 'plan-check-%%' ''',
+    '''INSERT INTO files (user_id, name, size, type, storage_key, content_hash, created_at)
+       SELECT u.id, 'file ' || g, g, CASE WHEN g %% 10 = 0 THEN 'deleted' ELSE 'text/plain' END, 'plan-check',
+              md5(u.id || '-' || g) || md5(g || '-' || u.id), NOW() - g * INTERVAL '1 minute'
+       FROM users u CROSS JOIN generate_series(1, 150) g WHERE u.email LIKE 'plan-check-%%' ''',
+    '''INSERT INTO previews (source_hash, preview_hash, width, height, size)
+       SELECT content_hash, content_hash, 320, 240, 1024 FROM files
+       WHERE storage_key = 'plan-check' AND id %% 4 = 0 ON CONFLICT DO NOTHING''',
+    '''INSERT INTO streaming_platforms (user_id, name, status, created_at)
+       SELECT u.id, 'platform ' || g, CASE WHEN g %% 10 = 0 THEN 'deleted' ELSE 'active' END, NOW() - g * INTERVAL '1 minute'
+       FROM users u CROSS JOIN generate_series(1, 100) g WHERE u.email LIKE 'plan-check-%%' ''',
+    '''INSERT INTO sessions (user_id, session_token, expires_at)
+       SELECT u.id, 'plan-check-' || u.id || '-' || g, NOW() + g * INTERVAL '1 hour'
+       FROM users u CROSS JOIN generate_series(1, 60) g WHERE u.email LIKE 'plan-check-%%' ''',
+    'ANALYZE users, games, files, previews, streaming_platforms, sessions',
+]
+
+
+def seed(cursor, users: int) -> None:
+    for statement in SEED_STATEMENTS:
+        cursor.execute(statement, {'users': users})
+
+
+def sample_params(cursor) -> Dict[str, Any]:
+    cursor.execute(
+        '''SELECT u.id, u.email, (SELECT session_token FROM sessions s WHERE s.user_id = u.id LIMIT 1),
+                  NOW()::timestamp::text, pg_snapshot_xmin(pg_current_snapshot())::text
+           FROM users u JOIN (SELECT user_id FROM games GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1) busiest
+                ON busiest.user_id = u.id'''
+    )
+    row = cursor.fetchone()
+    if row is None:
+        raise SystemExit('[query_plans] no games to sample; run with --seed')
+    return {'user_id': row[0], 'email': row[1], 'session_token': row[2] or '', 'now': row[3], 'since': int(row[4])}
+
+
+def plan_nodes(node: Dict[str, Any]) -> List[Dict[str, Any]]:
+    nodes = [node]
+    for child in node.get('Plans', []):
+        nodes.extend(plan_nodes(child))
+    return nodes
+
+
+def check_plan(plan: Dict[str, Any], max_buffers: int) -> List[str]:
+    problems = []
+    for node in plan_nodes(plan):
+        if node['Node Type'] == 'Seq Scan':
+            problems.append(f"seq scan on {node.get('Relation Name')}")
+        elif node['Node Type'] in ('Sort', 'Incremental Sort'):
+            problems.append(f"{node['Node Type'].lower()} on {', '.join(node.get('Sort Key', []))}")
+    buffers = plan.get('Shared Hit Blocks', 0) + plan.get('Shared Read Blocks', 0)
+    if buffers > max_buffers:
+        problems.append(f'{buffers} shared buffers (budget {max_buffers})')
+    return problems
+
+
+def run(conn, seed_users: int = 0) -> List[Tuple[str, List[str]]]:
+    queries = hot_queries()
+    cursor = conn.cursor()
+    try:
+        if seed_users:
+            seed(cursor, seed_users)
+        sample = sample_params(cursor)
+        results = []
+        for name, (max_buffers, statement) in queries.items():
+            query, args = statement(sample)
+            cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}', args)
+            explained = cursor.fetchone()[0]
+            if isinstance(explained, str):
+                explained = json.loads(explained)
+            results.append((name, check_plan(explained[0]['Plan'], max_buffers)))
+        return results
+    finally:
+        conn.rollback()
+        cursor.close()
+
+
+def bench(conn, iterations: int, seed_users: int = 0) -> List[Tuple[str, float, float]]:
+    queries = hot_queries()
+    cursor = conn.cursor()
+    try:
+        if seed_users:
+            seed(cursor, seed_users)
+        sample = sample_params(cursor)
+        results = []
+        for name, (_, statement) in queries.items():
+            timings = []
+            for prepared in (False, True):
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    query, args = statement(sample)
+                    if prepared:
+                        execute_prepared(cursor, query, args)
+                    else:
+                        cursor.execute(query, args)
+                    cursor.fetchall()
+                timings.append((time.perf_counter() - started) / iterations * 1e6)
+            results.append((name, timings[0], timings[1]))
+        return results
+    finally:
+        conn.rollback()
+        cursor.close()
+
+
+def option(flag: str) -> int:
+    return int(sys.argv[sys.argv.index(flag) + 1]) if flag in sys.argv[1:] else 0
+
+
+if __name__ == '__main__':
+    from db_pool import get_pool
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        if option('--bench'):
+            for name, text_us, prepared_us in bench(conn, option('--bench'), option('--seed')):
+                print(f'[query_plans] {name}: text {text_us:.0f} us, prepared {prepared_us:.0f} us '
+                      f'({100 * (text_us - prepared_us) / text_us:.0f}% saved)')
+            sys.exit(0)
+        results = run(conn, option('--seed'))
+    finally:
+        pool.putconn(conn)
+    for name, problems in results:
+        print(f"[query_plans] {name}: {'; '.join(problems) if problems else 'ok'}")
+    sys.exit(1 if any(problems for _, problems in results) else 0)